@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+'''
+Scaling benchmark for eosgenlab.py, run against the offline vSphere fake in
+fakevsphere.py so no ESXi host is needed.
+
+For each topology size and mode a spine/leaf topology is generated and the
+full build is run in a fresh python process, with the fake standing in for
+the host's SOAP API and datastore http service. Reported per run:
+
+    wall time, SOAP calls (total and per node), tasks (total and per
+    node), bytes uploaded and peak memory of the process
+
+Use --latency and --task_duration to make the fake behave more like a real
+host; the defaults measure the script's own overhead. --json writes the
+results out so runs can be compared from commit to commit.
+
+Examples:
+    python3 benchmark/bench.py
+    python3 benchmark/bench.py --sizes 2,50,500 --modes seed,linked --latency 0.002
+    python3 benchmark/bench.py --json bench.json
+'''
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+MODES = OrderedDict([
+    ('default', []),
+    ('seed', ['--seed']),
+    ('linked', ['--linked']),
+    ('sparse', ['--sparse']),
+    ('fabric', ['--linked', '--fabric']),
+])
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Scaling benchmark for eosgenlab.py against an offline vSphere fake')
+    parser.add_argument('--sizes',
+                        default='2,10,50,100,250,500',
+                        action='store',
+                        help='Comma separated topology sizes (number of nodes)')
+    parser.add_argument('--modes',
+                        default='default,seed,linked',
+                        action='store',
+                        help='Comma separated disk modes: %s' % ', '.join(MODES))
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.0,
+                        action='store',
+                        help='Seconds added to every SOAP call')
+    parser.add_argument('--task_duration',
+                        type=float,
+                        default=0.0,
+                        action='store',
+                        help='Seconds each task takes to complete')
+    parser.add_argument('--image_mb',
+                        type=int,
+                        default=4,
+                        action='store',
+                        help='Size of the generated vmdk in MB')
+    parser.add_argument('--parallel',
+                        type=int,
+                        default=4,
+                        action='store',
+                        help='Passed on to eosgenlab.py')
+    parser.add_argument('--max_uploads',
+                        type=int,
+                        default=2,
+                        action='store',
+                        help='Passed on to eosgenlab.py')
+    parser.add_argument('--json',
+                        action='store',
+                        help='Write the results to this file')
+    parser.add_argument('--one',
+                        nargs=2,
+                        metavar=('NODES', 'MODE'),
+                        help=argparse.SUPPRESS)
+    return parser
+
+
+def topology(nodes):
+    '''
+    A spine/leaf topology with the given number of nodes: two spines (four
+    from 100 nodes up) and racks of two leafs. Each rack has an MLAG peer
+    link. Spines only have nine front panel ports, so the first nine leafs
+    get an uplink to every spine.
+    '''
+    spines = 2 if nodes < 100 else 4
+    spines = min(spines, max(nodes - 1, 1))
+    doc = OrderedDict()
+    for s in range(1, spines + 1):
+        doc['Spine-%d' % s] = OrderedDict([('description', 'Spine-%d' % s),
+                                           ('Ma1', 'Lab-vEOS')])
+    for leaf in range(nodes - spines):
+        rack, side = divmod(leaf, 2)
+        name = 'R%d-Leaf-%d' % (rack + 1, side + 1)
+        node = OrderedDict([('description', name), ('Ma1', 'Lab-vEOS')])
+        uplinks = spines if leaf < 9 else 0
+        for s in range(1, uplinks + 1):
+            segment = 'vEOS-R%d-L%d-S%d' % (rack + 1, side + 1, s)
+            node['E%d' % s] = segment
+            doc['Spine-%d' % s]['E%d' % (leaf + 1)] = segment
+        if side == 1 or leaf + 1 < nodes - spines:
+            node['E%d' % (uplinks + 1)] = 'vEOS-R%d-Peer' % (rack + 1)
+        doc[name] = node
+    return doc
+
+
+def write_yaml(doc, path):
+    #Plain block style yaml like example.yaml, without needing a yaml dumper
+    #that knows about OrderedDict
+    with open(path, 'w') as fh:
+        for name, node in doc.items():
+            fh.write('%s:\n' % name)
+            for key, value in node.items():
+                fh.write('    %s: %s\n' % (key, value))
+            fh.write('\n')
+
+
+def write_image(path, size_mb):
+    '''
+    A raw disk image that is mostly zeros, with some data at the start and
+    every 8MB, roughly the shape of the vEOS image.
+    '''
+    with open(path, 'wb') as fh:
+        fh.truncate(size_mb * 2**20)
+        for offset in range(0, size_mb * 2**20, 8 * 2**20):
+            fh.seek(offset)
+            fh.write(os.urandom(256 * 1024))
+
+
+def run_one(nodes, mode, args):
+    '''
+    Build one topology against a fresh fake and return the measurements.
+    Runs in its own process so peak memory is the run's own.
+    '''
+    workdir = tempfile.mkdtemp(prefix='eosgenlab-bench-')
+    #Keep the checksum and extent caches out of the real home directory
+    os.environ['HOME'] = workdir
+    sys.path.insert(0, HERE)
+    sys.path.insert(0, os.path.dirname(HERE))
+
+    import fakevsphere
+    from pyVim import connect
+    import eosgenlab
+
+    yaml_file = os.path.join(workdir, 'topology.yaml')
+    write_yaml(topology(nodes), yaml_file)
+    image = os.path.join(workdir, 'vEOS-lab.vmdk')
+    write_image(image, args.image_mb)
+
+    #A host big enough for the lab, so the capacity check lets it through
+    service_instance, host = fakevsphere.fake_service_instance(
+        latency=args.latency, task_duration=args.task_duration,
+        memory_mb=max(262144, nodes * 8192), cpu_cores=max(32, nodes))
+    server = fakevsphere.FakeDatastoreServer(host)
+    connect.SmartConnect = lambda **kwargs: service_instance
+    connect.Disconnect = lambda si: None
+    #The fake datastore service is plain http on a local port
+    uploader_init = eosgenlab.Uploader.__init__
+
+    def local_uploader(self, *a, **kw):
+        uploader_init(self, *a, **kw)
+        self.base_url = server.base_url
+    eosgenlab.Uploader.__init__ = local_uploader
+
+    sys.argv = ['eosgenlab.py', '-d', 'datastore1', '-s', '127.0.0.1', '-u', 'root',
+                '-p', 'bench', '-S', '-l', image, '-y', yaml_file,
+                '--parallel', str(args.parallel),
+                '--max_uploads', str(args.max_uploads)] + MODES[mode]
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    exit_code = 0
+    start = time.time()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            eosgenlab.main()
+        except SystemExit as e:
+            exit_code = e.code or 0
+    wall = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    server.close()
+
+    calls = host.soap_calls()
+    return OrderedDict([
+        ('nodes', nodes),
+        ('mode', mode),
+        ('exit', exit_code),
+        ('vms', len(host.vms)),
+        ('wall', round(wall, 3)),
+        ('soap_calls', calls),
+        ('calls_per_node', round(calls / float(nodes), 1)),
+        ('tasks', host.tasks),
+        ('tasks_per_node', round(host.tasks / float(nodes), 2)),
+        ('bytes_uploaded', host.bytes_uploaded),
+        #ru_maxrss is in KB on Linux and bytes on macOS
+        ('peak_mb', round(peak / (2.0**20 if sys.platform == 'darwin' else 2.0**10), 1)),
+        ('run_mb', round((peak - baseline) / (2.0**20 if sys.platform == 'darwin'
+                                               else 2.0**10), 1)),
+    ])
+
+
+def print_row(result):
+    print ("%6d %-8s %8.2f %9d %8.1f %7d %7.2f %12d %8.1f %7.1f%s" % (
+        result['nodes'], result['mode'], result['wall'], result['soap_calls'],
+        result['calls_per_node'], result['tasks'], result['tasks_per_node'],
+        result['bytes_uploaded'], result['peak_mb'], result['run_mb'],
+        '' if result['exit'] == 0 and result['vms'] == result['nodes']
+        else '  FAILED (exit %s, %d VMs)' % (result['exit'], result['vms'])))
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    if args.one:
+        print (json.dumps(run_one(int(args.one[0]), args.one[1], args)))
+        return
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    modes = args.modes.split(',')
+    for mode in modes:
+        if mode not in MODES:
+            raise SystemExit("Unknown mode %s" % mode)
+
+    passthrough = ['--latency', str(args.latency), '--task_duration', str(args.task_duration),
+                   '--image_mb', str(args.image_mb), '--parallel', str(args.parallel),
+                   '--max_uploads', str(args.max_uploads)]
+    print ("%6s %-8s %8s %9s %8s %7s %7s %12s %8s %7s" % (
+        'nodes', 'mode', 'wall(s)', 'calls', 'calls/n', 'tasks', 'tasks/n', 'bytes',
+        'peak MB', 'run MB'))
+    results = []
+    for mode in modes:
+        for size in sizes:
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                              '--one', str(size), mode] + passthrough)
+            result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+            results.append(result)
+            print_row(result)
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({'settings': vars(args), 'results': results}, fh, indent=2)
+    if any(result['exit'] != 0 or result['vms'] != result['nodes'] for result in results):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1156 @@
+'''
+In-process stand-in for the slice of the vSphere API that eosgenlab.py uses.
+
+FakeStub plugs in underneath real pyVmomi managed objects, so every
+method call and property read made by the script lands in here instead
+of going over SOAP to an ESXi host. Per-call latency and task durations are
+configurable and every call is counted so the benchmark can report SOAP
+calls and tasks per node.
+
+FakeDatastoreServer is the matching stand-in for the host's http side:
+the datastore /folder service and NFC lease uploads.
+
+Needs python 3.
+'''
+import datetime
+import hashlib
+import itertools
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+from pyVmomi import VmomiSupport
+
+
+def typed(val):
+    '''Plain lists have to be pyVmomi arrays to travel in a DynamicProperty.'''
+    if not isinstance(val, list):
+        return val
+    if val and all(isinstance(v, VmomiSupport.ManagedObject) for v in val):
+        return VmomiSupport.GetVmodlType('vmodl.ManagedObject[]')(val)
+    if val and all(isinstance(v, str) for v in val):
+        return VmomiSupport.GetVmodlType('string[]')(val)
+    return VmomiSupport.GetVmodlType('vmodl.DataObject[]')(val)
+
+
+class FakeFile(object):
+    '''A file on the fake datastore. Only small files keep their content.'''
+    KEEP = 1024 * 1024
+
+    def __init__(self, size=0, sha1=None, data=None):
+        self.size = size
+        self.sha1 = sha1
+        self.data = data
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(len(data), hashlib.sha1(data).hexdigest(),
+                   data if len(data) <= cls.KEEP else None)
+
+
+class FakeHost(object):
+    '''
+    The state of one fake ESXi host: inventory, host networking, datastore
+    files and counters. FakeStub talks to this.
+    '''
+    def __init__(self, hostname='esxi-1', datastores=('datastore1',),
+                 memory_mb=262144, cpu_mhz=2400, cpu_cores=32,
+                 datastore_gb=4096, latency=0.0, task_duration=0.0,
+                 http_latency=0.0, http_bandwidth=0):
+        self.hostname = hostname
+        self.latency = latency
+        self.task_duration = task_duration
+        self.memory_mb = memory_mb
+        self.cpu_mhz = cpu_mhz
+        self.cpu_cores = cpu_cores
+        self.datastore_gb = datastore_gb
+        self.lock = threading.RLock()
+        self.cond = threading.Condition(self.lock)
+        self.ids = itertools.count(1)
+        self.calls = {}
+        self.tasks = 0
+        self.bytes_uploaded = 0
+        self.http_requests = 0
+        self.http_latency = http_latency
+        self.http_bandwidth = http_bandwidth    # bytes/s, 0 for unlimited
+        self.session_valid = True
+        self.sessions = 1
+
+        self.vms = {}          # moId -> dict(name, devices, power, ...)
+        self.vswitches = {}    # name -> vim.host.VirtualSwitch.Specification
+        self.portgroups = {}   # name -> vim.host.PortGroup.Specification
+        self.networks = {}     # pg name -> moId
+        self.files = {}        # '[ds] path' -> FakeFile
+        self.task_info = {}    # moId -> dict(state, done_at, result, error, ...)
+        self.views = {}        # moId -> list of managed objects
+        self.filters = {}      # moId -> dict(collector, tasks, version)
+        self.collectors = {'propertyCollector': {}}
+        self.leases = {}       # moId -> dict(state, vm, disk, progress)
+        self.cancelled_waits = set()
+        self.nfc_base_url = None
+        self.datastores = list(datastores)
+
+        #Every host has the default management network
+        self.vswitches['vSwitch0'] = vim.host.VirtualSwitch.Specification(
+            numPorts=128, mtu=1500)
+        self.portgroups['VM Network'] = vim.host.PortGroup.Specification(
+            name='VM Network', vswitchName='vSwitch0', vlanId=0,
+            policy=vim.host.NetworkPolicy())
+        self.networks['VM Network'] = 'HaNetwork-VM Network'
+
+    def session_key(self):
+        return 'fake-session-%d' % self.sessions
+
+    def expire_session(self):
+        '''
+        Log the session out from under the client, like an idle timeout:
+        calls fail with NotAuthenticated until it logs in again, and the
+        session's property collectors, filters and views are gone.
+        '''
+        with self.cond:
+            self.session_valid = False
+            for moid in list(self.collectors):
+                if moid != 'propertyCollector':
+                    for fid in self.collectors.pop(moid):
+                        self.filters.pop(fid, None)
+            self.views.clear()
+            self.cond.notify_all()
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def next_id(self, prefix):
+        return '%s-%d' % (prefix, next(self.ids))
+
+    def soap_calls(self):
+        return sum(self.calls.values())
+
+
+class FakeStub(object):
+    '''
+    pyVmomi stub adapter backed by a FakeHost. Managed objects handed out
+    by this stub call back into it for every method and property.
+    '''
+    def __init__(self, host):
+        self.host = host
+        self.version = 'vim.version.version12'
+        #Stub the objects we hand out call back through, per call (thread),
+        #see InvokeMethod()
+        self.local = threading.local()
+
+    @property
+    def cookie(self):
+        return 'vmware_soap_session="%s"; Path=/; HttpOnly; Secure;' % self.host.session_key()
+
+    #pyVmomi entry points
+    def InvokeMethod(self, mo, info, args, outerStub=None):
+        '''
+        Like SoapStubAdapter, when called through an outer stub (e.g. a
+        VimSessionOrientedStub) return (status, result or fault) and hand
+        out objects bound to the outer stub.
+        '''
+        self.local.binding = outerStub or self
+        if outerStub is not None:
+            try:
+                return 200, self.invoke(mo, info, args)
+            except vmodl.MethodFault as e:
+                return 500, e
+        return self.invoke(mo, info, args)
+
+    def invoke(self, mo, info, args):
+        host = self.host
+        if info.wsdlName == 'Fetch':
+            return self.fetch(mo, args[0])
+        host.count(info.wsdlName)
+        if host.latency:
+            time.sleep(host.latency)
+        if not host.session_valid and info.wsdlName not in ('Login', 'RetrieveServiceContent'):
+            raise vim.fault.NotAuthenticated()
+        handler = getattr(self, 'm_' + info.wsdlName, None)
+        if handler is None:
+            raise vmodl.fault.NotImplemented(
+                msg='fake vSphere does not implement %s' % info.wsdlName)
+        return handler(mo, *args)
+
+    def InvokeAccessor(self, mo, info):
+        self.local.binding = self
+        return self.fetch(mo, info.name)
+
+    def fetch(self, mo, name):
+        host = self.host
+        host.count('get:' + name)
+        if host.latency:
+            time.sleep(host.latency)
+        if not host.session_valid and not isinstance(mo, (vim.ServiceInstance,
+                                                          vim.SessionManager)):
+            raise vim.fault.NotAuthenticated()
+        return self.prop(mo, name)
+
+    def DropConnections(self):
+        pass
+
+    #Managed object helpers
+    def mo(self, vimtype, moid):
+        return vimtype(moid, getattr(self.local, 'binding', self))
+
+    def root_objects(self):
+        return {
+            'rootFolder': self.mo(vim.Folder, 'ha-folder-root'),
+            'datacenter': self.mo(vim.Datacenter, 'ha-datacenter'),
+            'vmFolder': self.mo(vim.Folder, 'ha-folder-vm'),
+            'hostSystem': self.mo(vim.HostSystem, 'ha-host'),
+            'resourcePool': self.mo(vim.ResourcePool, 'ha-root-pool'),
+        }
+
+    def inventory(self, vimtype):
+        '''Everything of a given type the fake knows about.'''
+        host = self.host
+        objs = []
+        if issubclass(vim.Folder, vimtype) or vimtype is vim.Folder:
+            objs += [self.mo(vim.Folder, 'ha-folder-root'),
+                     self.mo(vim.Folder, 'ha-folder-vm')]
+        if vimtype in (vim.Datacenter, vim.ManagedEntity):
+            objs.append(self.mo(vim.Datacenter, 'ha-datacenter'))
+        if vimtype in (vim.HostSystem, vim.ManagedEntity):
+            objs.append(self.mo(vim.HostSystem, 'ha-host'))
+        if vimtype in (vim.ResourcePool, vim.ManagedEntity):
+            objs.append(self.mo(vim.ResourcePool, 'ha-root-pool'))
+        if vimtype in (vim.Datastore, vim.ManagedEntity):
+            objs += [self.mo(vim.Datastore, ds) for ds in host.datastores]
+        if vimtype in (vim.Network, vim.ManagedEntity):
+            objs += [self.mo(vim.Network, n) for n in sorted(host.networks.values())]
+        if vimtype in (vim.VirtualMachine, vim.ManagedEntity):
+            objs += [self.mo(vim.VirtualMachine, v) for v in sorted(host.vms)]
+        return objs
+
+    def prop(self, mo, name):
+        '''Resolve a (possibly dotted) property path of a managed object.'''
+        first, _, rest = name.partition('.')
+        handler = getattr(self, 'p_' + type(mo).__name__.split('.')[-1], None)
+        if handler is None:
+            raise vmodl.fault.InvalidProperty(name=name)
+        val = handler(mo, first)
+        for part in rest.split('.') if rest else []:
+            val = getattr(val, part) if val is not None else None
+        return val
+
+    #Properties
+    def p_ServiceInstance(self, mo, name):
+        if name == 'content':
+            return self.m_RetrieveServiceContent(mo)
+        raise vmodl.fault.InvalidProperty(name=name)
+
+    def p_SessionManager(self, mo, name):
+        if name == 'currentSession':
+            if not self.host.session_valid:
+                return None
+            return vim.UserSession(key=self.host.session_key(), userName='root')
+        raise vmodl.fault.InvalidProperty(name=name)
+
+    def p_Folder(self, mo, name):
+        if name == 'name':
+            return {'ha-folder-root': 'ha-folder-root', 'ha-folder-vm': 'vm'}[mo._moId]
+        if name == 'childEntity':
+            if mo._moId == 'ha-folder-root':
+                return [self.mo(vim.Datacenter, 'ha-datacenter')]
+            return self.inventory(vim.VirtualMachine)
+        if name == 'parent':
+            return None
+        raise vmodl.fault.InvalidProperty(name=name)
+
+    def p_Datacenter(self, mo, name):
+        objs = self.root_objects()
+        return {'name': 'ha-datacenter',
+                'vmFolder': objs['vmFolder'],
+                'datastore': self.inventory(vim.Datastore),
+                'network': self.inventory(vim.Network)}[name]
+
+    def p_ResourcePool(self, mo, name):
+        return {'name': 'Resources', 'owner': None}[name]
+
+    def p_ContainerView(self, mo, name):
+        if name == 'view':
+            return self.host.views[mo._moId]
+        raise vmodl.fault.InvalidProperty(name=name)
+
+    def p_ListView(self, mo, name):
+        return self.p_ContainerView(mo, name)
+
+    def p_Datastore(self, mo, name):
+        host = self.host
+        used = sum(f.size for path, f in host.files.items()
+                   if path.startswith('[%s]' % mo._moId))
+        #datastore_gb is one size for all, or datastore -> size
+        capacity = (host.datastore_gb.get(mo._moId, 4096) if isinstance(host.datastore_gb, dict)
+                    else host.datastore_gb) * 1024 ** 3
+        if name == 'name':
+            return mo._moId
+        if name == 'info':
+            return vim.host.VmfsDatastoreInfo(name=mo._moId, url='/vmfs/volumes/' + mo._moId,
+                                             freeSpace=capacity - used)
+        if name == 'summary':
+            return vim.Datastore.Summary(name=mo._moId, datastore=mo, capacity=capacity,
+                                         freeSpace=capacity - used, type='VMFS',
+                                         accessible=True)
+        if name == 'browser':
+            return self.mo(vim.host.DatastoreBrowser, 'datastoreBrowser-' + mo._moId)
+        if name == 'vm':
+            return self.inventory(vim.VirtualMachine)
+        raise vmodl.fault.InvalidProperty(name=name)
+
+    def p_Network(self, mo, name):
+        host = self.host
+        pgname = [n for n, m in host.networks.items() if m == mo._moId]
+        if not pgname:
+            raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+        if name == 'name':
+            return pgname[0]
+        if name == 'vm':
+            return [self.mo(vim.VirtualMachine, v) for v, vm in sorted(host.vms.items())
+                    if any(getattr(d.backing, 'deviceName', None) == pgname[0]
+                           for d in vm['devices'])]
+        if name == 'host':
+            return [self.mo(vim.HostSystem, 'ha-host')]
+        raise vmodl.fault.InvalidProperty(name=name)
+
+    def network_info(self):
+        host = self.host
+        with host.lock:
+            vswitches = [vim.host.VirtualSwitch(name=n, key='key-vim.host.VirtualSwitch-' + n,
+                                                numPorts=s.numPorts, mtu=s.mtu, spec=s)
+                         for n, s in sorted(host.vswitches.items())]
+            portgroups = [vim.host.PortGroup(key='key-vim.host.PortGroup-' + n, spec=s)
+                          for n, s in sorted(host.portgroups.items())]
+        return vim.host.NetworkInfo(vswitch=vswitches, portgroup=portgroups)
+
+    def p_HostSystem(self, mo, name):
+        host = self.host
+        if name == 'name':
+            return host.hostname
+        if name == 'config':
+            return vim.host.ConfigInfo(network=self.network_info())
+        if name == 'configManager':
+            return vim.host.ConfigManager(
+                networkSystem=self.mo(vim.host.NetworkSystem, 'networkSystem'))
+        if name == 'network':
+            return self.inventory(vim.Network)
+        if name == 'datastore':
+            return self.inventory(vim.Datastore)
+        if name == 'vm':
+            return self.inventory(vim.VirtualMachine)
+        if name == 'parent':
+            return None
+        if name == 'summary':
+            with host.lock:
+                used_mb = sum(vm['memoryMB'] for vm in host.vms.values()
+                              if vm['power'] == 'poweredOn')
+            return vim.host.Summary(
+                host=mo,
+                hardware=vim.host.Summary.HardwareSummary(
+                    memorySize=host.memory_mb * 1024 * 1024, cpuMhz=host.cpu_mhz,
+                    numCpuCores=host.cpu_cores, numCpuThreads=host.cpu_cores * 2),
+                quickStats=vim.host.Summary.QuickStats(
+                    overallMemoryUsage=used_mb, overallCpuUsage=0),
+                config=vim.host.Summary.ConfigSummary(name=host.hostname))
+        if name == 'hardware':
+            return vim.host.HardwareInfo(memorySize=host.memory_mb * 1024 * 1024)
+        raise vmodl.fault.InvalidProperty(name=name)
+
+    def p_NetworkSystem(self, mo, name):
+        if name == 'networkInfo':
+            return self.network_info()
+        raise vmodl.fault.InvalidProperty(name=name)
+
+    def p_VirtualMachine(self, mo, name):
+        host = self.host
+        with host.lock:
+            vm = host.vms.get(mo._moId)
+        if vm is None:
+            raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+        if name == 'name':
+            return vm['name']
+        if name == 'config':
+            spec = vm['config']
+            return vim.vm.ConfigInfo(
+                name=vm['name'], guestId=vm['guestId'], version=vm['version'],
+                annotation=vm['annotation'],
+                cpuAllocation=spec.cpuAllocation or vim.ResourceAllocationInfo(reservation=0),
+                memoryAllocation=spec.memoryAllocation or
+                vim.ResourceAllocationInfo(reservation=0),
+                memoryReservationLockedToMax=bool(spec.memoryReservationLockedToMax),
+                latencySensitivity=spec.latencySensitivity or
+                vim.LatencySensitivity(level='normal'),
+                hardware=vim.vm.VirtualHardware(numCPU=vm['numCPUs'],
+                                                memoryMB=vm['memoryMB'],
+                                                device=list(vm['devices'])),
+                files=vim.vm.FileInfo(vmPathName=vm['vmPathName']))
+        if name == 'runtime':
+            return vim.vm.RuntimeInfo(powerState=vm['power'],
+                                      host=self.mo(vim.HostSystem, 'ha-host'))
+        if name == 'guestHeartbeatStatus':
+            return 'green' if vm['power'] == 'poweredOn' else 'gray'
+        if name == 'guest':
+            return vim.vm.GuestInfo(toolsRunningStatus='guestToolsRunning'
+                                    if vm['power'] == 'poweredOn' else 'guestToolsNotRunning')
+        if name == 'summary':
+            return vim.vm.Summary(config=vim.vm.Summary.ConfigSummary(
+                name=vm['name'], memorySizeMB=vm['memoryMB'], numCpu=vm['numCPUs']))
+        if name == 'network':
+            return [self.mo(vim.Network, self.host.networks[d.backing.deviceName])
+                    for d in vm['devices']
+                    if getattr(d.backing, 'deviceName', None) in self.host.networks]
+        if name == 'datastore':
+            return self.inventory(vim.Datastore)[:1]
+        raise vmodl.fault.InvalidProperty(name=name)
+
+    def p_HttpNfcLease(self, mo, name):
+        with self.host.lock:
+            lease = self.host.leases[mo._moId]
+        if name == 'state':
+            return lease['state']
+        if name == 'error':
+            return lease.get('error')
+        if name == 'initializeProgress':
+            return 100
+        if name == 'info':
+            return vim.HttpNfcLease.Info(
+                lease=mo, entity=self.mo(vim.VirtualMachine, lease['vm']),
+                leaseTimeout=300,
+                deviceUrl=[vim.HttpNfcLease.DeviceUrl(
+                    key='/%s/VirtualIDEController0:0' % lease['vm'],
+                    importKey='/%s/VirtualIDEController0:0' % lease['vm'],
+                    url='%s/nfc/%s/disk-0.vmdk' % (self.host.nfc_base_url, mo._moId),
+                    targetId='disk-0.vmdk', disk=True)])
+        raise vmodl.fault.InvalidProperty(name=name)
+
+    def p_Task(self, mo, name):
+        host = self.host
+        with host.lock:
+            t = host.task_info[mo._moId]
+            state = 'success' if time.time() >= t['done_at'] else 'running'
+            if state == 'success' and t['error'] is not None:
+                state = 'error'
+        info = vim.TaskInfo(key=mo._moId, task=mo, state=state,
+                            descriptionId=t['name'], cancelable=False, cancelled=False,
+                            queueTime=datetime.datetime.utcfromtimestamp(t['queued']),
+                            startTime=datetime.datetime.utcfromtimestamp(t['queued']))
+        if state != 'running':
+            info.completeTime = datetime.datetime.utcfromtimestamp(t['done_at'])
+        if state == 'success':
+            info.result = typed(t['result'])
+        if state == 'error':
+            info.error = t['error']
+        if name == 'info':
+            return info
+        raise vmodl.fault.InvalidProperty(name=name)
+
+    #Methods: service instance and views
+    def m_RetrieveServiceContent(self, mo):
+        objs = self.root_objects()
+        return vim.ServiceInstanceContent(
+            rootFolder=objs['rootFolder'],
+            propertyCollector=self.mo(vmodl.query.PropertyCollector, 'propertyCollector'),
+            viewManager=self.mo(vim.view.ViewManager, 'ViewManager'),
+            fileManager=self.mo(vim.FileManager, 'ha-nfc-file-manager'),
+            virtualDiskManager=self.mo(vim.VirtualDiskManager, 'ha-vdiskmanager'),
+            ovfManager=self.mo(vim.OvfManager, 'ha-ovf-manager'),
+            sessionManager=self.mo(vim.SessionManager, 'ha-sessionmgr'),
+            about=vim.AboutInfo(name='Fake ESXi', apiVersion='6.5', apiType='HostAgent'))
+
+    def m_Login(self, mo, userName, password, locale=None):
+        with self.host.lock:
+            if not self.host.session_valid:
+                self.host.sessions += 1
+            self.host.session_valid = True
+        return vim.UserSession(key=self.host.session_key(), userName=userName)
+
+    def m_CurrentTime(self, mo):
+        return datetime.datetime.now()
+
+    def m_Logout(self, mo):
+        pass
+
+    def m_CreateContainerView(self, mo, container, type, recursive):
+        host = self.host
+        objs = []
+        for t in type or [vim.ManagedEntity]:
+            objs += self.inventory(t)
+        if isinstance(container, vim.Datacenter) and type:
+            objs = [o for o in objs if not isinstance(o, vim.Datacenter)]
+        moid = host.next_id('session[fake]view')
+        with host.lock:
+            host.views[moid] = objs
+        return self.mo(vim.view.ContainerView, moid)
+
+    def m_CreateListView(self, mo, obj=None):
+        host = self.host
+        moid = host.next_id('session[fake]listview')
+        with host.lock:
+            host.views[moid] = list(obj or [])
+        return self.mo(vim.view.ListView, moid)
+
+    def m_ModifyListView(self, mo, add=None, remove=None):
+        host = self.host
+        with host.cond:
+            view = host.views.get(mo._moId)
+            if view is None:
+                raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+            for o in add or []:
+                if o not in view:
+                    view.append(o)
+            for o in remove or []:
+                if o in view:
+                    view.remove(o)
+            host.cond.notify_all()
+        return []
+
+    def m_DestroyView(self, mo):
+        with self.host.lock:
+            self.host.views.pop(mo._moId, None)
+
+    #Methods: property collector
+    def m_CreatePropertyCollector(self, mo):
+        host = self.host
+        moid = host.next_id('session[fake]pc')
+        with host.lock:
+            host.collectors[moid] = {}
+        return self.mo(vmodl.query.PropertyCollector, moid)
+
+    def m_DestroyPropertyCollector(self, mo):
+        with self.host.lock:
+            self.host.collectors.pop(mo._moId, None)
+
+    def m_CreateFilter(self, mo, spec, partialUpdates):
+        host = self.host
+        moid = host.next_id('session[fake]filter')
+        with host.cond:
+            if mo._moId not in host.collectors:
+                raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+            host.filters[moid] = {'collector': mo._moId, 'spec': spec, 'seen': {}}
+            host.collectors.setdefault(mo._moId, {})[moid] = True
+            host.cond.notify_all()
+        return self.mo(vmodl.query.PropertyCollector.Filter, moid)
+
+    def m_DestroyPropertyFilter(self, mo):
+        host = self.host
+        with host.cond:
+            f = host.filters.pop(mo._moId, None)
+            if f:
+                host.collectors.get(f['collector'], {}).pop(mo._moId, None)
+            host.cond.notify_all()
+
+    def filter_tasks(self, spec):
+        '''The task objects a filter currently watches.'''
+        tasks = []
+        for obj_spec in spec.objectSet:
+            if isinstance(obj_spec.obj, vim.Task):
+                tasks.append(obj_spec.obj)
+            elif isinstance(obj_spec.obj, vim.view.View):
+                tasks += [t for t in self.host.views.get(obj_spec.obj._moId, [])
+                          if isinstance(t, vim.Task)]
+        return tasks
+
+    def pending_updates(self, collector):
+        '''Task state changes not yet reported by the filters of a collector.'''
+        host = self.host
+        updates = []
+        now = time.time()
+        for fid in list(host.collectors.get(collector, {})):
+            f = host.filters[fid]
+            objects = []
+            for task in self.filter_tasks(f['spec']):
+                t = host.task_info.get(task._moId)
+                if t is None:
+                    continue
+                state = 'success' if now >= t['done_at'] else 'running'
+                if f['seen'].get(task._moId) == state:
+                    continue
+                f['seen'][task._moId] = state
+                info = self.p_Task(task, 'info')
+                objects.append(vmodl.query.PropertyCollector.ObjectUpdate(
+                    kind='modify', obj=task,
+                    changeSet=[vmodl.query.PropertyCollector.Change(
+                        name='info', op='assign', val=info)]))
+            if objects:
+                updates.append(vmodl.query.PropertyCollector.FilterUpdate(
+                    filter=self.mo(vmodl.query.PropertyCollector.Filter, fid),
+                    objectSet=objects))
+        return updates
+
+    def next_deadline(self, collector):
+        host = self.host
+        now = time.time()
+        deadlines = []
+        for fid in host.collectors.get(collector, {}):
+            for task in self.filter_tasks(host.filters[fid]['spec']):
+                t = host.task_info.get(task._moId)
+                if t and t['done_at'] > now:
+                    deadlines.append(t['done_at'])
+        return min(deadlines) if deadlines else None
+
+    def m_WaitForUpdatesEx(self, mo, version=None, options=None):
+        host = self.host
+        max_wait = options.maxWaitSeconds if options is not None else None
+        start = time.time()
+        with host.cond:
+            while True:
+                if mo._moId not in host.collectors:
+                    raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+                if mo._moId in host.cancelled_waits:
+                    host.cancelled_waits.discard(mo._moId)
+                    raise vmodl.fault.RequestCanceled()
+                updates = self.pending_updates(mo._moId)
+                if updates:
+                    version = str(int(version or 0) + 1)
+                    return vmodl.query.PropertyCollector.UpdateSet(version=version,
+                                                                  filterSet=updates)
+                deadline = self.next_deadline(mo._moId)
+                remaining = None
+                if max_wait is not None:
+                    remaining = start + max_wait - time.time()
+                    if remaining <= 0:
+                        return None
+                if deadline is not None:
+                    wait = max(0.0, deadline - time.time())
+                    remaining = wait if remaining is None else min(remaining, wait)
+                host.cond.wait(remaining if remaining is not None else 1.0)
+
+    def m_CancelWaitForUpdates(self, mo):
+        with self.host.cond:
+            self.host.cancelled_waits.add(mo._moId)
+            self.host.cond.notify_all()
+
+    def m_WaitForUpdates(self, mo, version=None):
+        return self.m_WaitForUpdatesEx(mo, version)
+
+    def select_objects(self, obj_spec):
+        '''Expand an ObjectSpec the way the script uses them.'''
+        objs = []
+        if not obj_spec.skip:
+            objs.append(obj_spec.obj)
+        return objs + self.traverse(obj_spec.obj, obj_spec.selectSet)
+
+    def traverse(self, obj, selects):
+        '''Follow TraversalSpecs from obj, including nested ones.'''
+        objs = []
+        for select in selects or []:
+            if not isinstance(select, vmodl.query.PropertyCollector.TraversalSpec):
+                continue
+            if not isinstance(obj, select.type):
+                continue
+            if select.path == 'view':
+                found = list(self.host.views.get(obj._moId, []))
+            else:
+                val = self.prop(obj, select.path)
+                found = list(val) if isinstance(val, list) else [val]
+            for child in found:
+                objs.append(child)
+                objs += self.traverse(child, select.selectSet)
+        return objs
+
+    def m_RetrieveContents(self, mo, specSet):
+        result = []
+        for spec in specSet:
+            objs = []
+            for obj_spec in spec.objectSet:
+                objs += self.select_objects(obj_spec)
+            for obj in objs:
+                props = []
+                for prop_spec in spec.propSet:
+                    if not isinstance(obj, prop_spec.type):
+                        continue
+                    for path in prop_spec.pathSet or []:
+                        try:
+                            val = self.prop(obj, path)
+                        except (vmodl.fault.InvalidProperty,
+                                vmodl.fault.ManagedObjectNotFound, KeyError):
+                            continue
+                        props.append(vmodl.DynamicProperty(name=path, val=typed(val)))
+                if any(isinstance(obj, p.type) for p in spec.propSet):
+                    result.append(vmodl.query.PropertyCollector.ObjectContent(
+                        obj=obj, propSet=props))
+        return result
+
+    m_RetrieveProperties = m_RetrieveContents
+
+    def m_RetrievePropertiesEx(self, mo, specSet, options=None):
+        return vmodl.query.PropertyCollector.RetrieveResult(
+            objects=self.m_RetrieveContents(mo, specSet))
+
+    #Methods: tasks
+    def task(self, name, result=None, error=None, duration=None):
+        host = self.host
+        moid = host.next_id('haTask-%s' % name)
+        now = time.time()
+        with host.cond:
+            host.tasks += 1
+            host.task_info[moid] = {
+                'name': name, 'result': result, 'error': error, 'queued': now,
+                'done_at': now + (host.task_duration if duration is None else duration)}
+            host.cond.notify_all()
+        return self.mo(vim.Task, moid)
+
+    def m_CancelTask(self, mo):
+        host = self.host
+        with host.cond:
+            t = host.task_info[mo._moId]
+            if time.time() >= t['done_at']:
+                raise vim.fault.InvalidState()
+            t['error'] = vmodl.fault.RequestCanceled()
+            t['done_at'] = time.time()
+            host.cond.notify_all()
+
+    #Methods: files
+    def m_MakeDirectory(self, mo, name, datacenter=None, createParentDirectories=False):
+        with self.host.lock:
+            if name.rstrip('/') + '/' in self.host.files:
+                raise vim.fault.FileAlreadyExists(file=name)
+            self.host.files[name.rstrip('/') + '/'] = FakeFile()
+
+    def m_CopyDatastoreFile_Task(self, mo, sourceName, sourceDatacenter=None,
+                                 destinationName=None, destinationDatacenter=None,
+                                 force=False):
+        host = self.host
+        with host.lock:
+            src = host.files.get(sourceName)
+            if src is None:
+                return self.task('CopyDatastoreFile',
+                                 error=vim.fault.FileNotFound(file=sourceName))
+            host.files[destinationName] = FakeFile(src.size, src.sha1, src.data)
+        return self.task('CopyDatastoreFile')
+
+    def m_CopyVirtualDisk_Task(self, mo, sourceName, sourceDatacenter=None,
+                               destName=None, destDatacenter=None, destSpec=None,
+                               force=False):
+        return self.m_CopyDatastoreFile_Task(mo, sourceName, None, destName, None, force)
+
+    def m_DeleteVirtualDisk_Task(self, mo, name, datacenter=None):
+        with self.host.lock:
+            if self.host.files.pop(name, None) is None:
+                return self.task('DeleteVirtualDisk', error=vim.fault.FileNotFound(file=name))
+        return self.task('DeleteVirtualDisk')
+
+    def m_DeleteDatastoreFile_Task(self, mo, name, datacenter=None):
+        host = self.host
+        with host.lock:
+            prefix = name.rstrip('/')
+            for path in list(host.files):
+                if path == prefix or path.startswith(prefix + '/'):
+                    del host.files[path]
+        return self.task('DeleteDatastoreFile')
+
+    def m_SearchDatastoreSubFolders_Task(self, mo, datastorePath, searchSpec=None):
+        host = self.host
+        folders = {}
+        with host.lock:
+            for path, f in host.files.items():
+                if not path.startswith(datastorePath.rstrip('/')) or path.endswith('/'):
+                    continue
+                folder, _, fname = path.rpartition('/')
+                folders.setdefault(folder, []).append(
+                    vim.host.DatastoreBrowser.FileInfo(path=fname, fileSize=f.size))
+        result = [vim.host.DatastoreBrowser.SearchResults(folderPath=folder + '/', file=files)
+                  for folder, files in sorted(folders.items())]
+        return self.task('SearchDatastoreSubFolders', result=result)
+
+    #Methods: host networking
+    def m_AddVirtualSwitch(self, mo, vswitchName, spec=None):
+        host = self.host
+        with host.lock:
+            if vswitchName in host.vswitches:
+                raise vim.fault.AlreadyExists(name=vswitchName)
+            host.vswitches[vswitchName] = spec or vim.host.VirtualSwitch.Specification(numPorts=128)
+
+    def m_AddPortGroup(self, mo, portgrp):
+        host = self.host
+        with host.lock:
+            if portgrp.name in host.portgroups:
+                raise vim.fault.AlreadyExists(name=portgrp.name)
+            if portgrp.vswitchName not in host.vswitches:
+                raise vim.fault.NotFound(msg='vSwitch %s not found' % portgrp.vswitchName)
+            host.portgroups[portgrp.name] = portgrp
+            host.networks[portgrp.name] = 'HaNetwork-' + portgrp.name
+
+    def m_RemovePortGroup(self, mo, pgName):
+        host = self.host
+        with host.lock:
+            if pgName not in host.portgroups:
+                raise vim.fault.NotFound(msg=pgName)
+            del host.portgroups[pgName]
+            host.networks.pop(pgName, None)
+
+    def m_RemoveVirtualSwitch(self, mo, vswitchName):
+        host = self.host
+        with host.lock:
+            if vswitchName not in host.vswitches:
+                raise vim.fault.NotFound(msg=vswitchName)
+            del host.vswitches[vswitchName]
+            for pg in [n for n, s in host.portgroups.items() if s.vswitchName == vswitchName]:
+                del host.portgroups[pg]
+                host.networks.pop(pg, None)
+
+    def m_UpdatePortGroup(self, mo, pgName, portgrp):
+        host = self.host
+        with host.lock:
+            if pgName not in host.portgroups:
+                raise vim.fault.NotFound(msg=pgName)
+            del host.portgroups[pgName]
+            host.networks.pop(pgName, None)
+            host.portgroups[portgrp.name] = portgrp
+            host.networks[portgrp.name] = 'HaNetwork-' + portgrp.name
+
+    def m_UpdateNetworkConfig(self, mo, config, changeMode):
+        #Validate everything first so a bad batch changes nothing
+        host = self.host
+        with host.lock:
+            vswitches = set(host.vswitches)
+            portgroups = set(host.portgroups)
+            for vs in config.vswitch or []:
+                if vs.changeOperation == 'add' and vs.name in vswitches:
+                    raise vim.fault.AlreadyExists(name=vs.name)
+                if vs.changeOperation == 'remove' and vs.name not in vswitches:
+                    raise vim.fault.NotFound(msg=vs.name)
+                if vs.changeOperation == 'add':
+                    vswitches.add(vs.name)
+            for pg in config.portgroup or []:
+                if pg.changeOperation == 'add' and (pg.spec.name in portgroups or
+                                                    pg.spec.vswitchName not in vswitches):
+                    raise vim.fault.AlreadyExists(name=pg.spec.name)
+                if pg.changeOperation == 'remove' and pg.spec.name not in portgroups:
+                    raise vim.fault.NotFound(msg=pg.spec.name)
+            for vs in config.vswitch or []:
+                if vs.changeOperation == 'add':
+                    host.vswitches[vs.name] = vs.spec
+            for pg in config.portgroup or []:
+                if pg.changeOperation == 'add':
+                    host.portgroups[pg.spec.name] = pg.spec
+                    host.networks[pg.spec.name] = 'HaNetwork-' + pg.spec.name
+                elif pg.changeOperation == 'edit':
+                    host.portgroups[pg.spec.name] = pg.spec
+                elif pg.changeOperation == 'remove':
+                    host.portgroups.pop(pg.spec.name, None)
+                    host.networks.pop(pg.spec.name, None)
+            for vs in config.vswitch or []:
+                if vs.changeOperation == 'remove':
+                    host.vswitches.pop(vs.name, None)
+        return vim.host.NetworkConfig.Result()
+
+    #Methods: virtual machines
+    def apply_devices(self, vm, device_changes):
+        for change in device_changes or []:
+            device = change.device
+            if change.operation == 'add':
+                if not device.key or device.key < 0:
+                    vm['next_key'] += 1
+                    device.key = vm['next_key']
+                if isinstance(device, vim.vm.device.VirtualDisk) and \
+                        change.fileOperation == 'create':
+                    backing = device.backing
+                    if not backing.fileName or backing.fileName.endswith(' '):
+                        backing.fileName = '%s%s/%s.vmdk' % (
+                            vm['vmPathName'].split(']')[0] + '] ', vm['name'], vm['name'])
+                    self.host.files[backing.fileName] = FakeFile(size=1024 * 1024)
+                vm['devices'].append(device)
+            elif change.operation == 'remove':
+                vm['devices'] = [d for d in vm['devices'] if d.key != device.key]
+            elif change.operation == 'edit':
+                vm['devices'] = [device if d.key == device.key else d
+                                 for d in vm['devices']]
+
+    def m_CreateVM_Task(self, mo, config, pool, host=None):
+        fake = self.host
+        with fake.lock:
+            if any(vm['name'] == config.name for vm in fake.vms.values()):
+                return self.task('CreateVM', error=vim.fault.DuplicateName(
+                    name=config.name, object=mo))
+            moid = str(next(fake.ids))
+            vm = {'name': config.name, 'devices': [], 'power': 'poweredOff',
+                  'memoryMB': config.memoryMB or 0, 'numCPUs': config.numCPUs or 1,
+                  'guestId': config.guestId, 'version': config.version,
+                  'annotation': config.annotation,
+                  'vmPathName': '%s%s/%s.vmx' % (config.files.vmPathName.split(']')[0] + '] ',
+                                                 config.name, config.name),
+                  'next_key': 4000, 'config': config}
+            self.apply_devices(vm, config.deviceChange)
+            fake.vms[moid] = vm
+        return self.task('CreateVM', result=self.mo(vim.VirtualMachine, moid))
+
+    def m_ReconfigVM_Task(self, mo, spec):
+        host = self.host
+        with host.lock:
+            vm = host.vms[mo._moId]
+            self.apply_devices(vm, spec.deviceChange)
+            if spec.memoryMB:
+                vm['memoryMB'] = spec.memoryMB
+            if spec.numCPUs:
+                vm['numCPUs'] = spec.numCPUs
+            if spec.annotation is not None:
+                vm['annotation'] = spec.annotation
+        return self.task('ReconfigVM')
+
+    def m_PowerOnVM_Task(self, mo, host=None):
+        with self.host.lock:
+            self.host.vms[mo._moId]['power'] = 'poweredOn'
+        return self.task('PowerOnVM')
+
+    def m_PowerOffVM_Task(self, mo):
+        with self.host.lock:
+            self.host.vms[mo._moId]['power'] = 'poweredOff'
+        return self.task('PowerOffVM')
+
+    def m_Destroy_Task(self, mo):
+        host = self.host
+        with host.lock:
+            vm = host.vms.pop(mo._moId, None)
+            if vm:
+                for d in vm['devices']:
+                    if isinstance(d, vim.vm.device.VirtualDisk):
+                        host.files.pop(d.backing.fileName, None)
+        return self.task('Destroy')
+
+    def m_ImportVApp(self, mo, spec, folder=None, host=None):
+        fake = self.host
+        task = self.m_CreateVM_Task(mo, spec.configSpec, mo)
+        with fake.lock:
+            t = fake.task_info[task._moId]
+            fake.tasks -= 1
+            if t['error'] is not None:
+                raise t['error']
+            vm = fake.vms[t['result']._moId]
+            disk = [d for d in vm['devices'] if isinstance(d, vim.vm.device.VirtualDisk)][0]
+            moid = fake.next_id('nfc-lease')
+            fake.leases[moid] = {'state': 'ready', 'vm': t['result']._moId,
+                                 'disk': disk.backing.fileName, 'progress': 0}
+        return self.mo(vim.HttpNfcLease, moid)
+
+    def m_HttpNfcLeaseProgress(self, mo, percent):
+        with self.host.lock:
+            self.host.leases[mo._moId]['progress'] = percent
+
+    def m_HttpNfcLeaseComplete(self, mo):
+        with self.host.lock:
+            self.host.leases[mo._moId]['state'] = 'done'
+
+    def m_HttpNfcLeaseAbort(self, mo, fault=None):
+        host = self.host
+        with host.lock:
+            lease = host.leases[mo._moId]
+            lease['state'] = 'error'
+            host.vms.pop(lease['vm'], None)
+            host.files.pop(lease['disk'], None)
+
+    def m_UnregisterVM(self, mo):
+        with self.host.lock:
+            self.host.vms.pop(mo._moId, None)
+
+
+def fake_service_instance(**kwargs):
+    '''Build a FakeHost and a ServiceInstance wired to it.'''
+    host = FakeHost(**kwargs)
+    stub = FakeStub(host)
+    return vim.ServiceInstance('ServiceInstance', stub), host
+
+
+def decode_stream_optimized(read):
+    '''
+    Walk a streamOptimized vmdk, pulling it through read(size), and
+    return the size and sha1 of the virtual disk it holds. Checks the
+    header, the grain order and that a footer and end marker are present.
+    '''
+    header = read(512)
+    magic, version, flags, capacity, grain_sectors, desc_offset, desc_size = \
+        struct.unpack('<IIIQQQQ', header[:44])
+    if magic != 0x564d444b or not flags & 0x10000:
+        raise ValueError('not a streamOptimized vmdk')
+    read((desc_offset + desc_size - 1) * 512)
+    sha1 = hashlib.sha1()
+    written = 0
+    footer = False
+    while True:
+        sector = read(512)
+        lba, size = struct.unpack('<QI', sector[:12])
+        if size:
+            data = sector[12:] + read(-(-(size - 500) // 512) * 512) if size > 500 else sector[12:]
+            grain = zlib.decompress(data[:size])
+            if lba * 512 < written:
+                raise ValueError('grains out of order')
+            while written < lba * 512:
+                zeros = min(lba * 512 - written, 1024 * 1024)
+                sha1.update(b'\0' * zeros)
+                written += zeros
+            sha1.update(grain)
+            written += len(grain)
+            continue
+        marker = struct.unpack('<I', sector[12:16])[0]
+        if marker == 0:
+            break
+        if marker == 3:
+            footer = True
+        read(lba * 512)
+    if not footer:
+        raise ValueError('no footer')
+    while written < capacity * 512:
+        zeros = min(capacity * 512 - written, 1024 * 1024)
+        sha1.update(b'\0' * zeros)
+        written += zeros
+    return written, sha1.hexdigest()
+
+
+class DatastoreHandler(BaseHTTPRequestHandler):
+    '''
+    The datastore /folder endpoint: PUT, GET, HEAD and DELETE of
+    /folder/<path>?dsName=<datastore> against the FakeHost's files.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def ds_path(self):
+        url = urlparse(self.path)
+        if not url.path.startswith('/folder/'):
+            return None
+        params = parse_qs(url.query)
+        return '[%s] %s' % (params.get('dsName', ['datastore1'])[0],
+                            unquote(url.path[len('/folder/'):]))
+
+    def authorized(self):
+        '''
+        The datastore service takes the SOAP session's cookie.
+        '''
+        host = self.server.fake_host
+        if host.session_valid and host.session_key() in self.headers.get('Cookie', ''):
+            return True
+        self.reply(401)
+        return False
+
+    def reply(self, code, body=b'', length=None):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body) if length is None else length))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_PUT(self):
+        host = self.server.fake_host
+        if host.http_latency:
+            time.sleep(host.http_latency)
+        path = self.ds_path()
+        length = int(self.headers.get('Content-Length', 0))
+        if not self.authorized():
+            self.rfile.read(length)
+            return
+        sha1 = hashlib.sha1()
+        keep = []
+        remaining = length
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            sha1.update(chunk)
+            if length <= FakeFile.KEEP:
+                keep.append(chunk)
+            remaining -= len(chunk)
+            with host.lock:
+                host.bytes_uploaded += len(chunk)
+            if host.http_bandwidth:
+                time.sleep(len(chunk) / float(host.http_bandwidth))
+        with host.lock:
+            host.http_requests += 1
+            host.files[path] = FakeFile(length - remaining, sha1.hexdigest(),
+                                        b''.join(keep) if keep else None)
+        self.reply(201)
+
+    def do_POST(self):
+        '''
+        NFC lease disk upload: decode the streamOptimized vmdk and store
+        the disk it describes, so the checksum is that of the virtual disk.
+        '''
+        host = self.server.fake_host
+        parts = urlparse(self.path).path.split('/')
+        with host.lock:
+            lease = host.leases.get(parts[2]) if len(parts) > 3 and parts[1] == 'nfc' else None
+        if lease is None or lease['state'] != 'ready':
+            self.reply(404)
+            return
+        remaining = [int(self.headers.get('Content-Length', 0))]
+
+        def read(size):
+            data = self.rfile.read(min(size, remaining[0]))
+            remaining[0] -= len(data)
+            with host.lock:
+                host.bytes_uploaded += len(data)
+            if len(data) != size:
+                raise ValueError('short stream')
+            return data
+
+        try:
+            size = decode_stream_optimized(read)
+        except (ValueError, struct.error, zlib.error) as e:
+            self.rfile.read(remaining[0])
+            self.reply(400, str(e).encode('ascii'))
+            return
+        with host.lock:
+            host.http_requests += 1
+            host.files[lease['disk']] = FakeFile(*size)
+        self.reply(200)
+
+    def do_HEAD(self):
+        host = self.server.fake_host
+        if not self.authorized():
+            return
+        with host.lock:
+            host.http_requests += 1
+            f = host.files.get(self.ds_path())
+        if f is None:
+            self.reply(404)
+        else:
+            self.reply(200, length=f.size)
+
+    def do_GET(self):
+        host = self.server.fake_host
+        if not self.authorized():
+            return
+        with host.lock:
+            host.http_requests += 1
+            f = host.files.get(self.ds_path())
+        if f is None or f.data is None:
+            self.reply(404)
+        else:
+            self.reply(200, f.data)
+
+    def do_DELETE(self):
+        host = self.server.fake_host
+        if not self.authorized():
+            return
+        with host.lock:
+            host.http_requests += 1
+            found = host.files.pop(self.ds_path(), None)
+        self.reply(204 if found else 404)
+
+
+class FakeDatastoreServer(object):
+    '''
+    Local http stand-in for the host's datastore file service, running on a
+    background thread. base_url is what the Uploader should talk to.
+    '''
+    def __init__(self, fake_host):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), DatastoreHandler)
+        self.server.daemon_threads = True
+        self.server.fake_host = fake_host
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:%d/folder/' % self.server.server_address[1]
+        #NFC urls come with * for the host, like the real ones
+        fake_host.nfc_base_url = 'http://*:%d' % self.server.server_address[1]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -52,24 +52,62 @@ from pyVim import connect
 from pyVmomi import vim
 from pyVmomi import vmodl
 import argparse
+import copy
 import yaml
 import re
-
-
+import os
+import json
+import math
+import struct
+import zlib
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import FIRST_EXCEPTION, wait as futures_wait
+from functools import wraps
+
+
+
+def datastore_list(value):
+    '''
+    Parse --datastore: one name, or a comma separated list of names each
+    optionally followed by :weight. Returns an OrderedDict of name ->
+    weight, None where no weight was given.
+    '''
+    datastores = OrderedDict()
+    for item in value.split(','):
+        name, sep, weight = item.strip().rpartition(':')
+        if not sep:
+            name, weight = weight, None
+        else:
+            try:
+                weight = float(weight)
+            except ValueError:
+                weight = -1
+            if weight <= 0:
+                raise argparse.ArgumentTypeError("bad weight in %r" % item)
+        if not name or name in datastores:
+            raise argparse.ArgumentTypeError("bad datastore list %r" % value)
+        datastores[name] = weight
+    return datastores
 
 def build_arg_parser():
     parser = argparse.ArgumentParser(
         description='Standard Arguments for talking to vCenter for vEOS')
     parser.add_argument('-d', '--datastore',
-                        required=True,
+                        type=datastore_list,
                         action='store',
-                        help='Datastore name')
+                        help='Datastore name, or a comma separated list to spread '
+                             'the VMs over (e.g. ds1,ds2 or ds1:2,ds2:1). Without '
+                             'weights VMs go by free space. The first one gets '
+                             'the seed upload')
     parser.add_argument('-s', '--host',
-                        required=True,
-                        action='store',
-                        help='esxi host to connect to')
+                        action='append',
+                        help='esxi host to connect to. Give it more than once '
+                             'to spread the lab over several hosts')
     parser.add_argument('-u', '--user',
-                        required=True,
                         action='store',
                         help='User name to use when connecting to host')
     parser.add_argument('-o', '--port',
@@ -82,17 +120,139 @@ def build_arg_parser():
                         action='store_true',
                         help='Disable ssl host certificate verification')
     parser.add_argument('-l', '--local_file',
-                        required=True,
                         action='store',
                         help='Local vEOS vmdk disk path to file to upload')
     parser.add_argument('-y', '--yaml_file',
-                        required=True,
                         action='store',
                         help='Yaml file to parse')
     parser.add_argument('-p', '--password',
                         required=False,
                         action='store',
                         help='Password to use when connecting to host')
+    parser.add_argument('--seed',
+                        required=False,
+                        action='store_true',
+                        help='Upload the vmdk once to a seed folder and copy it '
+                             'on the datastore for each VM')
+    parser.add_argument('--linked',
+                        required=False,
+                        action='store_true',
+                        help='Give each VM a delta disk off one golden base '
+                             'disk instead of a full copy (implies --seed)')
+    parser.add_argument('--parallel',
+                        type=int,
+                        default=4,
+                        action='store',
+                        help='Number of VMs to build at the same time')
+    parser.add_argument('--max_uploads',
+                        type=int,
+                        default=2,
+                        action='store',
+                        help='Number of vmdk uploads to run at the same time')
+    parser.add_argument('--stepwise',
+                        required=False,
+                        action='store_true',
+                        help='Create each VM as an empty shell and reconfigure in '
+                             'the disk and NICs separately (for debugging)')
+    parser.add_argument('--plan',
+                        required=False,
+                        action='store_true',
+                        help='Show what it would take to make the host match '
+                             'the yaml file, without changing anything')
+    parser.add_argument('--apply',
+                        required=False,
+                        action='store_true',
+                        help='Make the host match the yaml file, only creating '
+                             'or changing what differs')
+    parser.add_argument('--seed_folder',
+                        default='vEOS-seed',
+                        action='store',
+                        help='Datastore folder used for the seed vmdk')
+    parser.add_argument('--sparse',
+                        required=False,
+                        action='store_true',
+                        help='Send the seed as a compressed streamOptimized vmdk '
+                             'through an import lease, skipping zero blocks '
+                             '(implies --seed)')
+    parser.add_argument('--fabric',
+                        required=False,
+                        action='store_true',
+                        help='Put links on a few shared trunk vSwitches as '
+                             'VLAN port groups instead of a vSwitch per link')
+    parser.add_argument('--uplink_vswitch',
+                        default='vEOS-uplink',
+                        action='store',
+                        help='vSwitch carrying links between hosts as VLANs '
+                             'when the lab spans several hosts')
+    parser.add_argument('--uplink_nic',
+                        required=False,
+                        action='store',
+                        help='Physical NIC (e.g. vmnic1) to create the uplink '
+                             'vSwitch on if a host does not have it')
+    parser.add_argument('--destroy',
+                        action='store_true',
+                        help='Remove the VMs in the yaml file, their datastore '
+                             'folders and the vSwitches and port groups no '
+                             'other VM uses. With --plan, only show what would go')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Finish a build that was cut short, skipping the '
+                             'steps its journal in ~/.eosgenlab/journal says '
+                             'are done')
+    parser.add_argument('--overcommit',
+                        action='store_true',
+                        help='Build even if the lab needs more memory, vCPUs or '
+                             'disk than the host has free, with a warning')
+    parser.add_argument('--power_on',
+                        action='store_true',
+                        help='Power the VMs on in waves once they are built')
+    parser.add_argument('--wave_size',
+                        type=int,
+                        default=4,
+                        action='store',
+                        help='Number of VMs to power on at the same time')
+    parser.add_argument('--boot_timeout',
+                        type=int,
+                        default=300,
+                        action='store',
+                        help='Seconds to wait for a wave to boot (guest '
+                             'heartbeat or tools running) before the next')
+    parser.add_argument('--task_timeout',
+                        type=int,
+                        required=False,
+                        action='store',
+                        help='Cancel and fail any vSphere task that runs longer '
+                             'than this many seconds')
+    parser.add_argument('--lab',
+                        required=False,
+                        action='store',
+                        help='Name the VMs are tagged with, in their annotation, '
+                             'as belonging to this lab. Defaults to the yaml '
+                             'file name')
+    parser.add_argument('--export',
+                        required=False,
+                        action='store',
+                        metavar='DIR',
+                        help='Write each tagged lab on the hosts to DIR as a '
+                             'yaml file, plus an index.json of VMs, NICs, port '
+                             'groups and vSwitches. With --lab only that lab')
+    parser.add_argument('--diff',
+                        required=False,
+                        nargs='+',
+                        metavar='SNAPSHOT',
+                        help='Compare two snapshots (an exported index.json or '
+                             'a yaml file), or one with the yaml file. Does '
+                             'not connect to a host')
+    parser.add_argument('--report',
+                        required=False,
+                        action='store',
+                        help='Write per node and per phase timings, call counts, '
+                             'bytes and task times to this json file')
+    parser.add_argument('--trace',
+                        required=False,
+                        action='store',
+                        help='Write a Chrome trace (chrome://tracing, Perfetto) '
+                             'of the run to this file')
     args = parser.parse_args()
 
     return parser
@@ -103,6 +263,30 @@ def get_args():
     """
     parser = build_arg_parser()
     args = parser.parse_args()
+    if args.plan and args.apply:
+        parser.error("--plan only shows what --apply would change, use one or the other")
+    #What has to be given depends on the job: diffing works on files alone,
+    #exporting only needs the hosts and tearing down has no use for the vmdk
+    if args.diff:
+        needed = [] if len(args.diff) == 2 else ['yaml_file']
+        if len(args.diff) > 2:
+            parser.error("--diff takes one or two snapshots")
+    elif args.export:
+        needed = ['host', 'user']
+    elif args.destroy:
+        needed = ['datastore', 'host', 'user', 'yaml_file']
+    else:
+        needed = ['datastore', 'host', 'user', 'local_file', 'yaml_file']
+    missing = [name for name in needed if getattr(args, name) is None]
+    if missing:
+        parser.error("the following arguments are required: %s" % ', '.join(
+            '--' + name for name in missing))
+    #args.datastore stays the name of the first datastore, which the seed
+    #goes to, args.datastores has them all with their weights
+    args.datastores = args.datastore or OrderedDict()
+    args.datastore = list(args.datastores)[0] if args.datastores else None
+    if args.diff:
+        return args
 
     return prompt_for_password(args)
 
@@ -113,85 +297,415 @@ def prompt_for_password(args):
     if not args.password:
         args.password = getpass.getpass(
             prompt='Enter password for host %s and user %s: ' %
-                   (args.host, args.user))
+                   (', '.join(args.host), args.user))
     return args
 
 
-def get_obj(content, vimtype, name):
-    """
-    Return an object by name, if name is None the
-    first found object is returned
-    """
-    obj = None
-    container = content.viewManager.CreateContainerView(
-        content.rootFolder, vimtype, True)
-    for c in container.view:
-        if name:
-            if c.name == name:
-                obj = c
-                return obj
-        else:
-            obj = c
-            return obj
-
-def vswitch_exists(host, vswitchtocheck):
+class NullSpan(object):
     '''
-    Check to see if the vswitch already exists or not
+    What Tracer.span() hands out while tracing is off: does nothing.
     '''
-    vswitchlistobj=host.config.network.portgroup
-    for switch in vswitchlistobj:
-        if switch.spec.vswitchName == vswitchtocheck:
-            return True
-        else:
-            continue
-    return False
-
-
-def create_vm(vmname, service_instance, vm_folder, resource_pool,datastore, switchintf):
-
-    #datastore_path = '[' + datastore + '] ' + vm_name
-    datastore_path = '[' + datastore + '] '
-    # Note that if we just leave the datastore as the path, then it will
-    # create in directory that has the vm name. In this case we want that
-    # behavior.
-    # bare minimum VM shell, no disks. Feel free to edit
-    vmx_file = vim.vm.FileInfo(logDirectory=None,
-                               snapshotDirectory=None,
-                               suspendDirectory=None,
-                               vmPathName=datastore_path)
-
-
-
-    config = vim.vm.ConfigSpec(
-                                name=vmname,
-                                memoryMB=4096,
-                                numCPUs=1,
-                                files=vmx_file,
-                                guestId='rhel6_64Guest',
-                                version='vmx-07',)
-                                #deviceChange=devices)
-
-
-
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    def __init__(self, tracer, name, kind, phase, node, args):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.phase = phase
+        self.node = node
+        self.args = args
+        self.children = 0.0
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        if stack:
+            parent = stack[-1]
+            self.phase = self.phase or parent.phase
+            self.node = self.node or parent.node
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.time() - self.start
+        stack = self.tracer.stack()
+        stack.pop()
+        if stack:
+            stack[-1].children += duration
+        self.tracer.record(self, duration)
+        return False
+
+
+class Tracer(object):
+    '''
+    Optional instrumentation for a run. Spans are tagged with a phase
+    (upload, create, wait, ...) and the node being built, and nest: a span
+    without a phase or node takes them from the span it runs in. Once a
+    service instance is instrumented every SOAP call and property read is a
+    span of its own.
+
+    While the tracer is off span() returns a shared no-op and the stub is
+    left alone, so the cost is one attribute check per span.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.events = []
+        self.tasks = []
+        self.start = time.time()
+
+    def enable(self):
+        self.enabled = True
+        self.start = time.time()
+
+    def stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def span(self, name, phase=None, node=None, kind='phase', **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, kind, phase or (name if kind == 'phase' else None), node, args)
+
+    def record(self, span, duration):
+        with self.lock:
+            self.events.append((span.name, span.kind, span.phase, span.node, span.start,
+                                duration, duration - span.children,
+                                threading.current_thread().name, span.args))
+
+    def count_bytes(self, nbytes):
+        '''
+        Add bytes moved to the innermost span, e.g. the upload.
+        '''
+        if self.enabled and self.stack():
+            args = self.stack()[-1].args
+            args['bytes'] = args.get('bytes', 0) + nbytes
+
+    def task_done(self, info):
+        '''
+        Note how long a finished task sat in the host's queue and ran.
+        '''
+        if not self.enabled:
+            return
+        stack = self.stack()
+        queued = info.queueTime
+        started = info.startTime or queued
+        completed = info.completeTime or started
+        with self.lock:
+            self.tasks.append(OrderedDict([
+                ('task', info.descriptionId or str(info.task)),
+                ('node', stack[-1].node if stack else None),
+                ('queue', (started - queued).total_seconds() if queued else None),
+                ('run', (completed - started).total_seconds() if started else None)]))
+
+    def instrument(self, service_instance):
+        '''
+        Wrap the stub under service_instance so every method call and
+        property read on any managed object becomes a 'soap' span.
+        '''
+        if not self.enabled:
+            return
+        stub = service_instance._stub
+        invoke_method = stub.InvokeMethod
+        invoke_accessor = stub.InvokeAccessor
+
+        def traced_method(mo, info, args):
+            with self.span(info.wsdlName, kind='soap'):
+                return invoke_method(mo, info, args)
+
+        def traced_accessor(mo, info):
+            with self.span('get ' + info.name, kind='soap'):
+                return invoke_accessor(mo, info)
+
+        stub.InvokeMethod = traced_method
+        stub.InvokeAccessor = traced_accessor
+
+    def report(self):
+        '''
+        Sum the spans up per phase, per node and per SOAP method.
+        '''
+        def bucket():
+            return OrderedDict([('time', 0.0), ('self', 0.0), ('count', 0),
+                                ('calls', 0), ('bytes', 0)])
+
+        phases = OrderedDict()
+        nodes = OrderedDict()
+        calls = OrderedDict()
+        total_bytes = 0
+        with self.lock:
+            events = list(self.events)
+            tasks = list(self.tasks)
+        for name, kind, phase, node, start, duration, own, thread, args in events:
+            targets = [phases.setdefault(phase or 'other', bucket())]
+            if node:
+                entry = nodes.setdefault(node, OrderedDict([('time', 0.0),
+                                                            ('phases', OrderedDict())]))
+                targets.append(entry['phases'].setdefault(phase or 'other', bucket()))
+            total_bytes += args.get('bytes', 0)
+            for target in targets:
+                target['bytes'] += args.get('bytes', 0)
+                if kind == 'soap':
+                    target['calls'] += 1
+                else:
+                    target['time'] += duration
+                    target['self'] += own
+                    target['count'] += 1
+            if kind == 'soap':
+                call = calls.setdefault(name, OrderedDict([('count', 0), ('time', 0.0)]))
+                call['count'] += 1
+                call['time'] += duration
+            elif kind == 'node':
+                nodes[node]['time'] += duration
+        return OrderedDict([
+            ('total', time.time() - self.start),
+            ('soap_calls', sum(call['count'] for call in calls.values())),
+            ('tasks', len(tasks)),
+            ('bytes', total_bytes),
+            ('phases', phases),
+            ('nodes', nodes),
+            ('calls', OrderedDict(sorted(calls.items(), key=lambda item: -item[1]['time']))),
+            ('task_times', tasks)])
+
+    def chrome_trace(self):
+        '''
+        The spans as Chrome trace events (chrome://tracing, Perfetto or
+        speedscope), one row per thread.
+        '''
+        with self.lock:
+            events = list(self.events)
+        threads = {}
+        trace = []
+        for name, kind, phase, node, start, duration, own, thread, args in events:
+            tid = threads.setdefault(thread, len(threads) + 1)
+            event_args = dict(args, phase=phase, node=node)
+            trace.append({'name': name, 'cat': kind, 'ph': 'X', 'pid': 1, 'tid': tid,
+                          'ts': int((start - self.start) * 1e6),
+                          'dur': int(duration * 1e6), 'args': event_args})
+        for thread, tid in threads.items():
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                          'args': {'name': thread}})
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def save(self, report_file=None, trace_file=None):
+        if not self.enabled:
+            return
+        if report_file:
+            with open(report_file, 'w') as fh:
+                json.dump(self.report(), fh, indent=2)
+            print ("Run report written to %s" % report_file)
+        if trace_file:
+            with open(trace_file, 'w') as fh:
+                json.dump(self.chrome_trace(), fh)
+            print ("Trace written to %s" % trace_file)
+
+#One tracer for the run, off unless --report or --trace is given
+tracer = Tracer()
+
+def traced(phase):
+    '''
+    Decorator: run the function in a span for phase.
+    '''
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class InventoryIndex(object):
+    '''
+    Name to managed object index of the host inventory for the length of
+    a run. Rather than a container view walk per lookup (and a property
+    fetch per object to read its name) the names of every VM, network, host,
+    folder, resource pool, datacenter and datastore are loaded with one
+    RetrieveContents call. Objects this script creates are added as we go.
+    '''
+    TYPES = [vim.VirtualMachine, vim.Network, vim.HostSystem, vim.Folder,
+             vim.ResourcePool, vim.Datacenter, vim.Datastore]
+
+    def __init__(self, service_instance):
+        self.service_instance = service_instance
+        self.lock = threading.Lock()
+        self.objects = dict((vimtype, OrderedDict()) for vimtype in self.TYPES)
+        self.load()
+
+    def _retrieve(self, obj, path, skip, vimtypes):
+        '''
+        Read the names of everything reachable from obj through path.
+        '''
+        content = self.service_instance.RetrieveContent()
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverse', path=path, skip=False, type=type(obj))
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+            obj=obj, skip=skip, selectSet=[traversal])
+        prop_specs = [vmodl.query.PropertyCollector.PropertySpec(type=vimtype, pathSet=['name'])
+                      for vimtype in vimtypes]
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec],
+                                                               propSet=prop_specs)
+        for result in content.propertyCollector.RetrieveContents([filter_spec]):
+            for prop in result.propSet:
+                if prop.name == 'name':
+                    self.add(result.obj, prop.val)
+
+    def load(self):
+        '''
+        (Re)load the whole index.
+        '''
+        content = self.service_instance.RetrieveContent()
+        view = content.viewManager.CreateContainerView(content.rootFolder, self.TYPES, True)
+        try:
+            self._retrieve(view, 'view', True, self.TYPES)
+        finally:
+            view.Destroy()
+
+    def refresh_networks(self, host):
+        '''
+        Pick up networks that showed up on the host since we loaded, i.e.
+        port groups we just created.
+        '''
+        self._retrieve(host, 'network', True, [vim.Network])
+
+    def add(self, obj, name):
+        for vimtype in self.TYPES:
+            if isinstance(obj, vimtype):
+                with self.lock:
+                    self.objects[vimtype].setdefault(name, obj)
+                return
+
+    def remove(self, obj, name):
+        for vimtype in self.TYPES:
+            if isinstance(obj, vimtype):
+                with self.lock:
+                    self.objects[vimtype].pop(name, None)
+                return
+
+    def get(self, vimtype, name=None):
+        '''
+        Return an object by name, if name is None the first
+        object of that type is returned.
+        '''
+        with self.lock:
+            objects = self.objects[vimtype]
+            if name is None:
+                for obj in objects.values():
+                    return obj
+                return None
+            return objects.get(name)
+
+    def network(self, host, name):
+        '''
+        Look up a port group's network, refreshing from the host if it is
+        one we haven't seen yet.
+        '''
+        nic_obj = self.get(vim.Network, name)
+        if nic_obj is None:
+            self.refresh_networks(host)
+            nic_obj = self.get(vim.Network, name)
+        return nic_obj
+
+@traced('network')
+def ensure_vswitch(network_state, vswitchname, network_stage=None):
+    '''
+    Create the vSwitch and its port group if they are not there yet.
+    When a network stage is given the check and the create run on it, so
+    with several VMs being built at once they still happen one at a time.
+    '''
+    if network_stage is not None:
+        return network_stage.submit(ensure_vswitch, network_state, vswitchname).result()
 
-    print ("Creating VM {}...".format(vmname))
-    task = vm_folder.CreateVM_Task(config=config, pool=resource_pool)
-    wait_for_tasks(service_instance, [task])
+    if network_state.fabric is not None:
+        if network_state.portgroup_exists(vswitchname + '-PG'):
+            print ("Port group %s-PG exists. Using existing..." % vswitchname)
+        else:
+            switch, vlan = network_state.fabric.assign(vswitchname)
+            print ("Port group %s-PG (VLAN %d on %s) does not exist. Creating..." % (
+                vswitchname, vlan, switch))
+    elif not network_state.vswitch_exists(vswitchname):
+        print ("vSwitch %s does not exist. Creating..." % vswitchname)
+    elif not network_state.portgroup_exists(vswitchname + '-PG'):
+        print ("vSwitch %s exists without its port group. Creating..." % vswitchname)
+    else:
+        print ("vSwitch %s exists. Using existing..." % vswitchname)
+    network_state.ensure(vswitchname)
 
+def topology_vswitches(doc):
+    '''
+    Every vSwitch the yaml file needs, in the order they are first used.
+    '''
+    vswitches = []
+    for switch in doc.keys():
+        for intname, vswitchname in vm_interfaces(switch, doc[switch], verbose=False):
+            if vswitchname not in vswitches:
+                vswitches.append(vswitchname)
+    return vswitches
 
 
-    #Get server object
-    servcontent = service_instance.RetrieveContent()
-    vmobj = (get_obj(servcontent, [vim.VirtualMachine], vmname))
+#Interface keys: Ma1, and E1, Et1, Eth1, Ethernet1 (any case) for Ethernet1
+INTERFACE_RE = re.compile(r'^(?:(ma|management)|(?:e|et|eth|ethernet))[ _-]?([0-9]+)$',
+                          re.IGNORECASE)
 
-    #Now  reconfig this by adding a controller and disk.
-    #We could have probably did this above when defining the VM;
-    #But this gives us some flexibility for testing new config specs.
-    spec = vim.vm.ConfigSpec()
+def parse_interface(key):
+    '''
+    ('Ma', 1) or ('E', n) for a yaml interface key, or None if it isn't one.
+    '''
+    match = INTERFACE_RE.match(str(key).strip())
+    if match is None:
+        return None
+    return ('Ma' if match.group(1) else 'E', int(match.group(2)))
 
+def vm_interfaces(vmname, switchintf, verbose=True):
+    '''
+    Work out which yaml interfaces become NICs and in what order. Ma1 always
+    comes first, followed by the front panel interfaces in numeric order
+    (E2 before E10). Returns a list of (vEOS interface name, vSwitch name)
+    tuples. Problems with the interfaces are printed unless verbose is
+    False.
+    '''
+    interfaces = []
+    front_panel = []
+    for interface in switchintf.keys():
+        parsed = parse_interface(interface)
+        if parsed == ('Ma', 1) and not interfaces:
+            interfaces.append(('Ma1', switchintf[interface]))
+        elif parsed is not None and parsed[0] == 'E':
+            front_panel.append((parsed[1], interface))
+    if not interfaces and verbose:
+        print ("No Management interface was specified. This will be an issue with VM %s." % vmname)
+
+    #Ma1 is first interface, so front panel interfaces get one less than
+    #the hardware version allows.
+    version = node_profile(vmname, switchintf)['hardware_version']
+    int_index=1
+    for number, interface in sorted(front_panel):
+        if int_index > max_nics(version) - 1:
+            if verbose:
+                print ("vmx-%02d only supports %d interfaces per VM. Ignoring additional "
+                       "interfaces in yaml file." % (version, max_nics(version)))
+            break
+        interfaces.append(('Et%s' % int_index, switchintf[interface]))
+        #Increment our index so we know if we have too many interfaces...
+        int_index += 1
+    return interfaces
 
-    #Setup our disk that we copied over.
-    dev_changes=[]
+def ide_controller_spec():
+    '''
+    Device spec for the IDE controller our disk hangs off.
+    '''
     disk_ctlr = vim.vm.device.VirtualDeviceSpec()
     disk_ctlr.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
     disk_ctlr.device = vim.vm.device.VirtualIDEController()
@@ -201,11 +715,16 @@ def create_vm(vmname, service_instance, vm_folder, resource_pool,datastore, swit
     disk_ctlr.device.unitNumber = 1
     disk_ctlr.device.controllerKey = 200
     disk_ctlr.device.busNumber = 0
-    dev_changes.append(disk_ctlr)
+    return disk_ctlr
 
+def disk_spec(vmname, datastore, controller, base_disk=None):
+    '''
+    Device spec for the vEOS disk. Normally this is the vmdk that was
+    uploaded or copied into the VM folder. If base_disk is given the VM gets
+    a new delta disk whose parent is base_disk instead.
+    '''
     #Since we starting out here...unit number should be 0
     unit_number = 0
-    controller = disk_ctlr.device
     disk_spec = vim.vm.device.VirtualDeviceSpec()
     #disk_spec.fileOperation = "create"
     #If we don't set fileOperation, it should just use existing file which is
@@ -218,108 +737,504 @@ def create_vm(vmname, service_instance, vm_folder, resource_pool,datastore, swit
     disk_spec.device.controllerKey = controller.key
     disk_spec.device.unitNumber = unit_number
     disk_spec.device.backing.fileName = '[%s] %s/vEOS-lab.vmdk' % ( datastore, vmname)
-    dev_changes.append(disk_spec)
+    if base_disk:
+        #Linked mode. Have the host create a child disk that only holds our
+        #writes; everything else is read from the golden base disk.
+        disk_spec.fileOperation = vim.vm.device.VirtualDeviceSpec.FileOperation.create
+        disk_spec.device.backing.parent = vim.vm.device.VirtualDisk.FlatVer2BackingInfo()
+        disk_spec.device.backing.parent.fileName = base_disk
+        disk_spec.device.backing.parent.diskMode = 'persistent'
+        disk_spec.device.backing.deltaDiskFormat = 'redoLogFormat'
+    return disk_spec
+
+#NIC models a profile can ask for
+NIC_TYPES = {
+    'e1000': vim.vm.device.VirtualE1000,
+    'e1000e': vim.vm.device.VirtualE1000e,
+    'vmxnet3': vim.vm.device.VirtualVmxnet3,
+}
+
+def nic_spec(nic_obj, nic='e1000'):
+    '''
+    Device spec for a NIC bound to the given port group (vim.Network).
+    '''
+    nic_spec = vim.vm.device.VirtualDeviceSpec()
+    nic_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
+    nic_type = NIC_TYPES[nic]()
+    nic_spec.device = nic_type
+    nic_spec.device.addressType = "generated"
+    nic_spec.device.deviceInfo = vim.Description()
+    nic_spec.device.backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
+    # portgroup is an object called net_name and we need to pass both the object
+    #and its name to the NIC device
+    nic_spec.device.backing.network = nic_obj
+    nic_spec.device.backing.deviceName = nic_obj.name
+    nic_spec.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
+    nic_spec.device.connectable.startConnected = True
+    nic_spec.device.connectable.allowGuestControl = True
+    return nic_spec
+
+#What every vEOS VM gets unless its profile says otherwise
+NODE_DEFAULTS = OrderedDict([
+    ('nic', 'e1000'),
+    ('hardware_version', 7),
+    ('cpus', 1),
+    ('memory', 4096),
+    ('cpu_reservation', 0),         # MHz
+    ('memory_reservation', 0),      # MB, or 'all'
+    ('latency_sensitivity', 'normal'),
+])
+
+#NICs per VM by the first hardware version that allows that many
+NIC_LIMITS = [(4, 4), (7, 10)]
+#First hardware version with each NIC model
+NIC_MIN_VERSION = {'e1000': 4, 'vmxnet3': 7, 'e1000e': 8}
+LATENCY_LEVELS = ('low', 'normal', 'medium', 'high')
+
+class ProfileError(Exception):
+    pass
+
+def node_role(switch, switchintf):
+    '''
+    A node's role: its role key if it has one, otherwise spine or leaf if
+    the name says so, otherwise default.
+    '''
+    if switchintf.get('role'):
+        return str(switchintf['role'])
+    for role in ('spine', 'leaf'):
+        if role in switch.lower():
+            return role
+    return 'default'
+
+def apply_profiles(doc):
+    '''
+    Take the profiles section out of the yaml file and fold the profiles into
+    the nodes. A node gets the default profile, then the one for its role
+    (see node_role()), then whatever it sets itself:
+
+        profiles:
+            default:
+                nic: vmxnet3
+                hardware_version: 13
+            spine:
+                cpus: 2
+                memory: 8192
+
+        DC1-Spine-1:
+            role: spine
+            memory: 6144
+            Ma1: Lab-vEOS
+            ...
+
+    Returns the nodes. The settings are checked by compile_topology().
+    '''
+    profiles = doc.pop('profiles', None) or {}
+    for role, profile in profiles.items():
+        for key in profile or {}:
+            if key not in NODE_DEFAULTS:
+                raise ProfileError("Unknown setting %s in profile %s" % (key, role))
+    for switch in list(doc.keys()):
+        switchintf = doc[switch] or {}
+        role = node_role(switch, switchintf)
+        if role != 'default' and role not in profiles and 'role' in switchintf:
+            raise ProfileError("Node %s has role %s but there is no such profile" %
+                               (switch, role))
+        merged = OrderedDict()
+        for name in ('default', role):
+            merged.update(profiles.get(name) or {})
+        merged.update(switchintf)
+        doc[switch] = merged
+    return doc
+
+def node_profile(switch, switchintf):
+    '''
+    The VM settings for a node (see NODE_DEFAULTS), with the hardware
+    version as an int. Raises ProfileError for settings that make no sense.
+    '''
+    profile = OrderedDict((key, switchintf.get(key, value))
+                          for key, value in NODE_DEFAULTS.items())
+    version = str(profile['hardware_version'])
+    if version.startswith('vmx-'):
+        version = version[len('vmx-'):]
+    if not version.isdigit() or int(version) < NIC_LIMITS[0][0]:
+        raise ProfileError("Node %s: bad hardware_version %s" %
+                           (switch, profile['hardware_version']))
+    profile['hardware_version'] = int(version)
+    profile['nic'] = str(profile['nic']).lower()
+    if profile['nic'] not in NIC_TYPES:
+        raise ProfileError("Node %s: nic must be one of %s" %
+                           (switch, ', '.join(sorted(NIC_TYPES))))
+    if profile['hardware_version'] < NIC_MIN_VERSION[profile['nic']]:
+        raise ProfileError("Node %s: %s needs hardware_version %d or later" %
+                           (switch, profile['nic'], NIC_MIN_VERSION[profile['nic']]))
+    if profile['latency_sensitivity'] not in LATENCY_LEVELS:
+        raise ProfileError("Node %s: latency_sensitivity must be one of %s" %
+                           (switch, ', '.join(LATENCY_LEVELS)))
+    for key in ('cpus', 'memory', 'cpu_reservation'):
+        if not isinstance(profile[key], int) or profile[key] < 0:
+            raise ProfileError("Node %s: %s must be a whole number" % (switch, key))
+    if profile['memory_reservation'] != 'all' and \
+            (not isinstance(profile['memory_reservation'], int) or
+             profile['memory_reservation'] > profile['memory']):
+        raise ProfileError("Node %s: memory_reservation must be 'all' or MB up to memory" %
+                           switch)
+    return profile
+
+def max_nics(version):
+    '''
+    How many NICs a VM of the given hardware version can have.
+    '''
+    nics = 0
+    for first, limit in NIC_LIMITS:
+        if version >= first:
+            nics = limit
+    return nics
 
-    spec.deviceChange = dev_changes
-    task = vmobj.ReconfigVM_Task( spec=spec )
-    wait_for_tasks(service_instance, [task])
+#Compiling the yaml file
+NODE_SETTINGS = ('description', 'role') + tuple(NODE_DEFAULTS)
 
-    #We could have done this in one shot above with our NICs below. But I want it
-    #separate so I can re-use the code for other use cases. Its keeps it a little more modular
+class TopologyError(Exception):
+    '''
+    Everything wrong with a yaml file, one problem per line.
+    '''
+    def __init__(self, problems):
+        Exception.__init__(self, '\n'.join(problems))
+        self.problems = problems
 
-    #Now lets get our interfaces configured
-    content=service_instance.RetrieveContent()
-    host=get_obj(content,[vim.HostSystem], None)
-    spec = vim.vm.ConfigSpec()
-    dev_changes=[]
 
+def generate_nodes(spec):
+    '''
+    Expand the generate section of a yaml file into nodes: spines, and racks
+    of leafs with a link from every leaf to every spine, plus an MLAG peer
+    link when a rack has two leafs.
+
+        generate:
+            prefix: DC1          # optional, goes in front of every name
+            spines: 2
+            racks: 4
+            leafs: 2             # per rack, 2 if not given
+            management: Lab-vEOS # Ma1 network, Lab-vEOS if not given
+
+    gives DC1-Spine-1, DC1-Spine-2, DC1-R1-Leaf-1, ... DC1-R4-Leaf-2.
+    '''
+    prefix = str(spec.get('prefix') or '')
+    name = lambda *parts: '-'.join(([prefix] if prefix else []) + list(parts))
+    spines = int(spec.get('spines', 0))
+    racks = int(spec.get('racks', 0))
+    leafs = int(spec.get('leafs', 2))
+    management = str(spec.get('management', 'Lab-vEOS'))
+    nodes = OrderedDict()
+    for spine in range(1, spines + 1):
+        nodes[name('Spine-%d' % spine)] = OrderedDict([('description', name('Spine-%d' % spine)),
+                                                      ('Ma1', management)])
+    for rack in range(1, racks + 1):
+        for leaf in range(1, leafs + 1):
+            node = OrderedDict([('description', name('R%d-Leaf-%d' % (rack, leaf))),
+                                ('Ma1', management)])
+            for spine in range(1, spines + 1):
+                link = 'vEOS-' + name('S%d-R%dL%d' % (spine, rack, leaf))
+                node['E%d' % spine] = link
+                nodes[name('Spine-%d' % spine)]['E%d' % ((rack - 1) * leafs + leaf)] = link
+            if leafs == 2:
+                node['E%d' % (spines + 1)] = 'vEOS-' + name('R%d-Peer' % rack)
+            nodes[name('R%d-Leaf-%d' % (rack, leaf))] = node
+    return nodes
+
+def compile_topology(doc):
+    '''
+    Turn a parsed yaml file into the nodes to build, checking the whole
+    thing up front so mistakes don't turn up halfway through a build. The
+    generate section (see generate_nodes()) is expanded, nodes listed in
+    the file come after it and replace generated ones of the same name,
+    and profiles are folded in (see apply_profiles()).
+
+    Each node comes out with its settings, then Ma1, then E1, E2, ... in
+    numeric order, whatever spelling the file used. Raises TopologyError
+    listing every problem found:
+        keys that are neither an interface nor a setting
+        the same interface twice, or gaps in the numbering (NICs are
+        handed to vEOS in order, so E1, E3 would come up as Et1, Et2)
+        more interfaces than the node's hardware version allows
+        links without exactly two ends. The management network and the
+        links listed under shared can have any number.
+    '''
+    if not isinstance(doc, dict):
+        raise TopologyError(["The yaml file should be a mapping of node names to interfaces"])
+    doc = OrderedDict(doc)
+    problems = []
+    keys = {}               # yaml key -> parse_interface(), most keys repeat
+    shared = set(str(link) for link in doc.pop('shared', None) or [])
+    nodes = OrderedDict()
+    if 'profiles' in doc:
+        nodes['profiles'] = doc.pop('profiles')
+    if doc.get('generate'):
+        nodes.update(generate_nodes(doc.pop('generate')))
+    doc.pop('generate', None)
+    for switch, switchintf in doc.items():
+        if not isinstance(switchintf, dict):
+            problems.append("%s: should be a mapping of interfaces to links" % switch)
+            continue
+        nodes[str(switch)] = switchintf
+    nodes = apply_profiles(nodes)
+
+    ends = OrderedDict()    # link -> [(node, interface)]
+    for switch in list(nodes.keys()):
+        settings = OrderedDict()
+        interfaces = {}
+        numbers = []
+        for key, value in nodes[switch].items():
+            if key not in keys:
+                keys[key] = parse_interface(key)
+            parsed = keys[key]
+            if parsed is None:
+                if key not in NODE_SETTINGS:
+                    problems.append("%s: %s is not an interface or a setting" % (switch, key))
+                settings[key] = value
+                continue
+            intname = '%s%d' % parsed
+            if parsed[0] == 'Ma' and parsed[1] != 1:
+                problems.append("%s: %s, vEOS only has Ma1" % (switch, key))
+                continue
+            if intname in interfaces:
+                problems.append("%s: %s and %s are the same interface" %
+                                (switch, interfaces[intname][0], key))
+                continue
+            if value is None or str(value).strip() == '':
+                problems.append("%s: %s has no link" % (switch, key))
+                continue
+            interfaces[intname] = (key, str(value).strip())
+            if parsed[0] == 'Ma':
+                shared.add(str(value).strip())
+            else:
+                numbers.append(parsed[1])
+
+        numbers.sort()
+        if numbers != list(range(1, len(numbers) + 1)):
+            problems.append("%s: interfaces should be numbered from E1 without gaps, got %s" %
+                            (switch, ', '.join('E%d' % number for number in numbers)))
+        try:
+            version = node_profile(switch, settings)['hardware_version']
+        except ProfileError as e:
+            problems.append(str(e))
+            version = NODE_DEFAULTS['hardware_version']
+        if len(numbers) > max_nics(version) - 1:
+            problems.append("%s: %d front panel interfaces, vmx-%02d allows %d" %
+                            (switch, len(numbers), version, max_nics(version) - 1))
+        if 'Ma1' not in interfaces:
+            problems.append("%s: has no Ma1" % switch)
+
+        node = settings
+        for intname in ['Ma1'] + ['E%d' % number for number in numbers]:
+            if intname in interfaces:
+                node[intname] = interfaces[intname][1]
+                ends.setdefault(interfaces[intname][1], []).append((switch, intname))
+        nodes[switch] = node
+
+    for link, members in ends.items():
+        if link in shared or len(members) == 2:
+            continue
+        problems.append("Link %s has %d end%s (%s), a link needs exactly two unless it is "
+                        "listed under shared" % (link, len(members),
+                                                 '' if len(members) == 1 else 's',
+                                                 ', '.join('%s %s' % end for end in members)))
+    if problems:
+        raise TopologyError(problems)
+    return nodes
+
+@traced('compile')
+def load_topology(yaml_file):
+    '''
+    Read and compile the yaml file (see compile_topology()), with the C
+    parser if PyYAML has one.
+    '''
+    with open(yaml_file, 'r') as fh:
+        try:
+            doc = yaml.load(fh, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+        except yaml.YAMLError as e:
+            raise TopologyError(["%s: %s" % (yaml_file, e)])
+    return compile_topology(doc)
+
+#Lab tags. ESXi has no vSphere tags without vCenter, so a VM is marked as
+#part of a lab in its annotation (the Notes field):
+#    eosgenlab-lab: <lab>
+#    description: <the node's description>
+LAB_TAG = 'eosgenlab-lab'
+
+def lab_name(args):
+    return args.lab or os.path.splitext(os.path.basename(args.yaml_file))[0]
+
+def node_annotation(lab, switchintf):
+    lines = ['%s: %s' % (LAB_TAG, lab)]
+    if switchintf.get('description') is not None:
+        lines.append('description: %s' % switchintf['description'])
+    return '\n'.join(lines)
+
+def parse_annotation(annotation):
+    '''
+    The fields of a lab tag, or None if the annotation isn't one.
+    '''
+    fields = OrderedDict()
+    for line in (annotation or '').splitlines():
+        key, sep, value = line.partition(': ')
+        if sep:
+            fields[key] = value
+    if LAB_TAG not in fields:
+        return None
+    return fields
+
+def vm_config_spec(vmname, datastore, profile=None, annotation=None):
+    '''
+    The bare VM shell, no devices. Memory, vCPUs, reservations and the
+    like come from profile (see node_profile()), annotation is the lab tag.
+    '''
+    if profile is None:
+        profile = node_profile(vmname, {})
+    #datastore_path = '[' + datastore + '] ' + vm_name
+    datastore_path = '[' + datastore + '] '
+    # Note that if we just leave the datastore as the path, then it will
+    # create in directory that has the vm name. In this case we want that
+    # behavior.
+    vmx_file = vim.vm.FileInfo(logDirectory=None,
+                               snapshotDirectory=None,
+                               suspendDirectory=None,
+                               vmPathName=datastore_path)
+
+    config = vim.vm.ConfigSpec(
+                                name=vmname,
+                                memoryMB=profile['memory'],
+                                numCPUs=profile['cpus'],
+                                files=vmx_file,
+                                guestId='rhel6_64Guest',
+                                annotation=annotation,
+                                version='vmx-%02d' % profile['hardware_version'],)
+    if profile['cpu_reservation']:
+        config.cpuAllocation = vim.ResourceAllocationInfo(
+            reservation=profile['cpu_reservation'])
+    #High latency sensitivity only takes with all of the memory reserved
+    if profile['memory_reservation'] == 'all' or profile['latency_sensitivity'] == 'high':
+        config.memoryReservationLockedToMax = True
+        config.memoryAllocation = vim.ResourceAllocationInfo(reservation=profile['memory'])
+    elif profile['memory_reservation']:
+        config.memoryAllocation = vim.ResourceAllocationInfo(
+            reservation=profile['memory_reservation'])
+    if profile['latency_sensitivity'] != 'normal':
+        config.latencySensitivity = vim.LatencySensitivity(
+            level=profile['latency_sensitivity'])
+    return config
+
+def build_vm_spec(vmname, datastore, networks, base_disk=None, profile=None,
+                  annotation=None):
+    '''
+    A fully specified ConfigSpec for the VM: the shell plus the IDE
+    controller, the disk and one NIC per entry in networks, so the whole VM
+    comes up with a single CreateVM_Task.
+    '''
+    if profile is None:
+        profile = node_profile(vmname, {})
+    config = vm_config_spec(vmname, datastore, profile, annotation)
+    disk_ctlr = ide_controller_spec()
+    #Devices added in the same spec reference each other with temporary
+    #negative keys
+    disk_ctlr.device.key = -1
+    config.deviceChange = [disk_ctlr, disk_spec(vmname, datastore, disk_ctlr.device, base_disk)]
+    config.deviceChange += [nic_spec(nic_obj, profile['nic']) for nic_obj in networks]
+    return config
+
+@traced('create')
+def create_vm(vmname, service_instance, vm_folder, resource_pool,datastore, switchintf,
+              base_disk=None, network_stage=None, stepwise=False, index=None,
+              network_state=None, journal=None, lab=None):
+    '''
+    Create the VM with its disk and interfaces. If base_disk is given the VM
+    gets a new delta disk whose parent is base_disk rather than a vmdk of its
+    own. vSwitch changes go through network_stage if one is given, see
+    ensure_vswitch().
+
+    The VM is created fully specified in one task. With stepwise the old
+    path is used instead: create an empty shell, then reconfigure in the
+    disk, then the NICs. That is slower but handy for testing new specs.
+
+    Lookups go through index (an InventoryIndex) and the host networking
+    through network_state (a NetworkState), so pass the run's ones in when
+    building more than one VM.
+
+    Finished steps are recorded in journal (a Journal) if given. A stepwise
+    build that was cut short carries on with the VM the journal names. With
+    lab the VM is tagged as part of that lab.
+    '''
+    if index is None:
+        index = InventoryIndex(service_instance)
+    profile = node_profile(vmname, switchintf)
+    annotation = node_annotation(lab, switchintf) if lab else None
+
+    #Get our vSwitches and Port Groups in place first so the NICs have
+    #something to bind to
+    host=index.get(vim.HostSystem)
+    if network_state is None:
+        network_state = NetworkState(host)
     print ("Creating vSwitches and Portgroups for VM %s" % vmname)
-    for interface in sorted(switchintf.keys()):
-        #First, lets find the management interface
-        #We'll use findall because I have no idea of case in the yaml
-        #file. Not efficient, but this will work.
-        if re.findall('ma1', interface,re.IGNORECASE):
-            print ("vEOS Ma1 binding to %s " % switchintf[interface])
-            #Check if its already configured or not
-            if not vswitch_exists(host, switchintf[interface]):
-                print ("vSwitch %s does not exist. Creating..." % switchintf[interface])
-                AddHostSwitch(host, switchintf[interface])
-
-            #For our Port Groups, we just add the suffix -PG and use this as the Standard
-            #naming convention
-            PGNAME=switchintf[interface]+'-PG'
-            #Lets bind our nic.
-            nic_spec = vim.vm.ConfigSpec()
-            nic_spec = vim.vm.device.VirtualDeviceSpec()
-            nic_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
-            nic_type = vim.vm.device.VirtualE1000()
-            nic_spec.device = nic_type
-            nic_spec.device.addressType = "generated"
-            nic_spec.device.deviceInfo = vim.Description()
-            nic_spec.device.backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
-            #We need both the name and object passed here...so get it
-            nic_obj= get_obj(content,[vim.Network], PGNAME)
-            nic_spec.device.backing.network = nic_obj
-            nic_spec.device.backing.deviceName = nic_obj.name
-            # portgroup is an object called net_name and we need to pass both the object
-            #and its name to the NIC device
-            nic_spec.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
-            nic_spec.device.connectable.startConnected = True
-            nic_spec.device.connectable.allowGuestControl = True
-            dev_changes.append(nic_spec)
-            break
+    networks = []
+    for intname, vswitchname in vm_interfaces(vmname, switchintf):
+        print ("vEOS %s binding to %s " % (intname, vswitchname))
+        #Check if its already configured or not
+        ensure_vswitch(network_state, vswitchname, network_stage)
+        #For our Port Groups, we just add the suffix -PG and use this as the Standard
+        #naming convention
+        networks.append(index.network(host, vswitchname + '-PG'))
+
+    if not stepwise:
+        print ("Creating VM {}...".format(vmname))
+        config = build_vm_spec(vmname, datastore, networks, base_disk, profile, annotation)
+        task = vm_folder.CreateVM_Task(config=config, pool=resource_pool)
+        vmobj = wait_for_tasks(service_instance, [task])[0]
+        index.add(vmobj, vmname)
+        if journal is not None:
+            journal.record_all([(vmname, 'vm', {'moid': vmobj._moId}),
+                                (vmname, 'attach', {}), (vmname, 'nics', {})])
+        return vmobj
+
+    def done(step):
+        return journal is not None and journal.done(vmname, step)
+
+    created = done('vm')
+    if created:
+        vmobj = vim.VirtualMachine(created['moid'], service_instance._stub)
+        print ("VM %s exists (%s). Carrying on..." % (vmname, created['moid']))
     else:
-        print ("No Management interface was specified. This will be an issue with this VM.")
-
-    int_index=1
-    for interface in sorted(switchintf.keys()):
-        #Ma1 is first interface, so front panel interfaces are max'd out at 9.
-        if int_index > 9:
-            print ("ESXi only supports 10 interfaces per VM. Ignoring additional interfaces in yaml file.")
-            break
-        if re.findall('e[0-9]', interface,re.IGNORECASE):
-            print ("vEOS Et%s binding to %s " % (str(int_index),switchintf[interface]))
-            #Check if its already configured or not
-            if not vswitch_exists(host, switchintf[interface]):
-                print ("vSwitch %s does not exist. Creating..." % switchintf[interface])
-                AddHostSwitch(host, switchintf[interface])
-            else:
-                print ("vSwitch %s exists. Using existing..." % switchintf[interface] )
-
-            #For our Port Groups, we just add the suffix -PG and use this as the Standard
-            #naming convention
-            PGNAME=switchintf[interface]+'-PG'
-            #Lets bind our nic.
-            nic_spec = vim.vm.ConfigSpec()
-            nic_spec = vim.vm.device.VirtualDeviceSpec()
-            nic_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
-            nic_type = vim.vm.device.VirtualE1000()
-            nic_spec.device = nic_type
-            nic_spec.device.addressType = "generated"
-            nic_spec.device.deviceInfo = vim.Description()
-            nic_spec.device.backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
-            #We need both the name and object passed here...so get it
-            nic_obj= get_obj(content,[vim.Network], PGNAME)
-            nic_spec.device.backing.network = nic_obj
-            nic_spec.device.backing.deviceName = nic_obj.name
-            # portgroup is an object called net_name and we need to pass both the object
-            #and its name to the NIC device
-            nic_spec.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
-            nic_spec.device.connectable.startConnected = True
-            nic_spec.device.connectable.allowGuestControl = True
-            dev_changes.append(nic_spec)
-
-            #Increment our index so we know if we have too many interfaces...
-            int_index += 1
+        # bare minimum VM shell, no disks. Feel free to edit
+        config = vm_config_spec(vmname, datastore, profile, annotation)
+        print ("Creating VM {}...".format(vmname))
+        task = vm_folder.CreateVM_Task(config=config, pool=resource_pool)
+        #Get server object
+        vmobj = wait_for_tasks(service_instance, [task])[0]
+        index.add(vmobj, vmname)
+        if journal is not None:
+            journal.record(vmname, 'vm', moid=vmobj._moId)
+
+    if not done('attach'):
+        #Now  reconfig this by adding a controller and disk.
+        spec = vim.vm.ConfigSpec()
+        disk_ctlr = ide_controller_spec()
+        spec.deviceChange = [disk_ctlr, disk_spec(vmname, datastore, disk_ctlr.device, base_disk)]
+        task = vmobj.ReconfigVM_Task( spec=spec )
+        wait_for_tasks(service_instance, [task])
+        if journal is not None:
+            journal.record(vmname, 'attach')
 
     #NOW Apply new NIC specs
-    spec.deviceChange = dev_changes
+    spec = vim.vm.ConfigSpec()
+    spec.deviceChange = [nic_spec(nic_obj, profile['nic']) for nic_obj in networks]
     task = vmobj.ReconfigVM_Task( spec=spec )
     wait_for_tasks(service_instance, [task])
+    if journal is not None:
+        journal.record(vmname, 'nics')
+    return vmobj
 
 
-
-def AddHostSwitch(host, vswitchName):
+def vswitch_spec():
+    '''
+    Spec for the vSwitches we create for vEOS links.
+    '''
     vswitch_spec = vim.host.VirtualSwitch.Specification()
     vswitch_spec.numPorts = 32
     vswitch_spec.mtu = 9000
@@ -335,72 +1250,583 @@ def AddHostSwitch(host, vswitchName):
     #network_policy.security.forgedTransmits = True
 
     #vswitch_spec.policy = network_policy
+    return vswitch_spec
 
-    host.configManager.networkSystem.AddVirtualSwitch(vswitchName,vswitch_spec)
-
-    #Now create port group and add that to the vswitch we just created.
-
+def portgroup_spec(vswitchName, name=None, vlan=4095):
+    '''
+    Spec for the <vswitch>-PG port group that our NICs bind to. In fabric
+    mode the port group is named after the link and sits on a shared trunk
+    vSwitch with a VLAN of its own.
+    '''
     portgroup_spec = vim.host.PortGroup.Specification()
     portgroup_spec.vswitchName = vswitchName
-    portgroup_spec.name = vswitchName+'-PG'
-    portgroup_spec.vlanId = int(4095)
+    portgroup_spec.name = name or vswitchName+'-PG'
+    portgroup_spec.vlanId = int(vlan)
     network_policy = vim.host.NetworkPolicy()
     network_policy.security = vim.host.NetworkPolicy.SecurityPolicy()
     network_policy.security.allowPromiscuous = True
     network_policy.security.macChanges = True
     network_policy.security.forgedTransmits = True
     portgroup_spec.policy = network_policy
+    return portgroup_spec
+
+
+class NetworkState(object):
+    '''
+    Local copy of the host's vSwitch and port group names. It is read once
+    from the network system and kept up to date as we add to it, so
+    checking whether a vSwitch exists doesn't cost a trip to the host.
+    '''
+    def __init__(self, host, fabric=None):
+        self.host = host
+        self.network_system = host.configManager.networkSystem
+        self.fabric = fabric
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        info = self.network_system.networkInfo
+        with self.lock:
+            self.vswitches = set(vswitch.name for vswitch in info.vswitch or [])
+            #vSwitches bridged to a physical NIC are the user's, whatever
+            #they are called
+            self.uplinked = set(vswitch.name for vswitch in info.vswitch or []
+                                if vswitch.pnic or getattr(vswitch.spec, 'bridge', None))
+            self.portgroups = set(pg.spec.name for pg in info.portgroup or [])
+            self.portgroup_vswitch = dict((pg.spec.name, pg.spec.vswitchName)
+                                          for pg in info.portgroup or [])
+            if self.fabric is not None:
+                self.fabric.sync(info.portgroup or [])
+
+    def switch_for(self, link):
+        '''
+        The vSwitch a link's port group lives on: its own vSwitch, or in
+        fabric mode the trunk vSwitch the link was assigned to.
+        '''
+        if self.fabric is None:
+            return link
+        return self.fabric.assign(link)[0]
+
+    def link_portgroup_spec(self, link):
+        if self.fabric is None:
+            return portgroup_spec(link)
+        vswitchname, vlan = self.fabric.assign(link)
+        return portgroup_spec(vswitchname, link + '-PG', vlan)
+
+    def link_vswitch_spec(self, vswitchname):
+        if self.fabric is None:
+            return vswitch_spec()
+        return self.fabric.vswitch_spec(vswitchname)
+
+    def vswitch_exists(self, vswitchname):
+        with self.lock:
+            return vswitchname in self.vswitches
+
+    def portgroup_exists(self, pgname):
+        with self.lock:
+            return pgname in self.portgroups
+
+    def has_uplink(self, vswitchname):
+        with self.lock:
+            return vswitchname in self.uplinked
+
+    def ensure(self, vswitchname):
+        '''
+        Create the vSwitch and/or its port group, whichever is missing.
+        Returns True if anything was created.
+        '''
+        created = False
+        if self.portgroup_exists(vswitchname + '-PG'):
+            return created
+        switch = self.switch_for(vswitchname)
+        if not self.vswitch_exists(switch):
+            self.network_system.AddVirtualSwitch(switch, self.link_vswitch_spec(switch))
+            with self.lock:
+                self.vswitches.add(switch)
+            created = True
+        if not self.portgroup_exists(vswitchname + '-PG'):
+            self.network_system.AddPortGroup(self.link_portgroup_spec(vswitchname))
+            with self.lock:
+                self.portgroups.add(vswitchname + '-PG')
+            created = True
+            #Keep the VLAN the link was just given, like apply() does
+            if self.fabric is not None:
+                self.fabric.save()
+        return created
+
+    def missing(self, vswitchnames):
+        '''
+        Return the vSwitches and port groups (as names) that have to be
+        added for the given vSwitches to be usable. In fabric mode the
+        vSwitches are the shared trunk vSwitches the links sit on.
+        '''
+        vswitches = []
+        portgroups = []
+        with self.lock:
+            for vswitchname in vswitchnames:
+                if vswitchname + '-PG' not in self.portgroups and vswitchname not in portgroups:
+                    portgroups.append(vswitchname)
+        #A port group that exists has its vSwitch
+        switches = [self.switch_for(vswitchname) for vswitchname in portgroups]
+        with self.lock:
+            for switch in switches:
+                if switch not in self.vswitches and switch not in vswitches:
+                    vswitches.append(switch)
+        return vswitches, portgroups
+
+    def apply(self, vswitchnames):
+        '''
+        Add everything missing for the given vSwitches in a single
+        UpdateNetworkConfig call instead of two calls per vSwitch.
+        Returns the number of vSwitches and port groups added.
+        '''
+        vswitches, portgroups = self.missing(vswitchnames)
+        if not vswitches and not portgroups:
+            return 0
+
+        config = vim.host.NetworkConfig()
+        for vswitchname in vswitches:
+            vswitch_config = vim.host.VirtualSwitch.Config()
+            vswitch_config.changeOperation = 'add'
+            vswitch_config.name = vswitchname
+            vswitch_config.spec = self.link_vswitch_spec(vswitchname)
+            config.vswitch.append(vswitch_config)
+        for vswitchname in portgroups:
+            pg_config = vim.host.PortGroup.Config()
+            pg_config.changeOperation = 'add'
+            pg_config.spec = self.link_portgroup_spec(vswitchname)
+            config.portgroup.append(pg_config)
+        self.network_system.UpdateNetworkConfig(config=config, changeMode='modify')
+        if self.fabric is not None:
+            self.fabric.save()
+
+        with self.lock:
+            self.vswitches.update(vswitches)
+            self.portgroups.update(vswitchname + '-PG' for vswitchname in portgroups)
+            for vswitchname in portgroups:
+                self.portgroup_vswitch[vswitchname + '-PG'] = self.switch_for(vswitchname)
+        return len(vswitches) + len(portgroups)
+
+    def remove(self, pgnames, vswitchnames):
+        '''
+        Remove port groups and then vSwitches in a single UpdateNetworkConfig
+        call.
+        '''
+        if not pgnames and not vswitchnames:
+            return
+        config = vim.host.NetworkConfig()
+        for pgname in pgnames:
+            pg_config = vim.host.PortGroup.Config()
+            pg_config.changeOperation = 'remove'
+            pg_config.spec = vim.host.PortGroup.Specification(
+                name=pgname, vswitchName=self.portgroup_vswitch.get(pgname, ''), vlanId=0,
+                policy=vim.host.NetworkPolicy())
+            config.portgroup.append(pg_config)
+        for vswitchname in vswitchnames:
+            vswitch_config = vim.host.VirtualSwitch.Config()
+            vswitch_config.changeOperation = 'remove'
+            vswitch_config.name = vswitchname
+            config.vswitch.append(vswitch_config)
+        self.network_system.UpdateNetworkConfig(config=config, changeMode='modify')
+        with self.lock:
+            self.portgroups.difference_update(pgnames)
+            self.vswitches.difference_update(vswitchnames)
+            for pgname in pgnames:
+                self.portgroup_vswitch.pop(pgname, None)
+
+
+
+#Fabric mode: instead of a vSwitch per link, links become VLAN port groups
+#on a small pool of shared trunk vSwitches
+FABRIC_PREFIX = 'vEOS-fabric-'
+FABRIC_PORTS = 1024
+FABRIC_VLANS = (2, 4094)
+
+class FabricError(Exception):
+    pass
+
+
+class VlanFabric(object):
+    '''
+    Assigns every link a trunk vSwitch from the pool and a VLAN of its own,
+    so links stay isolated at L2 while sharing vSwitches. A link's VLAN
+    starts from a hash of its name and probes upwards past VLANs in use,
+    so it doesn't depend on which other links exist. Assignments are kept
+    in ~/.eosgenlab/vlans/<host>.json and reused on the next run, and port
+    groups already on the host's fabric vSwitches always win over the file.
+
+    Links are packed onto the first vSwitch with ports left for them,
+    counting ports_per_link NICs per link. VLAN ids are unique across the
+    whole pool.
+
+    With pool=False there is just the one vSwitch called prefix, e.g. the
+    uplink vSwitch carrying links between hosts, bridged to nic if the
+    vSwitch has to be created.
+    '''
+    def __init__(self, hostname, ports=FABRIC_PORTS, ports_per_link=2, prefix=FABRIC_PREFIX,
+                 pool=True, nic=None):
+        self.hostname = hostname
+        self.ports = ports
+        self.ports_per_link = ports_per_link
+        self.prefix = prefix
+        self.pool = pool
+        self.nic = nic
+        self.lock = threading.RLock()
+        self.state_file = os.path.join(os.path.expanduser('~'), '.eosgenlab', 'vlans',
+                                       re.sub(r'[^A-Za-z0-9_.-]', '_', hostname) + '.json')
+        self.links = {}        # link -> [vswitch, vlan]
+        self.link_ports = {}   # link -> NICs on it in the topology
+        self.dirty = False
+        try:
+            with open(self.state_file, 'r') as fh:
+                self.links = dict((link, list(entry)) for link, entry in
+                                  json.load(fh).get('links', {}).items())
+        except (IOError, ValueError):
+            pass
 
-    host.configManager.networkSystem.AddPortGroup(portgroup_spec)
+    def sync(self, portgroups):
+        '''
+        Take the host's word for links that already have a port group on
+        a fabric vSwitch.
+        '''
+        with self.lock:
+            for pg in portgroups:
+                spec = pg.spec
+                if not self.owns(spec.vswitchName) or not spec.name.endswith('-PG'):
+                    continue
+                link = spec.name[:-len('-PG')]
+                if self.links.get(link) != [spec.vswitchName, spec.vlanId]:
+                    #Whoever had that VLAN in the file gets a new one
+                    for other, entry in list(self.links.items()):
+                        if other != link and entry[1] == spec.vlanId:
+                            del self.links[other]
+                    self.links[link] = [spec.vswitchName, spec.vlanId]
+                    self.dirty = True
+
+    def owns(self, vswitchname):
+        if self.pool:
+            return vswitchname.startswith(self.prefix)
+        return vswitchname == self.prefix
+
+    def vswitch_name(self, number):
+        return self.prefix + str(number) if self.pool else self.prefix
+
+    def count_ports(self, doc):
+        '''
+        Count the NICs on each link in the topology, for packing.
+        '''
+        with self.lock:
+            for switch in doc.keys():
+                for intname, link in vm_interfaces(switch, doc[switch], verbose=False):
+                    self.link_ports[link] = self.link_ports.get(link, 0) + 1
+
+    def vswitch_load(self):
+        load = {}
+        for link, (vswitchname, vlan) in self.links.items():
+            if self.link_ports and link not in self.link_ports:
+                #Left over from an earlier topology, its VLAN stays reserved
+                continue
+            load[vswitchname] = load.get(vswitchname, 0) + \
+                self.link_ports.get(link, self.ports_per_link)
+        return load
+
+    def assign(self, link):
+        '''
+        The (vswitch, vlan) for a link, allocating one if it has none.
+        '''
+        with self.lock:
+            if link in self.links:
+                return tuple(self.links[link])
+            used = set(entry[1] for entry in self.links.values())
+            first, last = FABRIC_VLANS
+            span = last - first + 1
+            if len(used) >= span:
+                raise FabricError("Out of VLANs for link %s" % link)
+            vlan = first + zlib.crc32(link.encode('utf-8')) % span
+            while vlan in used:
+                vlan = first + (vlan - first + 1) % span
+            need = self.link_ports.get(link, self.ports_per_link)
+            load = self.vswitch_load()
+            number = 1
+            while self.pool and load.get(self.vswitch_name(number), 0) + need > self.ports and \
+                    load.get(self.vswitch_name(number), 0) > 0:
+                number += 1
+            self.links[link] = [self.vswitch_name(number), vlan]
+            self.dirty = True
+            return tuple(self.links[link])
+
+    def release(self, links):
+        '''
+        Give up the VLANs of links that were torn down.
+        '''
+        with self.lock:
+            for link in links:
+                if self.links.pop(link, None) is not None:
+                    self.dirty = True
+
+    def vswitch_spec(self, vswitchname=None):
+        spec = vswitch_spec()
+        spec.numPorts = self.ports
+        if self.nic:
+            spec.bridge = vim.host.VirtualSwitch.BondBridge(nicDevice=[self.nic])
+        return spec
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                if not os.path.isdir(os.path.dirname(self.state_file)):
+                    os.makedirs(os.path.dirname(self.state_file))
+                with open(self.state_file, 'w') as fh:
+                    json.dump({'host': self.hostname, 'links': self.links}, fh,
+                              indent=1, sort_keys=True)
+                self.dirty = False
+            except (IOError, OSError):
+                pass
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+class TaskMonitor(object):
+    '''
+    Watches every task we start through one PropertyCollector filter that
+    lives for the whole run, instead of a collector and filter per
+    wait_for_tasks() call. Tasks are added to a ListView the filter
+    traverses, and a background thread sitting in WaitForUpdatesEx
+    resolves a concurrent.futures.Future per task with the task's result
+    or its fault. Finished tasks are dropped from the view again.
+
+    A task whose timeout runs out is cancelled on the host and its future
+    fails with TaskTimeout. Cancelling a future cancels the task.
+
+    The collector, view and filter belong to the vSphere session. If the
+    session expires and is renewed they are gone, so they are set up again
+    and the pending tasks carry on in the new ones.
+    '''
+    def __init__(self, service_instance, timeout=None, poll=5):
+        self.service_instance = service_instance
+        self.timeout = timeout
+        self.poll = poll
+        self.lock = threading.Lock()
+        self.setup_lock = threading.Lock()
+        self.pending = {}       # str(task) -> (task, future, deadline)
+        self.stopping = False
+        self.error = None
+        self.setup()
+        self.thread = threading.Thread(target=self.run, name='TaskMonitor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def setup(self, lost=None):
+        '''
+        Create the collector, view and filter. With lost (the view that was
+        found missing) only if nobody has replaced it yet, then put the
+        pending tasks in the new view.
+        '''
+        with self.setup_lock:
+            if lost is not None and lost is not self.view:
+                return
+            self._create()
+            if lost is not None:
+                with self.lock:
+                    tasks = [entry[0] for entry in self.pending.values()]
+                if tasks:
+                    self.view.ModifyListView(add=tasks)
+
+    def _create(self):
+        content = self.service_instance.content
+        self.collector = content.propertyCollector.CreatePropertyCollector()
+        self.view = content.viewManager.CreateListView()
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(name='tasks',
+                                                                type=vim.view.ListView,
+                                                                path='view', skip=False)
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+        filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(
+            obj=self.view, skip=True, selectSet=[traversal])]
+        filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=vim.Task,
+                                                                          pathSet=['info'])]
+        self.filter = self.collector.CreateFilter(filter_spec, True)
+
+    def alive(self):
+        return self.thread.is_alive() and not self.stopping
+
+    def submit(self, tasks, timeout=None):
+        '''
+        Start watching tasks. Returns a Future per task, in order.
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.time() + timeout if timeout else None
+        futures = []
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            for task in tasks:
+                future = Future()
+                self.pending[str(task)] = (task, future, deadline)
+                futures.append(future)
+        for task, future in zip(tasks, futures):
+            future.add_done_callback(lambda future, task=task: self.cancelled(task, future))
+        #One call for the whole batch, the filter reports their state from here on
+        view = self.view
+        try:
+            view.ModifyListView(add=list(tasks))
+        except vmodl.fault.ManagedObjectNotFound:
+            self.setup(view)
+        return futures
+
+    def cancelled(self, task, future):
+        if not future.cancelled():
+            return
+        with self.lock:
+            if self.pending.pop(str(task), None) is None:
+                return
+        self.cancel_task(task)
+
+    def cancel_task(self, task):
+        try:
+            task.CancelTask()
+        except vmodl.MethodFault:
+            #Not cancelable or already done, either way we are not waiting for it
+            pass
+        self.forget([task])
+
+    def forget(self, tasks):
+        try:
+            self.view.ModifyListView(remove=tasks)
+        except vmodl.MethodFault:
+            pass
 
+    def run(self):
+        version = ''
+        lost = False
+        try:
+            while not self.stopping:
+                #Wake up in time for the next deadline
+                wait = self.poll
+                with self.lock:
+                    deadlines = [entry[2] for entry in self.pending.values() if entry[2]]
+                if deadlines:
+                    wait = min(wait, max(1, int(math.ceil(min(deadlines) - time.time()))))
+                options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=wait)
+                view = self.view
+                try:
+                    update = self.collector.WaitForUpdatesEx(version, options)
+                except vmodl.fault.ManagedObjectNotFound:
+                    #The session was renewed. Once, or the error is real.
+                    if lost:
+                        raise
+                    lost = True
+                    self.setup(view)
+                    version = ''
+                    continue
+                lost = False
+                if update is not None:
+                    version = update.version
+                    self.process(update)
+                self.expire()
+        except Exception as e:
+            if not self.stopping:
+                self.fail(e)
+
+    def process(self, update):
+        finished = []
+        for filter_set in update.filterSet:
+            for obj_set in filter_set.objectSet:
+                for change in obj_set.changeSet:
+                    if change.name != 'info' or change.val is None:
+                        continue
+                    info = change.val
+                    if info.state not in (vim.TaskInfo.State.success,
+                                          vim.TaskInfo.State.error):
+                        continue
+                    with self.lock:
+                        entry = self.pending.pop(str(obj_set.obj), None)
+                    if entry is None:
+                        continue
+                    task, future, deadline = entry
+                    finished.append(task)
+                    tracer.task_done(info)
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    if info.state == vim.TaskInfo.State.success:
+                        future.set_result(info.result)
+                    else:
+                        future.set_exception(info.error)
+        if finished:
+            self.forget(finished)
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            expired = [(key, entry) for key, entry in self.pending.items()
+                       if entry[2] is not None and entry[2] <= now]
+            for key, entry in expired:
+                del self.pending[key]
+        for key, (task, future, deadline) in expired:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(TaskTimeout("Task %s did not finish in time" % key))
+            self.cancel_task(task)
+
+    def fail(self, error):
+        '''
+        The update stream broke: fail everything still pending.
+        '''
+        with self.lock:
+            self.error = error
+            entries = list(self.pending.values())
+            self.pending.clear()
+        for task, future, deadline in entries:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+
+    def stop(self):
+        if self.stopping:
+            return
+        self.stopping = True
+        try:
+            self.collector.CancelWaitForUpdates()
+        except vmodl.MethodFault:
+            pass
+        self.thread.join(self.poll + 1)
+        try:
+            self.filter.Destroy()
+            self.view.Destroy()
+            self.collector.Destroy()
+        except (vmodl.MethodFault, IOError):
+            pass
 
+task_monitors = {}
+task_monitors_lock = threading.Lock()
 
-#Function borrowed from pyvmomi-community-samples samples.tools
-def wait_for_tasks(service_instance, tasks):
+def task_monitor(service_instance):
+    '''
+    The TaskMonitor for a service instance, started on first use and
+    stopped at exit.
+    '''
+    with task_monitors_lock:
+        monitor = task_monitors.get(id(service_instance))
+        if monitor is None or not monitor.alive():
+            monitor = TaskMonitor(service_instance,
+                                  monitor.timeout if monitor is not None else None)
+            task_monitors[id(service_instance)] = monitor
+            atexit.register(monitor.stop)
+        return monitor
+
+@traced('wait')
+def wait_for_tasks(service_instance, tasks, timeout=None):
     """Given the service instance and tasks, it returns after all the
-   tasks are complete.
+   tasks are complete. Returns the task results in order and raises the
+   first task fault, or TaskTimeout.
    """
-    property_collector = service_instance.content.propertyCollector
-    task_list = [str(task) for task in tasks]
-    # Create filter
-    obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=task)
-                 for task in tasks]
-    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task,
-                                                               pathSet=[],
-                                                               all=True)
-    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
-    filter_spec.objectSet = obj_specs
-    filter_spec.propSet = [property_spec]
-    pcfilter = property_collector.CreateFilter(filter_spec, True)
-    try:
-        version, state = None, None
-        # Loop looking for updates till the state moves to a completed state.
-        while len(task_list):
-            update = property_collector.WaitForUpdates(version)
-            for filter_set in update.filterSet:
-                for obj_set in filter_set.objectSet:
-                    task = obj_set.obj
-                    for change in obj_set.changeSet:
-                        if change.name == 'info':
-                            state = change.val.state
-                        elif change.name == 'info.state':
-                            state = change.val
-                        else:
-                            continue
-
-                        if not str(task) in task_list:
-                            continue
-
-                        if state == vim.TaskInfo.State.success:
-                            # Remove task from taskList
-                            task_list.remove(str(task))
-                        elif state == vim.TaskInfo.State.error:
-                            raise task.info.error
-            # Move to next version
-            version = update.version
-    finally:
-        if pcfilter:
-            pcfilter.Destroy()
+    futures = task_monitor(service_instance).submit(tasks, timeout)
+    done, not_done = futures_wait(futures, return_when=FIRST_EXCEPTION)
+    for future in futures:
+        if future in done and future.exception() is not None:
+            raise future.exception()
+    return [future.result() for future in futures]
 
 def GetVMHosts(content):
     host_view = content.viewManager.CreateContainerView(content.rootFolder,
@@ -410,44 +1836,14 @@ def GetVMHosts(content):
     host_view.Destroy()
     return obj
 
-def pushvmdk(si,datastorename,hostname,localfilename,verify_cert, vmname):
-    print ("Uploading vmdk for %s..." % vmname)
-    content = si.RetrieveContent()
-    # Get the list of all datacenters we have available to us
-    datacenters_object_view = content.viewManager.CreateContainerView(
-        content.rootFolder,
-        [vim.Datacenter],
-        True)
-
-    # Find the datastore and datacenter we are using
-    datacenter = None
-    datastore = None
-    for dc in datacenters_object_view.view:
-        datastores_object_view = content.viewManager.CreateContainerView(
-            dc,
-            [vim.Datastore],
-            True)
-        for ds in datastores_object_view.view:
-            if ds.info.name == datastorename:
-                datacenter = dc
-                datastore = ds
-    if not datacenter or not datastore:
-        print("Could not find the datastore specified")
-        raise SystemExit(-1)
-    # Clean up the views now that we have what we need
-    datastores_object_view.Destroy()
-    datacenters_object_view.Destroy()
-    # Build the url to put the file - https://hostname:port/resource?params
-
-    #To keep things simple, we'll use the vmname as the folder and then
-    #we'll force the vmdk file to vEOS-lab.vmdk
-    resource = "/folder/" + vmname + "/vEOS-lab.vmdk"
-    params = {"dsName": datastore.info.name,
-              "dcPath": datacenter.name}
-    http_url = "https://" + hostname + ":443" + resource
-
-    # Get the cookie built from the current session
-    client_cookie = si._stub.cookie
+def get_cookie(si):
+    '''
+    Build the requests cookie from the current vSphere session so we can
+    talk to the datastore http file service.
+    '''
+    # Get the cookie built from the current session. Under a session
+    # oriented stub the cookie lives on the soap stub it wraps.
+    client_cookie = getattr(si._stub, 'soapStub', si._stub).cookie
     # Break apart the cookie into it's component parts - This is more than
     # is needed, but a good example of how to break apart the cookie
     # anyways. The verbosity makes it clear what is happening.
@@ -459,29 +1855,2133 @@ def pushvmdk(si,datastorename,hostname,localfilename,verify_cert, vmname):
     # Make a cookie
     cookie = dict()
     cookie[cookie_name] = cookie_text
+    return cookie
 
-    # Get the request headers set up
-    headers = {'Content-Type': 'application/octet-stream'}
+class UploadError(Exception):
+    pass
 
-    # Get the file to upload ready, extra protection by using with against
-    # leaving open threads
-    with open(localfilename, "rb") as f:
-        # Connect and upload the file
-        request = requests.put(http_url,
-                               params=params,
-                               data=f,
-                               headers=headers,
-                               cookies=cookie,
-                               verify=verify_cert)
 
+class ProgressReader(object):
+    '''
+    Iterable over what we are uploading (normally a buffered reader on the
+    local file) in chunk_size blocks, which requests hands to the
+    connection one at a time. It has no read() on purpose: http.client
+    would read a file-like body 8KB at a time whatever chunk_size is. It
+    has a length so the upload goes out with a Content-Length, and reports
+    throughput and ETA as it goes, calling on_progress with the percentage
+    done each time.
+    '''
+    def __init__(self, f, size, label, chunk_size, interval=10, on_progress=None):
+        self.f = f
+        self.size = size
+        self.label = label
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.on_progress = on_progress
+        self.sent = 0
+        self.start = time.time()
+        self.last_report = self.start
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        while True:
+            data = self.f.read(self.chunk_size)
+            if not data:
+                return
+            self.sent += len(data)
+            now = time.time()
+            if now - self.last_report >= self.interval:
+                self.last_report = now
+                self.report(now)
+                if self.on_progress:
+                    self.on_progress(100 * self.sent // max(self.size, 1))
+            yield data
+
+    def rate(self, now=None):
+        elapsed = (now or time.time()) - self.start
+        return self.sent / elapsed if elapsed > 0 else 0
+
+    def report(self, now):
+        rate = self.rate(now)
+        eta = (self.size - self.sent) / rate if rate else 0
+        print ("%s: %d/%d MB (%d%%) %.1f MB/s ETA %ds" % (
+            self.label, self.sent // 2**20, self.size // 2**20,
+            100 * self.sent // max(self.size, 1), rate / 2**20, eta))
+
+    def close(self):
+        self.f.close()
+
+
+class Uploader(object):
+    '''
+    Uploads files to the datastore through the host's /folder http service.
+    All uploads share one pooled requests.Session carrying the vSphere
+    session cookie, at most max_uploads run at once, and each one is
+    verified by size afterwards and retried with backoff if it fails.
+
+    Every file we upload gets a <file>.sha1 next to it holding the local
+    checksum, so an upload is skipped when the datastore already has the
+    same file (same size and checksum).
+    '''
+    def __init__(self, service_instance, hostname, port, verify_cert, datacenter, datastore,
+                 max_uploads=2, chunk_size=8 * 2**20, retries=3, backoff=5):
+        self.service_instance = service_instance
+        self.base_url = "https://%s:%d/folder/" % (hostname, port)
+        self.params = {"dsName": datastore.info.name,
+                       "dcPath": datacenter.name}
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.slots = threading.BoundedSemaphore(max(1, max_uploads))
+        self.session = requests.Session()
+        self.session.verify = verify_cert if verify_cert is not None else True
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(1, max_uploads) + 2)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.stats_lock = threading.Lock()
+        self.bytes_sent = 0
+
+    def for_datastore(self, datastorename):
+        '''
+        An Uploader for another datastore on the same host, sharing this
+        one's connection pool and upload slots.
+        '''
+        uploader = copy.copy(self)
+        uploader.params = dict(self.params, dsName=datastorename)
+        return uploader
+
+    def request(self, method, path, **kwargs):
+        #Pick up the cookie every time, the vSphere session may have been renewed
+        self.session.cookies.update(get_cookie(self.service_instance))
+        response = self.session.request(method, self.base_url + path, params=self.params,
+                                        **kwargs)
+        if response.status_code in (401, 403):
+            #Session expired. Any SOAP call has the session stub log in again;
+            #requests without a body are tried again straight away.
+            self.service_instance.CurrentTime()
+            if 'data' not in kwargs:
+                self.session.cookies.update(get_cookie(self.service_instance))
+                response = self.session.request(method, self.base_url + path,
+                                                params=self.params, **kwargs)
+        return response
+
+    def remote_size(self, path):
+        '''
+        Size of a file on the datastore or None if it isn't there.
+        '''
+        response = self.request('HEAD', path)
+        if response.status_code != 200:
+            return None
+        return int(response.headers.get('Content-Length', -1))
+
+    def exists(self, path):
+        return self.remote_size(path) is not None
+
+    def identical(self, localfilename, path):
+        '''
+        Is path on the datastore the same as our local file? We compare the
+        size the datastore reports and the checksum stored next to it.
+        '''
+        if self.remote_size(path) != os.path.getsize(localfilename):
+            return False
+        return self.checksum_recorded(path, file_checksum(localfilename))
+
+    def checksum_recorded(self, path, checksum):
+        '''
+        Does the .sha1 file next to path hold checksum?
+        '''
+        response = self.request('GET', path + '.sha1')
+        if response.status_code != 200:
+            return False
+        return response.text.strip() == checksum
+
+    def record_checksum(self, path, checksum):
+        response = self.request('PUT', path + '.sha1', data=checksum,
+                                headers={'Content-Type': 'application/octet-stream'})
+        response.raise_for_status()
+
+    @traced('upload')
+    def upload(self, localfilename, path, label=None):
+        '''
+        Put localfilename on the datastore at path (relative to the
+        datastore root). Returns False if the upload was skipped because an
+        identical file was already there.
+        '''
+        label = label or path
+        if self.identical(localfilename, path):
+            print ("%s is up to date on the datastore. Skipping upload..." % path)
+            return False
+
+        with self.slots:
+            attempt = 0
+            while True:
+                try:
+                    self._upload(localfilename, path, label)
+                    break
+                except (requests.RequestException, UploadError) as e:
+                    attempt += 1
+                    if attempt > self.retries:
+                        raise UploadError("Upload of %s failed: %s" % (path, e))
+                    delay = self.backoff * 2 ** (attempt - 1)
+                    print ("Upload of %s failed (%s). Retrying in %ds..." % (path, e, delay))
+                    time.sleep(delay)
+
+        #Record the checksum next to the file so the next run can skip it
+        self.record_checksum(path, file_checksum(localfilename))
+        return True
+
+    def _upload(self, localfilename, path, label):
+        reader = ProgressReader(open(localfilename, 'rb', self.chunk_size),
+                                os.path.getsize(localfilename), label, self.chunk_size)
+        try:
+            response = self.request('PUT', path, data=reader,
+                                    headers={'Content-Type': 'application/octet-stream'})
+        finally:
+            reader.close()
+            with self.stats_lock:
+                self.bytes_sent += reader.sent
+            tracer.count_bytes(reader.sent)
+        if response.status_code not in (200, 201, 204):
+            raise UploadError("HTTP %d" % response.status_code)
+        if self.remote_size(path) != reader.size:
+            raise UploadError("size on the datastore does not match %s" % localfilename)
+        self.report(reader)
+
+    def report(self, reader):
+        print ("%s: %d MB in %ds (%.1f MB/s)" % (reader.label, reader.size // 2**20,
+                                                 time.time() - reader.start,
+                                                 reader.rate() / 2**20))
+
+    @traced('upload')
+    def stream(self, url, reader, content_type):
+        '''
+        POST a ProgressReader to an absolute url, e.g. an NFC lease disk
+        url. Nothing is retried here, a lease can't be resumed.
+        '''
+        with self.slots:
+            self.session.cookies.update(get_cookie(self.service_instance))
+            try:
+                response = self.session.post(url, data=reader,
+                                             headers={'Content-Type': content_type})
+            except requests.RequestException as e:
+                raise UploadError("Upload to %s failed: %s" % (url, e))
+            finally:
+                reader.close()
+                with self.stats_lock:
+                    self.bytes_sent += reader.sent
+                tracer.count_bytes(reader.sent)
+        if response.status_code not in (200, 201, 204):
+            raise UploadError("Upload to %s failed: HTTP %d" % (url, response.status_code))
+        self.report(reader)
+
+
+def pushvmdk(uploader, localfilename, vmname):
+    '''
+    Upload the vmdk into the VM's folder.
+    '''
+    print ("Uploading vmdk for %s..." % vmname)
+    #To keep things simple, we'll use the vmname as the folder and then
+    #we'll force the vmdk file to vEOS-lab.vmdk
+    return uploader.upload(localfilename, vmname + "/vEOS-lab.vmdk", vmname)
 
+checksum_lock = threading.Lock()
 
+def file_checksum(localfilename):
+    '''
+    Return the sha1 of a local file. Hashing a multi-GB vmdk is not free, so
+    the result is cached in ~/.eosgenlab/checksums.json keyed on the path,
+    size and mtime of the file.
+    '''
+    cache_file = os.path.join(os.path.expanduser('~'), '.eosgenlab',
+                              'checksums.json')
+    path = os.path.abspath(localfilename)
+    with checksum_lock:
+        stat = os.stat(path)
+        try:
+            with open(cache_file, 'r') as fh:
+                cache = json.load(fh)
+        except (IOError, ValueError):
+            cache = {}
+        entry = cache.get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['sha1']
+
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha1.update(chunk)
+        cache[path] = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                       'sha1': sha1.hexdigest()}
+        try:
+            if not os.path.isdir(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            with open(cache_file, 'w') as fh:
+                json.dump(cache, fh)
+        except (IOError, OSError):
+            #Not fatal, we'll just hash again next time
+            pass
+        return sha1.hexdigest()
+
+def push_seed(uploader, localfilename, seed_folder):
+    '''
+    Make sure the seed folder holds a copy of our local vmdk. The upload is
+    skipped if the seed from a previous run still matches. Returns True if
+    the seed was uploaded.
+    '''
+    return pushvmdk(uploader, localfilename, seed_folder)
+
+def seed_vmdk(args):
+    '''
+    Where the seed disk lives on a datastore: the uploaded vmdk, or with
+    --sparse the native disk import_sparse_seed() leaves.
+    '''
+    if args.sparse:
+        return '%s/%s.vmdk' % (args.seed_folder, args.seed_folder)
+    return args.seed_folder + '/vEOS-lab.vmdk'
+
+def seed_path(args, datastorename):
+    return '[%s] %s' % (datastorename, seed_vmdk(args))
+
+def copy_disks(si, datacenter, copies, native=False, force=True):
+    '''
+    Make host side copies of (source, destination) datastore path pairs,
+    creating destination folders as needed. All the copy tasks are started
+    before we wait on them. Without force a destination that exists is an
+    error rather than overwritten.
+
+    A native disk (see import_sparse_seed()) is a descriptor plus a -flat
+    extent, so it is copied with the VirtualDiskManager rather than as a
+    single file.
+    '''
+    content = si.RetrieveContent()
+    file_manager = content.fileManager
+    tasks = []
+    for source, destination in copies:
+        folder = destination.rsplit('/', 1)[0]
+        if folder != source.rsplit('/', 1)[0]:
+            try:
+                file_manager.MakeDirectory(name=folder, datacenter=datacenter,
+                                           createParentDirectories=True)
+            except vim.fault.FileAlreadyExists:
+                pass
+        if native:
+            disk_spec = vim.VirtualDiskManager.FileBackedVirtualDiskSpec()
+            disk_spec.diskType = 'thin'
+            disk_spec.adapterType = 'ide'
+            tasks.append(content.virtualDiskManager.CopyVirtualDisk_Task(
+                sourceName=source,
+                sourceDatacenter=datacenter,
+                destName=destination,
+                destDatacenter=datacenter,
+                destSpec=disk_spec,
+                force=force))
+            continue
+        tasks.append(file_manager.CopyDatastoreFile_Task(
+            sourceName=source,
+            sourceDatacenter=datacenter,
+            destinationName=destination,
+            destinationDatacenter=datacenter,
+            force=force))
+    if tasks:
+        wait_for_tasks(si, tasks)
+
+@traced('golden')
+def golden_disk(si, uploaders, datacenter, seed_folder, seed, checksum):
+    '''
+    Return datastore -> datastore path of the golden base disk for linked
+    mode, for each datastore in uploaders (datastore -> its Uploader). The
+    golden disk is named after the seed's checksum and made from the seed
+    vmdk (seed, relative to the datastore root) on the same datastore if it
+    doesn't exist yet. It is a
+    VirtualDiskManager copy of the seed so it is in the host's native
+    format. VMs only ever open it as the read-only parent of their own
+    delta disk, so it must not be attached to a VM directly or changed
+    while any lab VM is using it: a new seed gets a new golden disk, and
+    the old one stays for the VMs linked to it.
+    '''
+    goldens = OrderedDict()
+    copies = []
+    golden_vmdk = '%s/vEOS-golden-%s.vmdk' % (seed_folder, checksum)
+    for datastorename, uploader in uploaders.items():
+        golden = goldens[datastorename] = '[%s] %s' % (datastorename, golden_vmdk)
+        if uploader.exists(golden_vmdk):
+            print ("Golden base disk %s exists. Using existing..." % golden)
+            continue
+        print ("Creating golden base disk %s..." % golden)
+        copies.append(('[%s] %s' % (datastorename, seed), golden))
+    copy_disks(si, datacenter, copies, native=True, force=False)
+    return goldens
+
+@traced('copy')
+def copy_seed(ctx, vmnames):
+    '''
+    Fan the seed out to <vmname>/vEOS-lab.vmdk for each VM with server side
+    copies. vmnames maps each VM to its datastore, and every copy is made
+    from the seed on that same datastore (see seed_datastores()).
+    '''
+    args = ctx.args
+    copies = []
+    for vmname, datastorename in vmnames.items():
+        print ("Copying seed vmdk for %s..." % vmname)
+        copies.append((seed_path(args, datastorename),
+                       '[%s] %s/vEOS-lab.vmdk' % (datastorename, vmname)))
+    copy_disks(ctx.service_instance, ctx.datacenter, copies, native=args.sparse)
+
+def seed_datastores(ctx, datastorenames):
+    '''
+    Get the seed onto the first datastore of --datastore (uploaded, or
+    imported with --sparse) and from there, with host side copies, onto
+    the others in datastorenames, so no node's disk is copied from or
+    linked to another datastore. A copy whose recorded checksum matches the
+    local file is kept. Returns datastore -> the disk to use there: the
+    golden disk in linked mode, else the seed.
+    '''
+    args = ctx.args
+    if args.sparse:
+        #Only the allocated parts of the image are sent and the seed lands
+        #in native format
+        import_sparse_seed(ctx)
+    else:
+        push_seed(ctx.uploader, args.local_file, args.seed_folder)
+
+    checksum = file_checksum(args.local_file)
+    stale = [datastorename for datastorename in datastorenames
+             if datastorename != args.datastore and
+             not ctx.uploaders[datastorename].checksum_recorded(seed_vmdk(args), checksum)]
+    if stale:
+        print ("Copying the seed to %s..." % ', '.join(stale))
+        copy_disks(ctx.service_instance, ctx.datacenter,
+                   [(seed_path(args, args.datastore), seed_path(args, datastorename))
+                    for datastorename in stale], native=args.sparse)
+        for datastorename in stale:
+            ctx.uploaders[datastorename].record_checksum(seed_vmdk(args), checksum)
+
+    if args.linked:
+        #No copies at all, every VM gets a delta disk off the golden disk.
+        #The seed itself is never a parent, so replacing it leaves built
+        #labs alone.
+        return golden_disk(ctx.service_instance,
+                           OrderedDict((datastorename, ctx.uploaders[datastorename])
+                                       for datastorename in datastorenames),
+                           ctx.datacenter, args.seed_folder, seed_vmdk(args), checksum)
+    return OrderedDict((datastorename, seed_path(args, datastorename))
+                       for datastorename in datastorenames)
+
+
+#Sparse disk transfer. Most of the vEOS image is zeros, so instead of
+#sending the vmdk as is, --sparse converts it on the fly to a
+#streamOptimized vmdk (deflated grains, no zero grains) and imports that
+#through an NFC lease, which leaves a native disk on the datastore.
+SECTOR = 512
+GRAIN_SECTORS = 128                 # 64KB grains
+GRAIN_SIZE = GRAIN_SECTORS * SECTOR
+GT_ENTRIES = 512                    # grain table entries, one table covers 32MB
+SPARSE_MAGIC = 0x564d444b           # 'KDMV'
+SPARSE_HEADER = struct.Struct('<IIIQQQQIQQQBccccH433x')
+SPARSE_COMPRESSED = 0x10000
+SPARSE_MARKERS = 0x20000
+GD_AT_END = 0xffffffffffffffff
+MARKER_EOS, MARKER_GT, MARKER_GD, MARKER_FOOTER = 0, 1, 2, 3
+ZERO_GRAIN = b'\0' * GRAIN_SIZE
+COMPRESS_LEVEL = 6
+#The length of the deflated stream depends on the zlib doing the deflating
+ZLIB_VERSION = getattr(zlib, 'ZLIB_RUNTIME_VERSION', zlib.ZLIB_VERSION)
+
+
+class DiskImage(object):
+    '''
+    Read the virtual disk inside a local vmdk one 64KB grain at a time.
+    Knows hosted sparse vmdks (what Arista ships), flat vmdks (given as the
+    descriptor or the -flat file) and raw images. A vmdk that is already
+    streamOptimized is flagged so it can be sent as is.
+    '''
+    def __init__(self, localfilename):
+        self.f = open(localfilename, 'rb')
+        self.offset = 0
+        self.grain_directory = None
+        self.stream_optimized = False
+        self.gt_cache = (None, None)
+
+        head = self.f.read(SECTOR)
+        if len(head) == SECTOR and struct.unpack('<I', head[:4])[0] == SPARSE_MAGIC:
+            header = SPARSE_HEADER.unpack(head)
+            flags, capacity, grain_sectors = header[2], header[3], header[4]
+            self.capacity = capacity
+            if flags & SPARSE_COMPRESSED:
+                self.stream_optimized = True
+                return
+            self.source_grain = grain_sectors
+            self.gtes = header[7]
+            num_gts = -(-capacity // (grain_sectors * self.gtes))
+            self.f.seek(header[9] * SECTOR)
+            self.grain_directory = struct.unpack('<%dI' % num_gts, self.f.read(4 * num_gts))
+        elif head.startswith(b'# Disk DescriptorFile'):
+            self.f.seek(0)
+            descriptor = self.f.read(64 * 1024).decode('ascii', 'replace')
+            extents = re.findall(r'^RW\s+(\d+)\s+FLAT\s+"([^"]+)"\s*(\d*)', descriptor, re.MULTILINE)
+            if len(extents) != 1:
+                raise UploadError("%s: only single extent flat descriptors are supported"
+                                  % localfilename)
+            sectors, extent, offset = extents[0]
+            self.f.close()
+            self.f = open(os.path.join(os.path.dirname(os.path.abspath(localfilename)), extent), 'rb')
+            self.capacity = int(sectors)
+            self.offset = int(offset or 0) * SECTOR
+        else:
+            self.capacity = -(-os.path.getsize(localfilename) // SECTOR)
+
+    def grains(self):
+        return -(-self.capacity // GRAIN_SECTORS)
+
+    def _read_source_grain(self, grain):
+        '''
+        One grain of a hosted sparse vmdk, None if it was never written.
+        '''
+        gt_index, entry = divmod(grain, self.gtes)
+        if gt_index >= len(self.grain_directory) or not self.grain_directory[gt_index]:
+            return None
+        if self.gt_cache[0] != gt_index:
+            self.f.seek(self.grain_directory[gt_index] * SECTOR)
+            self.gt_cache = (gt_index, struct.unpack('<%dI' % self.gtes,
+                                                     self.f.read(4 * self.gtes)))
+        sector = self.gt_cache[1][entry]
+        if sector <= 1:
+            #0 is unallocated, 1 is an explicit zero grain
+            return None
+        self.f.seek(sector * SECTOR)
+        return self.f.read(self.source_grain * SECTOR)
+
+    def read_grain(self, grain):
+        '''
+        Contents of one 64KB grain, or None if it is known to be zero
+        without reading it.
+        '''
+        if self.grain_directory is None:
+            self.f.seek(self.offset + grain * GRAIN_SIZE)
+            data = self.f.read(GRAIN_SIZE)
+        else:
+            first = grain * GRAIN_SECTORS
+            parts = []
+            found = False
+            lba = first
+            while lba < first + GRAIN_SECTORS:
+                source, skip = divmod(lba, self.source_grain)
+                take = min(self.source_grain - skip, first + GRAIN_SECTORS - lba)
+                data = self._read_source_grain(source)
+                if data is None:
+                    parts.append(ZERO_GRAIN[:take * SECTOR])
+                else:
+                    found = True
+                    parts.append(data[skip * SECTOR:(skip + take) * SECTOR])
+                lba += take
+            if not found:
+                return None
+            data = b''.join(parts)
+        if len(data) < GRAIN_SIZE:
+            data += ZERO_GRAIN[len(data):]
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def sparse_header(capacity, descriptor_sectors, gd_offset):
+    return SPARSE_HEADER.pack(SPARSE_MAGIC, 3, 0x1 | SPARSE_COMPRESSED | SPARSE_MARKERS,
+                              capacity, GRAIN_SECTORS, 1, descriptor_sectors, GT_ENTRIES,
+                              0, gd_offset, 1 + descriptor_sectors, 0,
+                              b'\n', b' ', b'\r', b'\n', 1)
+
+def sparse_marker(sectors, marker_type):
+    return struct.pack('<QII', sectors, 0, marker_type) + b'\0' * (SECTOR - 16)
+
+def pad_sector(data):
+    return data + b'\0' * (-len(data) % SECTOR)
+
+def stream_optimized(image, checksum, allocated=None, found=None):
+    '''
+    Generate a streamOptimized vmdk of image, chunk by chunk. Only grains
+    that hold data are sent, each deflated; the grain tables follow the
+    grains they cover and the grain directory and footer come at the end,
+    so nothing bigger than one grain table is ever held in memory.
+
+    allocated is the list of grains known to hold data (see
+    sparse_layout()); without it every grain is read and zero ones are
+    dropped, and the ones kept are appended to found.
+    '''
+    capacity = image.capacity
+    num_gts = -(-image.grains() // GT_ENTRIES)
+    cylinders = min(capacity // (16 * 63), 16383)
+    descriptor = pad_sector((
+        '# Disk DescriptorFile\n'
+        'version=1\n'
+        'CID=%s\n'
+        'parentCID=ffffffff\n'
+        'createType="streamOptimized"\n\n'
+        '# Extent description\n'
+        'RW %d SPARSE "vEOS-lab.vmdk"\n\n'
+        '# The Disk Data Base\n'
+        '#DDB\n\n'
+        'ddb.adapterType = "ide"\n'
+        'ddb.geometry.cylinders = "%d"\n'
+        'ddb.geometry.heads = "16"\n'
+        'ddb.geometry.sectors = "63"\n'
+        'ddb.virtualHWVersion = "7"\n' % (checksum[:8], capacity, cylinders)).encode('ascii'))
+    descriptor_sectors = len(descriptor) // SECTOR
+    yield sparse_header(capacity, descriptor_sectors, GD_AT_END)
+    yield descriptor
+
+    position = 1 + descriptor_sectors
+    directory = [0] * num_gts
+    table, table_index = None, None
+    gt_sectors = GT_ENTRIES * 4 // SECTOR
+
+    def grain_table():
+        directory[table_index] = position + 1
+        return sparse_marker(gt_sectors, MARKER_GT) + struct.pack('<%dI' % GT_ENTRIES, *table)
+
+    for grain in (allocated if allocated is not None else range(image.grains())):
+        data = image.read_grain(grain)
+        if data is None or data == ZERO_GRAIN:
+            continue
+        if found is not None:
+            found.append(grain)
+        if grain // GT_ENTRIES != table_index:
+            if table is not None:
+                chunk = grain_table()
+                position += len(chunk) // SECTOR
+                yield chunk
+            table, table_index = [0] * GT_ENTRIES, grain // GT_ENTRIES
+        compressed = zlib.compress(data, COMPRESS_LEVEL)
+        chunk = pad_sector(struct.pack('<QI', grain * GRAIN_SECTORS, len(compressed)) + compressed)
+        table[grain % GT_ENTRIES] = position
+        position += len(chunk) // SECTOR
+        yield chunk
+    if table is not None:
+        chunk = grain_table()
+        position += len(chunk) // SECTOR
+        yield chunk
+
+    gd = pad_sector(struct.pack('<%dI' % num_gts, *directory))
+    gd_offset = position + 1
+    yield sparse_marker(len(gd) // SECTOR, MARKER_GD) + gd
+    yield sparse_marker(1, MARKER_FOOTER) + sparse_header(capacity, descriptor_sectors, gd_offset)
+    yield sparse_marker(0, MARKER_EOS)
+
+def sparse_layout(image, checksum):
+    '''
+    Which grains of the image hold data and how long the streamOptimized
+    version of it is. Working that out means reading and deflating the whole
+    image once, so the result is cached per image checksum in
+    ~/.eosgenlab/extents/<sha1>.json with the grains stored as runs. The
+    stream size becomes the upload's Content-Length, so a cache written
+    with another zlib or compression level is worked out again.
+    '''
+    cache_file = os.path.join(os.path.expanduser('~'), '.eosgenlab', 'extents',
+                              checksum + '.json')
+    try:
+        with open(cache_file, 'r') as fh:
+            layout = json.load(fh)
+        if layout['zlib'] != ZLIB_VERSION or layout['level'] != COMPRESS_LEVEL:
+            raise KeyError('zlib')
+        grains = []
+        for start, count in layout['runs']:
+            grains.extend(range(start, start + count))
+        return grains, layout['stream_size']
+    except (IOError, ValueError, KeyError):
+        pass
+
+    print ("Scanning %s for zero grains..." % image.f.name)
+    grains = []
+    stream_size = sum(len(chunk) for chunk in stream_optimized(image, checksum, found=grains))
+    runs = []
+    for grain in grains:
+        if runs and runs[-1][0] + runs[-1][1] == grain:
+            runs[-1][1] += 1
+        else:
+            runs.append([grain, 1])
+    try:
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        with open(cache_file, 'w') as fh:
+            json.dump({'capacity': image.capacity, 'runs': runs, 'stream_size': stream_size,
+                       'zlib': ZLIB_VERSION, 'level': COMPRESS_LEVEL}, fh)
+    except (IOError, OSError):
+        pass
+    return grains, stream_size
+
+
+class ChunkReader(object):
+    '''
+    Minimal file-like object over a generator of byte chunks, for
+    ProgressReader to read chunk_size blocks from.
+    '''
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = b''
+
+    def read(self, size):
+        parts = [self.buffer]
+        length = len(self.buffer)
+        while length < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        data = b''.join(parts)
+        self.buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        self.chunks.close()
+
+
+def wait_for_lease(lease):
+    '''
+    Wait for an NFC lease to be ready for us to upload to.
+    '''
+    while True:
+        state = lease.state
+        if state == vim.HttpNfcLease.State.ready:
+            return
+        if state == vim.HttpNfcLease.State.error:
+            raise lease.error
+        time.sleep(1)
+
+@traced('import')
+def import_sparse_seed(ctx):
+    '''
+    Import the local vmdk as the seed disk through an NFC lease, sending it
+    as a streamOptimized vmdk so only allocated data crosses the wire. The
+    disk is attached to a throwaway VM during the import, which is
+    unregistered afterwards leaving <seed_folder>/<seed_folder>.vmdk, a
+    native disk, behind. Returns its datastore path. The import is skipped
+    if the seed from a previous run still matches the local file.
+    '''
+    args = ctx.args
+    uploader = ctx.uploader
+    seed_name = args.seed_folder
+    vmdk = seed_vmdk(args)
+    path = seed_path(args, args.datastore)
+    checksum = file_checksum(args.local_file)
+    if uploader.checksum_recorded(vmdk, checksum):
+        print ("Seed disk %s is up to date. Skipping import..." % path)
+        return path
+
+    #Clear out what is left of an earlier import
+    leftover = ctx.index.get(vim.VirtualMachine, seed_name)
+    if leftover is not None:
+        leftover.UnregisterVM()
+        ctx.index.remove(leftover, seed_name)
+    if uploader.exists(vmdk):
+        content = ctx.service_instance.RetrieveContent()
+        task = content.virtualDiskManager.DeleteVirtualDisk_Task(name=path,
+                                                                 datacenter=ctx.datacenter)
+        wait_for_tasks(ctx.service_instance, [task])
+
+    image = DiskImage(args.local_file)
+    try:
+        if image.stream_optimized:
+            size = os.path.getsize(args.local_file)
+            print ("Importing seed disk, %s is already streamOptimized..." % args.local_file)
+        else:
+            grains, size = sparse_layout(image, checksum)
+            print ("Importing seed disk: %.1f of %d MB hold data, sending %.1f MB..." % (
+                len(grains) * GRAIN_SIZE / 2.0**20, image.capacity * SECTOR // 2**20,
+                size / 2.0**20))
+
+        config = vim.vm.ConfigSpec(name=seed_name, memoryMB=256, numCPUs=1,
+                                   guestId='otherGuest', version='vmx-07',
+                                   files=vim.vm.FileInfo(vmPathName='[%s] %s/%s.vmx' % (
+                                       args.datastore, seed_name, seed_name)))
+        disk_ctlr = ide_controller_spec()
+        disk_ctlr.device.key = -1
+        seed_disk = disk_spec(seed_name, args.datastore, disk_ctlr.device)
+        seed_disk.fileOperation = vim.vm.device.VirtualDeviceSpec.FileOperation.create
+        seed_disk.device.backing.fileName = path
+        seed_disk.device.backing.thinProvisioned = True
+        seed_disk.device.capacityInKB = image.capacity * SECTOR // 1024
+        config.deviceChange = [disk_ctlr, seed_disk]
+        import_spec = vim.vm.VmImportSpec(configSpec=config)
+
+        lease = ctx.resource_pool.ImportVApp(spec=import_spec, folder=ctx.vmfolder,
+                                             host=ctx.index.get(vim.HostSystem))
+        wait_for_lease(lease)
+        try:
+            url = [device.url for device in lease.info.deviceUrl if device.disk][0]
+            url = url.replace('*', ctx.hostname)
+            if image.stream_optimized:
+                source = open(args.local_file, 'rb', uploader.chunk_size)
+            else:
+                source = ChunkReader(stream_optimized(image, checksum, grains))
+            reader = ProgressReader(source, size, seed_name, uploader.chunk_size,
+                                    on_progress=lease.HttpNfcLeaseProgress)
+            uploader.stream(url, reader, 'application/x-vnd.vmware-streamVmdk')
+            if reader.sent != size:
+                raise UploadError("Sent %d bytes of a %d byte stream" % (reader.sent, size))
+        except Exception:
+            lease.HttpNfcLeaseAbort()
+            raise
+        lease.HttpNfcLeaseComplete()
+        lease.info.entity.UnregisterVM()
+    finally:
+        image.close()
+
+    uploader.record_checksum(vmdk, checksum)
+    return path
+
+
+#Build journal
+#Options that change what the build steps do. A journal written with
+#different ones is no good for resuming.
+JOURNAL_OPTIONS = ('datastores', 'local_file', 'seed', 'linked', 'sparse', 'seed_folder',
+                   'stepwise', 'fabric')
+
+class Journal(object):
+    '''
+    Append-only record of the build steps that finished on one host, kept
+    in ~/.eosgenlab/journal/<host>-<yaml file>.jsonl, one JSON object a line:
+
+        {"step": "vm", "node": "Spine-1", "moid": "12", "time": 1718000000.0}
+
+    The steps are 'seed' (the seed and golden disks are in place), 'vswitch'
+    (with the vSwitch name as the node) and for each node 'placed' (the
+    datastore it goes on), 'vmdk' (its disk is on the datastore),
+    'vm' (created, with its moid), 'attach' (disk attached) and 'nics'
+    (NICs bound, the node is done). Records are flushed and synced before
+    the step counts as done, so a build that dies part way leaves an exact
+    account of what it finished.
+
+    A build starts the journal over. With resume the records are read back
+    and finished steps are skipped without asking the host about them.
+    '''
+    def __init__(self, hostname, yaml_file):
+        name = '%s-%s.jsonl' % (hostname, os.path.splitext(os.path.basename(yaml_file))[0])
+        self.path = os.path.join(os.path.expanduser('~'), '.eosgenlab', 'journal',
+                                 re.sub(r'[^A-Za-z0-9_.-]', '_', name))
+        self.lock = threading.Lock()
+        self.steps = {}        # (node, step) -> record
+        self.fh = None
+
+    def open(self, options, resume=False):
+        '''
+        Start recording a build. With resume pick up where the journal left
+        off, unless it was written with other options. Returns the number of
+        records picked up.
+        '''
+        if resume:
+            self.read()
+            start = self.steps.get((None, 'start'))
+            if start is None:
+                print ("No journal at %s. Building from scratch..." % self.path)
+            elif start.get('options') != options:
+                print ("Journal %s was written with other options. Building from scratch..." %
+                       self.path)
+                self.steps = {}
+            else:
+                self.fh = open(self.path, 'a')
+                return len(self.steps) - 1
+        self.steps = {}
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self.fh = open(self.path, 'w')
+        self.record(None, 'start', options=options)
+        return 0
+
+    def read(self):
+        try:
+            with open(self.path, 'r') as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        #Cut short by a crash, the step did not finish
+                        continue
+                    self.steps[(entry.get('node'), entry['step'])] = entry
+        except IOError:
+            pass
+
+    def done(self, node, step):
+        '''
+        The record of a finished step, or None.
+        '''
+        with self.lock:
+            return self.steps.get((node, step))
+
+    def record(self, node, step, **fields):
+        self.record_all([(node, step, fields)])
+
+    def record_all(self, entries):
+        '''
+        Record several finished steps, (node, step, fields) each, with one
+        sync to disk.
+        '''
+        if self.fh is None:
+            return
+        with self.lock:
+            for node, step, fields in entries:
+                entry = OrderedDict([('step', step), ('node', node)])
+                entry.update(sorted(fields.items()))
+                entry['time'] = round(time.time(), 3)
+                self.fh.write(json.dumps(entry) + '\n')
+                self.steps[(node, step)] = entry
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+
+    def clear(self):
+        '''
+        Forget the build, e.g. once the lab is torn down.
+        '''
+        self.close()
+        self.steps = {}
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def journal_options(args):
+    return dict((option, getattr(args, option)) for option in JOURNAL_OPTIONS)
+
+
+class BuildContext(object):
+    '''
+    Everything about a run that the per-node build steps share: the
+    arguments, the connection and the run-scoped lookups.
+    '''
+    def __init__(self, args, service_instance, verify_cert, hostname):
+        self.args = args
+        self.service_instance = service_instance
+        self.verify_cert = verify_cert
+        self.hostname = hostname
+        #One inventory load for the whole run
+        self.index = InventoryIndex(service_instance)
+        self.vmfolder = self.index.get(vim.Folder)
+        self.resource_pool = self.index.get(vim.ResourcePool)
+        self.fabric = VlanFabric(hostname) if args.fabric else None
+        self.network_state = NetworkState(self.index.get(vim.HostSystem), self.fabric)
+        self.network_stage = None
+        #Datastores come out of the index too, no walking the datacenters
+        self.datacenter = self.index.get(vim.Datacenter)
+        self.datastores = OrderedDict()
+        for datastorename in args.datastores:
+            self.datastores[datastorename] = self.index.get(vim.Datastore, datastorename)
+            if self.datacenter is None or self.datastores[datastorename] is None:
+                print("Could not find the datastore %s" % datastorename)
+                raise SystemExit(-1)
+        self.datastore = self.datastores[args.datastore]
+        self.uploader = Uploader(service_instance, hostname, args.port, verify_cert,
+                                 self.datacenter, self.datastore, args.max_uploads)
+        self.uploaders = OrderedDict((datastorename, self.uploader.for_datastore(datastorename))
+                                     for datastorename in self.datastores)
+        #Node -> datastore its VM lives on (see place_disks()), and datastore
+        #-> base disk for linked mode
+        self.node_datastores = {}
+        self.base_disks = {}
+        self.capacity = None
+        self.journal = Journal(hostname, args.yaml_file)
+
+    def datastore_for(self, switch):
+        return self.node_datastores.get(switch, self.args.datastore)
+
+    def host_capacity(self):
+        if self.capacity is None:
+            self.capacity = host_capacity(self)
+        return self.capacity
+
+@traced('placement')
+def place_disks(ctx, doc, switches, pinned=None):
+    '''
+    Pick the datastore for the VM and disk of each node in switches, into
+    ctx.node_datastores. Nodes are spread so each datastore gets a share in
+    line with its weight from --datastore or, without weights, its free
+    space. A datastore without room for another disk is passed over.
+    pinned has nodes whose disk is already on a datastore; nodes the
+    journal placed stay where they were.
+    '''
+    args = ctx.args
+    journal = ctx.journal
+    if len(ctx.datastores) == 1:
+        ctx.node_datastores.update((switch, args.datastore) for switch in switches)
+        return
+    placed = dict(pinned or {})
+    for switch in switches:
+        entry = journal.done(switch, 'placed')
+        if entry is not None:
+            placed[switch] = entry['datastore']
+
+    #Free space is read once, with the rest of the host's capacity
+    free = dict(ctx.host_capacity()['datastores'])
+    weighted = any(weight is not None for weight in args.datastores.values())
+    weights = dict((datastorename, (weight or 1) if weighted else max(free[datastorename], 1))
+                   for datastorename, weight in args.datastores.items())
+    counts = dict((datastorename, 0) for datastorename in ctx.datastores)
+    for switch, datastorename in placed.items():
+        if datastorename in counts:
+            counts[datastorename] += 1
+
+    new = []
+    for switch in switches:
+        if switch in placed:
+            continue
+        need = node_needs(args, switch, doc[switch])['disk']
+        room = [datastorename for datastorename in ctx.datastores
+                if free[datastorename] >= need] or [max(free, key=free.get)]
+        datastorename = min(room, key=lambda name: (counts[name] + 1) / float(weights[name]))
+        counts[datastorename] += 1
+        free[datastorename] -= need
+        placed[switch] = datastorename
+        new.append(switch)
+    journal.record_all([(switch, 'placed', {'datastore': placed[switch]}) for switch in new])
+    ctx.node_datastores.update((switch, placed[switch]) for switch in switches)
+    print ("Datastores: %s" % ', '.join(
+        '%s %d nodes' % (datastorename, sum(1 for switch in switches
+                                            if placed[switch] == datastorename))
+        for datastorename in ctx.datastores))
+
+@traced('disks')
+def prepare_disks(ctx, switches):
+    '''
+    In seed and linked mode, get the seed onto every datastore that the
+    listed nodes are placed on (see place_disks()) and give the nodes their
+    disks: a copy of the seed, or in linked mode nothing until create_vm()
+    makes the delta disk. In the default mode each node uploads its own
+    disk in build_node().
+    '''
+    args = ctx.args
+    if not (args.seed or args.linked or args.sparse):
+        return
+    journal = ctx.journal
+    switches = [switch for switch in switches if not journal.done(switch, 'vmdk')]
+    if not args.linked and not switches:
+        #Every node has its copy, the seed is not needed
+        return
+    targets = [datastorename for datastorename in ctx.datastores
+               if any(ctx.datastore_for(switch) == datastorename for switch in switches)]
+    seed = journal.done(None, 'seed')
+    seeds = dict(seed['disks']) if seed is not None else {}
+    missing = [datastorename for datastorename in targets if datastorename not in seeds]
+    if missing:
+        seeds.update(seed_datastores(ctx, missing))
+        journal.record(None, 'seed', disks=seeds)
+    if args.linked:
+        ctx.base_disks = seeds
+        return
+    copy_seed(ctx, OrderedDict((switch, ctx.datastore_for(switch)) for switch in switches))
+    journal.record_all([(switch, 'vmdk', {}) for switch in switches])
+
+@traced('network')
+def build_network(ctx, vswitches):
+    '''
+    Put the vSwitches and Port Groups in place with one network update
+    before we start on the VMs.
+    '''
+    journal = ctx.journal
+    vswitches = [vswitch for vswitch in vswitches if not journal.done(vswitch, 'vswitch')]
+    if not vswitches:
+        return
+    try:
+        added = ctx.network_state.apply(vswitches)
+        print ("Added %d vSwitches and Portgroups" % added)
+    except vmodl.MethodFault as e:
+        print ("Batched network update failed (%s). Creating vSwitches one at a time..." % e.msg)
+        ctx.network_state.load()
+        return
+    journal.record_all([(vswitch, 'vswitch', {}) for vswitch in vswitches])
+
+def build_node(ctx, switch, switchintf, upload=True):
+    '''
+    Everything needed to bring up one node: its disk and the VM itself.
+    '''
+    args = ctx.args
+    with tracer.span(switch, phase='build', node=switch, kind='node'):
+        #Push VM, create VM and build/bind Port Groups to VM
+        datastorename = ctx.datastore_for(switch)
+        if upload and not (args.seed or args.linked or args.sparse) and \
+                not ctx.journal.done(switch, 'vmdk'):
+            pushvmdk(ctx.uploaders[datastorename], args.local_file, switch)
+            ctx.journal.record(switch, 'vmdk')
+
+        #Pass switchintf which is a dictionary of interfaces for the vm
+        create_vm(switch, ctx.service_instance, ctx.vmfolder, ctx.resource_pool, datastorename,
+                  switchintf, ctx.base_disks.get(datastorename), ctx.network_stage,
+                  args.stepwise, ctx.index, ctx.network_state, ctx.journal, lab_name(args))
+
+def build_nodes(ctx, doc, switches=None, uploads=None):
+    '''
+    Build the given nodes (all of them by default), args.parallel at a time.
+    uploads is the set of those nodes whose vmdk gets pushed to the
+    datastore first, all of them by default.
+    Nodes don't depend on each other except through host networking, and all
+    vSwitch/port group changes are funneled through a single worker so they
+    are applied in order.
+    '''
+    if switches is None:
+        switches = list(doc.keys())
+    if uploads is None:
+        uploads = set(switches)
+    ctx.network_stage = ThreadPoolExecutor(max_workers=1)
+    pool = ThreadPoolExecutor(max_workers=max(1, ctx.args.parallel))
+    try:
+        futures = [pool.submit(build_node, ctx, switch, doc[switch], switch in uploads)
+                   for switch in switches]
+        #Raise the first failure in yaml order, once everything has stopped
+        pool.shutdown(wait=True)
+        for future in futures:
+            future.result()
+    finally:
+        pool.shutdown(wait=True)
+        ctx.network_stage.shutdown(wait=True)
+        ctx.network_stage = None
+
+
+class HostSnapshot(object):
+    '''
+    What is on the host right now, as far as the yaml file is concerned:
+    each VM with the port groups its NICs are bound to, the host's vSwitches
+    and port groups, and which VM folders on the datastores hold a vEOS
+    disk. It is taken with a few bulk reads so plan_changes() can work
+    without going back to the host. The datastores are only searched if
+    some VM is missing.
+    '''
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.vms = {}
+        self.disks = None
+        self.load_vms()
+        ctx.network_state.load()
+
+    def has_disk(self, switch):
+        return self.disk_datastore(switch) is not None
+
+    def disk_datastore(self, switch):
+        '''
+        The datastore with a vEOS disk in the node's folder, or None.
+        '''
+        if self.disks is None:
+            self.disks = {}
+            self.load_disks()
+        return self.disks.get(switch)
+
+    def load_vms(self):
+        '''
+        VM names, devices and power state in one RetrieveContents call.
+        '''
+        content = self.ctx.service_instance.RetrieveContent()
+        view = content.viewManager.CreateContainerView(content.rootFolder,
+                                                       [vim.VirtualMachine], True)
+        try:
+            traversal = vmodl.query.PropertyCollector.TraversalSpec(
+                name='traverse', path='view', skip=False, type=vim.view.ContainerView)
+            obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+                obj=view, skip=True, selectSet=[traversal])
+            prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+                type=vim.VirtualMachine,
+                pathSet=['name', 'config.hardware.device', 'config.annotation',
+                         'runtime.powerState'])
+            filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec],
+                                                                   propSet=[prop_spec])
+            results = content.propertyCollector.RetrieveContents([filter_spec])
+        finally:
+            view.Destroy()
+
+        for result in results:
+            props = dict((prop.name, prop.val) for prop in result.propSet)
+            nics = [device for device in props.get('config.hardware.device') or []
+                    if isinstance(device, vim.vm.device.VirtualEthernetCard)]
+            nics.sort(key=lambda device: device.key)
+            self.vms[props['name']] = {'vm': result.obj, 'nics': nics,
+                                       'power': props.get('runtime.powerState'),
+                                       'annotation': props.get('config.annotation')}
+            self.ctx.index.add(result.obj, props['name'])
+
+    def load_disks(self):
+        '''
+        Every <folder>/vEOS-lab.vmdk on the datastores, with one search task
+        each, all waited on together.
+        '''
+        search_spec = vim.host.DatastoreBrowser.SearchSpec(matchPattern=['vEOS-lab.vmdk'])
+        tasks = [datastore.browser.SearchDatastoreSubFolders_Task(
+            datastorePath='[%s]' % datastorename, searchSpec=search_spec)
+            for datastorename, datastore in self.ctx.datastores.items()]
+        for datastorename, results in zip(self.ctx.datastores,
+                                          wait_for_tasks(self.ctx.service_instance, tasks)):
+            for result in results or []:
+                folder = result.folderPath.split(']', 1)[-1].strip().strip('/')
+                if any(f.path == 'vEOS-lab.vmdk' for f in result.file or []):
+                    self.disks.setdefault(folder, datastorename)
+
+
+@traced('plan')
+def plan_changes(ctx, doc, snapshot):
+    '''
+    Diff the yaml file against a HostSnapshot. Returns the vSwitches to add
+    and an ordered dict of node name -> list of actions, where an action is
+    one of:
+        ('upload', None)               node needs its disk
+        ('create', None)               node's VM is missing
+        ('add_nic', pgname)            VM is missing a NIC
+        ('rebind_nic', (nic, pgname))  NIC is on the wrong port group
+        ('tag', annotation)            VM is not tagged for the lab, see
+                                       node_annotation()
+    Nodes with nothing to do are left out.
+    '''
+    args = ctx.args
+    vswitches = topology_vswitches(doc)
+    missing_vswitches, missing_portgroups = ctx.network_state.missing(vswitches)
+    network = [vswitchname for vswitchname in vswitches
+               if vswitchname in missing_vswitches or vswitchname in missing_portgroups]
+
+    nodes = OrderedDict()
+    for switch in doc.keys():
+        actions = []
+        wanted = [vswitchname + '-PG' for intname, vswitchname in
+                  vm_interfaces(switch, doc[switch], verbose=False)]
+        existing = snapshot.vms.get(switch)
+        if existing is None:
+            if not args.linked and not snapshot.has_disk(switch):
+                actions.append(('upload', None))
+            actions.append(('create', None))
+        else:
+            nics = existing['nics']
+            for position, pgname in enumerate(wanted):
+                if position >= len(nics):
+                    actions.append(('add_nic', pgname))
+                elif getattr(nics[position].backing, 'deviceName', None) != pgname:
+                    actions.append(('rebind_nic', (nics[position], pgname)))
+            if len(nics) > len(wanted):
+                print ("VM %s has %d NICs that are not in the yaml file. Leaving them alone."
+                       % (switch, len(nics) - len(wanted)))
+            annotation = node_annotation(lab_name(args), doc[switch])
+            if (existing.get('annotation') or '') != annotation:
+                actions.append(('tag', annotation))
+        if actions:
+            nodes[switch] = actions
+    return network, nodes
+
+def nic_label(nic):
+    if nic.deviceInfo is not None and nic.deviceInfo.label:
+        return nic.deviceInfo.label
+    return 'NIC %d' % nic.key
+
+def print_plan(network, nodes):
+    if not network and not nodes:
+        print ("Host matches the yaml file. Nothing to do.")
+        return
+    for vswitchname in network:
+        print ("+ vSwitch/Portgroup %s" % vswitchname)
+    for switch, actions in nodes.items():
+        for action, detail in actions:
+            if action == 'upload':
+                print ("+ %s: disk" % switch)
+            elif action == 'create':
+                print ("+ %s: VM" % switch)
+            elif action == 'add_nic':
+                print ("+ %s: NIC on %s" % (switch, detail))
+            elif action == 'tag':
+                print ("~ %s: lab tag" % switch)
+            elif action == 'rebind_nic':
+                nic, pgname = detail
+                print ("~ %s: %s from %s to %s" % (switch, nic_label(nic),
+                                                   getattr(nic.backing, 'deviceName', None),
+                                                   pgname))
+
+@traced('apply')
+def apply_plan(ctx, doc, snapshot, network, nodes):
+    '''
+    Carry out what plan_changes() found, and nothing else.
+    '''
+    if network:
+        build_network(ctx, network)
+
+    #Missing VMs go through the normal build, disks only where they are missing
+    creates = [switch for switch, actions in nodes.items() if ('create', None) in actions]
+    uploads = [switch for switch, actions in nodes.items() if ('upload', None) in actions]
+    if creates:
+        #A disk left in a VM folder is used where it is
+        pinned = {}
+        if not ctx.args.linked:
+            pinned = dict((switch, snapshot.disk_datastore(switch)) for switch in creates
+                          if switch not in uploads)
+        place_disks(ctx, doc, creates, pinned)
+        prepare_disks(ctx, creates if ctx.args.linked else uploads)
+        build_nodes(ctx, doc, creates, set(uploads))
+
+    #Existing VMs get one reconfigure each, all waited on together
+    host = ctx.index.get(vim.HostSystem)
+    tasks = []
+    for switch, actions in nodes.items():
+        dev_changes = []
+        annotation = None
+        for action, detail in actions:
+            if action == 'add_nic':
+                print ("Adding NIC on %s to %s" % (detail, switch))
+                dev_changes.append(nic_spec(ctx.index.network(host, detail),
+                                            node_profile(switch, doc[switch])['nic']))
+            elif action == 'rebind_nic':
+                nic, pgname = detail
+                print ("Rebinding %s on %s to %s" % (nic_label(nic), switch, pgname))
+                nic_obj = ctx.index.network(host, pgname)
+                nic.backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
+                nic.backing.network = nic_obj
+                nic.backing.deviceName = nic_obj.name
+                change = vim.vm.device.VirtualDeviceSpec()
+                change.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
+                change.device = nic
+                dev_changes.append(change)
+            elif action == 'tag':
+                annotation = detail
+        if dev_changes or annotation is not None:
+            spec = vim.vm.ConfigSpec(deviceChange=dev_changes, annotation=annotation)
+            tasks.append(snapshot.vms[switch]['vm'].ReconfigVM_Task(spec=spec))
+    if tasks:
+        wait_for_tasks(ctx.service_instance, tasks)
+
+
+#Spreading a lab over several hosts
+VCPUS_PER_CORE = 4
+LINKED_DISK_BYTES = 512 * 2**20
+
+class PlacementError(Exception):
+    pass
+
+
+class CrossHostFabric(object):
+    '''
+    How one host of a multi-host lab lays out its links. Links with nodes
+    on other hosts go onto the uplink vSwitch as VLAN port groups, with the
+    same VLAN on every host (uplink is shared by all of them). The rest are
+    built as on a single host, on the local fabric if there is one and on a
+    vSwitch of their own if not.
+    '''
+    def __init__(self, uplink, crosslinks, local=None):
+        self.uplink = uplink
+        self.crosslinks = crosslinks
+        self.local = local
+
+    def sync(self, portgroups):
+        self.uplink.sync(portgroups)
+        if self.local is not None:
+            self.local.sync(portgroups)
+
+    def assign(self, link):
+        if link in self.crosslinks:
+            return self.uplink.assign(link)
+        if self.local is not None:
+            return self.local.assign(link)
+        return link, 4095
+
+    def vswitch_spec(self, vswitchname):
+        if self.uplink.owns(vswitchname):
+            return self.uplink.vswitch_spec(vswitchname)
+        if self.local is not None:
+            return self.local.vswitch_spec(vswitchname)
+        return vswitch_spec()
+
+    def save(self):
+        self.uplink.save()
+        if self.local is not None:
+            self.local.save()
+
+
+@traced('placement')
+def host_capacity(ctx):
+    '''
+    What is left on the host for new nodes, read in a single
+    RetrieveContents: memory (MB) not used by running VMs or promised to
+    powered off ones, vCPUs at VCPUS_PER_CORE per core less those of all
+    VMs, and free space on the datastores, in all ('disk') and for each
+    one ('datastores').
+    '''
+    host = ctx.index.get(vim.HostSystem)
+    collector = ctx.service_instance.content.propertyCollector
+    PC = vmodl.query.PropertyCollector
+    filter_spec = PC.FilterSpec(
+        objectSet=[PC.ObjectSpec(obj=host, skip=False,
+                                 selectSet=[PC.TraversalSpec(name='vms', type=vim.HostSystem,
+                                                             path='vm', skip=False)])] +
+                  [PC.ObjectSpec(obj=datastore, skip=False)
+                   for datastore in ctx.datastores.values()],
+        propSet=[PC.PropertySpec(type=vim.HostSystem,
+                                 pathSet=['summary.hardware', 'summary.quickStats']),
+                 PC.PropertySpec(type=vim.VirtualMachine,
+                                 pathSet=['summary.config', 'runtime.powerState']),
+                 PC.PropertySpec(type=vim.Datastore, pathSet=['name', 'summary.freeSpace'])])
+    memory = vcpus = disk = 0
+    datastores = OrderedDict((datastorename, 0) for datastorename in ctx.datastores)
+    for content in collector.RetrieveContents([filter_spec]):
+        props = dict((prop.name, prop.val) for prop in content.propSet or [])
+        if isinstance(content.obj, vim.HostSystem):
+            hardware = props['summary.hardware']
+            memory += hardware.memorySize // 2**20 - \
+                (props['summary.quickStats'].overallMemoryUsage or 0)
+            vcpus += hardware.numCpuCores * VCPUS_PER_CORE
+        elif isinstance(content.obj, vim.VirtualMachine):
+            config = props.get('summary.config')
+            if config is None:
+                continue
+            vcpus -= config.numCpu or 0
+            if props.get('runtime.powerState') != vim.VirtualMachine.PowerState.poweredOn:
+                memory -= config.memorySizeMB or 0
+        elif isinstance(content.obj, vim.Datastore):
+            datastores[props['name']] = props['summary.freeSpace']
+            disk += props['summary.freeSpace']
+    return {'memory': memory, 'vcpus': vcpus, 'disk': disk, 'datastores': datastores}
+
+def node_needs(args, switch, switchintf):
+    '''
+    What a node takes from a host: memory (MB), vCPUs and datastore space.
+    '''
+    disk = LINKED_DISK_BYTES if args.linked else os.path.getsize(args.local_file)
+    profile = node_profile(switch, switchintf)
+    return {'memory': profile['memory'], 'vcpus': profile['cpus'], 'disk': disk}
+
+def link_members(doc):
+    '''
+    The nodes on each link, in yaml order.
+    '''
+    members = OrderedDict()
+    for switch in doc.keys():
+        for intname, link in vm_interfaces(switch, doc[switch], verbose=False):
+            if switch not in members.setdefault(link, []):
+                members[link].append(switch)
+    return members
+
+def place_nodes(doc, capacities, needs, pinned=None, overcommit=False):
+    '''
+    Decide which host each node goes on. capacities is an OrderedDict of
+    host -> free resources (see host_capacity()), needs is node -> the
+    same (see node_needs()) and pinned has nodes that already live on a
+    host. Returns an OrderedDict of node -> host in yaml order.
+
+    Nodes are taken in breadth-first order over the link graph, so linked
+    nodes come one after the other, and each goes on the host where most of
+    its already placed neighbours are. Ties go to the first host in the
+    list with room, which packs hosts in order rather than spreading nodes
+    thin. A link shared by many nodes (like the management network) counts
+    for less than a point to point link. Raises PlacementError if a node
+    fits nowhere, unless overcommit is set, in which case it goes on the
+    host with the most memory left.
+    '''
+    free = OrderedDict((host, dict(capacity)) for host, capacity in capacities.items())
+    #Nodes that exist are already counted in what the host has free
+    placement = dict(pinned or {})
+
+    neighbours = dict((switch, {}) for switch in doc.keys())
+    for link, members in link_members(doc).items():
+        if len(members) < 2:
+            continue
+        weight = 1.0 / (len(members) - 1)
+        for switch in members:
+            for other in members:
+                if other != switch:
+                    neighbours[switch][other] = neighbours[switch].get(other, 0) + weight
+
+    #Breadth first, heaviest links first, starting each connected group from
+    #its best connected node
+    order = []
+    seen = set()
+    remaining = sorted(doc.keys(), key=lambda switch: -sum(neighbours[switch].values()))
+    for start in remaining:
+        if start in seen:
+            continue
+        seen.add(start)
+        queue = [start]
+        while queue:
+            switch = queue.pop(0)
+            order.append(switch)
+            for other, weight in sorted(neighbours[switch].items(), key=lambda item: -item[1]):
+                if other not in seen:
+                    seen.add(other)
+                    queue.append(other)
+
+    for switch in order:
+        if switch in placement:
+            continue
+        best = None
+        for position, host in enumerate(free):
+            if any(free[host][resource] < amount
+                   for resource, amount in needs[switch].items()):
+                continue
+            affinity = sum(weight for other, weight in neighbours[switch].items()
+                           if placement.get(other) == host)
+            if best is None or affinity > best[0]:
+                best = (affinity, host)
+        if best is None and overcommit:
+            best = (0, max(free, key=lambda host: free[host]['memory']))
+        if best is None:
+            raise PlacementError("Node %s (%d MB, %d vCPU) does not fit on any host. "
+                                 "Use --overcommit to place it anyway" % (
+                                     switch, needs[switch]['memory'], needs[switch]['vcpus']))
+        placement[switch] = best[1]
+        for resource, amount in needs[switch].items():
+            free[best[1]][resource] -= amount
+    return OrderedDict((switch, placement[switch]) for switch in doc.keys())
+
+def cross_host_links(doc, placement):
+    '''
+    Links whose nodes are on more than one host.
+    '''
+    return set(link for link, members in link_members(doc).items()
+               if len(set(placement[switch] for switch in members)) > 1)
+
+def uplink_fabric(args, contexts):
+    '''
+    The VLAN allocator for links between the hosts, one per set of hosts.
+    '''
+    return VlanFabric('uplink-' + '-'.join(sorted(contexts)), ports=4088,
+                      prefix=args.uplink_vswitch, pool=False, nic=args.uplink_nic)
+
+def release_uplink(args, contexts, doc):
+    '''
+    Give up the uplink VLANs of the lab's links once it is gone from all
+    the hosts, so build and destroy cycles don't use up the VLANs.
+    '''
+    uplink = uplink_fabric(args, contexts)
+    uplink.release(link_members(doc))
+    uplink.save()
+
+def place_lab(args, contexts, doc):
+    '''
+    Place the nodes on the hosts and set each host's networking up for the
+    links that cross to other hosts. Returns node -> host.
+    '''
+    pinned = {}
+    for hostname, ctx in contexts.items():
+        for switch in doc.keys():
+            if ctx.index.get(vim.VirtualMachine, switch) is not None:
+                pinned[switch] = hostname
+    capacities = OrderedDict((hostname, ctx.host_capacity())
+                             for hostname, ctx in contexts.items())
+    needs = dict((switch, node_needs(args, switch, doc[switch])) for switch in doc.keys())
+    placement = place_nodes(doc, capacities, needs, pinned, args.overcommit)
+    crosslinks = cross_host_links(doc, placement)
+
+    for hostname in contexts:
+        switches = [switch for switch in placement if placement[switch] == hostname]
+        print ("Host %s: %d nodes (%d MB free)" % (hostname, len(switches),
+                                                 capacities[hostname]['memory']))
+    print ("%d links span hosts" % len(crosslinks))
+
+    if crosslinks:
+        uplink = uplink_fabric(args, contexts)
+        uplink.count_ports(doc)
+        members = link_members(doc)
+        for hostname, ctx in contexts.items():
+            ctx.network_state.fabric = CrossHostFabric(uplink, crosslinks, ctx.fabric)
+            ctx.network_state.load()
+            uses_uplink = any(placement[switch] == hostname
+                              for link in crosslinks for switch in members[link])
+            if uses_uplink and not args.uplink_nic and \
+                    not ctx.network_state.vswitch_exists(args.uplink_vswitch):
+                raise PlacementError("Host %s has no vSwitch %s for links to other hosts. "
+                                     "Create one with an uplink trunking VLANs %d-%d or "
+                                     "give --uplink_nic" % ((hostname, args.uplink_vswitch) +
+                                                            FABRIC_VLANS))
+        #Settle the VLANs up front so the hosts agree whatever order they build in
+        for link in sorted(crosslinks):
+            uplink.assign(link)
+    return placement
+
+def host_docs(doc, placement, contexts):
+    '''
+    Split the topology into one per host.
+    '''
+    return OrderedDict((hostname, OrderedDict((switch, doc[switch]) for switch in doc.keys()
+                                              if placement[switch] == hostname))
+                       for hostname in contexts)
+
+def for_each_host(contexts, func):
+    '''
+    Run func(hostname, ctx) for every host at the same time, raising the
+    first failure once all of them have finished.
+    '''
+    pool = ThreadPoolExecutor(max_workers=len(contexts))
+    try:
+        futures = [pool.submit(func, hostname, ctx) for hostname, ctx in contexts.items()]
+        pool.shutdown(wait=True)
+        return [future.result() for future in futures]
+    finally:
+        pool.shutdown(wait=True)
+
+def build_lab(ctx, doc):
+    '''
+    Build the nodes in doc on the host from scratch, or with --resume
+    finish the build the journal says was cut short.
+    '''
+    journal = ctx.journal
+    picked_up = journal.open(journal_options(ctx.args), ctx.args.resume)
+    try:
+        switches = [switch for switch in doc.keys() if not journal.done(switch, 'nics')]
+        if picked_up:
+            print ("Resuming from %s: %d of %d nodes already built" % (
+                journal.path, len(doc) - len(switches), len(doc)))
+        if not switches:
+            return
+        place_disks(ctx, doc, switches)
+        prepare_disks(ctx, switches)
+        build_network(ctx, topology_vswitches(doc))
+        build_nodes(ctx, doc, switches)
+    finally:
+        journal.close()
+
+
+#Admission control and power-on
+class CapacityError(Exception):
+    pass
+
+
+def check_capacity(ctx, doc):
+    '''
+    Compare what the nodes in doc that don't exist yet need with what the
+    host has free (see host_capacity()). Prints the totals and returns the
+    resources that would be overcommitted.
+    '''
+    args = ctx.args
+    new = [switch for switch in doc.keys()
+           if ctx.index.get(vim.VirtualMachine, switch) is None]
+    capacity = ctx.host_capacity()
+    needed = {'memory': 0, 'vcpus': 0, 'disk': 0}
+    for switch in new:
+        for resource, amount in node_needs(args, switch, doc[switch]).items():
+            needed[resource] += amount
+    print ("Host %s: %d new nodes need %d MB of %d MB free memory, %d of %d vCPUs, "
+           "%d of %d GB disk" % (ctx.hostname, len(new),
+                                 needed['memory'], capacity['memory'],
+                                 needed['vcpus'], capacity['vcpus'],
+                                 needed['disk'] // 2**30, capacity['disk'] // 2**30))
+    return [resource for resource in ('memory', 'vcpus', 'disk')
+            if needed[resource] > capacity[resource]]
+
+def admit(contexts, docs, enforce=True):
+    '''
+    Run check_capacity() on every host. Overcommitting is an error unless
+    --overcommit was given (or enforce is False), then it is a warning.
+    '''
+    for hostname, ctx in contexts.items():
+        over = check_capacity(ctx, docs[hostname])
+        if not over:
+            continue
+        message = "Host %s does not have enough %s for the lab" % (hostname, ' or '.join(over))
+        if enforce and not ctx.args.overcommit:
+            raise CapacityError(message + ". Use --overcommit to build anyway")
+        print ("WARNING: " + message)
+
+def guests_ready(si, vms):
+    '''
+    Of the given VMs, the ones whose guest has a heartbeat or VMware tools
+    running, read in one call.
+    '''
+    PC = vmodl.query.PropertyCollector
+    filter_spec = PC.FilterSpec(
+        objectSet=[PC.ObjectSpec(obj=vm, skip=False) for vm in vms],
+        propSet=[PC.PropertySpec(type=vim.VirtualMachine,
+                                 pathSet=['guestHeartbeatStatus', 'guest.toolsRunningStatus'])])
+    ready = set()
+    for content in si.content.propertyCollector.RetrieveContents([filter_spec]):
+        props = dict((prop.name, prop.val) for prop in content.propSet or [])
+        if props.get('guestHeartbeatStatus') == 'green' or \
+                props.get('guest.toolsRunningStatus') == 'guestToolsRunning':
+            ready.add(str(content.obj))
+    return ready
+
+@traced('power')
+def power_on(ctx, doc, poll=5):
+    '''
+    Power on the nodes in doc that are off, in yaml order and wave_size at a
+    time. Each wave waits until its guests are up (see guests_ready()) or
+    boot_timeout runs out before the next one starts, so only a wave's worth
+    of VMs is booting at once.
+    '''
+    args = ctx.args
+    si = ctx.service_instance
+    vms = OrderedDict()
+    for switch in doc.keys():
+        vm = ctx.index.get(vim.VirtualMachine, switch)
+        if vm is not None:
+            vms[switch] = vm
+    if not vms:
+        return
+    PC = vmodl.query.PropertyCollector
+    filter_spec = PC.FilterSpec(
+        objectSet=[PC.ObjectSpec(obj=vm, skip=False) for vm in vms.values()],
+        propSet=[PC.PropertySpec(type=vim.VirtualMachine, pathSet=['runtime.powerState'])])
+    powered_on = set(str(content.obj) for content in
+                     si.content.propertyCollector.RetrieveContents([filter_spec])
+                     if content.propSet and content.propSet[0].val ==
+                     vim.VirtualMachine.PowerState.poweredOn)
+    off = [switch for switch in vms if str(vms[switch]) not in powered_on]
+    wave_size = max(args.wave_size, 1)
+    for start in range(0, len(off), wave_size):
+        wave = off[start:start + wave_size]
+        print ("Powering on %s" % ', '.join(wave))
+        wait_for_tasks(si, [vms[switch].PowerOnVM_Task() for switch in wave])
+        deadline = time.time() + args.boot_timeout
+        waiting = dict((str(vms[switch]), switch) for switch in wave)
+        while waiting:
+            for key in guests_ready(si, [vms[waiting[key]] for key in waiting]):
+                del waiting[key]
+            if not waiting or time.time() >= deadline:
+                break
+            time.sleep(min(poll, max(deadline - time.time(), 0)))
+        if waiting:
+            print ("Timed out waiting for %s to boot. Carrying on." %
+                   ', '.join(sorted(waiting.values())))
+
+#Tearing a lab down
+def wait_ignoring(si, tasks, faults):
+    '''
+    Wait for all the tasks in one go like wait_for_tasks(), but let tasks
+    that fail with one of the given fault types go.
+    '''
+    futures = task_monitor(si).submit(tasks)
+    futures_wait(futures)
+    for future in futures:
+        try:
+            future.result()
+        except faults:
+            pass
+
+@traced('destroy')
+def destroy_lab(ctx, doc, orphans=True):
+    '''
+    Remove the nodes in doc from the host: power off the ones that are on,
+    destroy the VMs and delete their datastore folders, each step as one
+    batch of tasks waited on together. Then remove the lab's port groups
+    that no VM left on the host uses, and the vSwitches that leaves empty,
+    in one network update. vSwitches that weren't the script's (the uplink
+    vSwitch, vSwitch0, ...) are never removed, nor is any vSwitch bridged to
+    a physical NIC (a management network the user set up, say), and neither
+    is the seed. With orphans the folders of nodes without a VM are deleted
+    as well.
+    '''
+    args = ctx.args
+    si = ctx.service_instance
+    snapshot = HostSnapshot(ctx)
+    network_state = ctx.network_state
+    doomed = [switch for switch in doc.keys() if switch in snapshot.vms]
+
+    links = topology_vswitches(doc)
+    in_use = set()
+    for name, vm in snapshot.vms.items():
+        if name not in doomed:
+            in_use.update(getattr(nic.backing, 'deviceName', None) for nic in vm['nics'])
+    pgnames = [link + '-PG' for link in links
+               if network_state.portgroup_exists(link + '-PG') and link + '-PG' not in in_use]
+    left = {}
+    for pgname, vswitchname in network_state.portgroup_vswitch.items():
+        if pgname not in pgnames:
+            left[vswitchname] = left.get(vswitchname, 0) + 1
+    ours = lambda vswitchname: not network_state.has_uplink(vswitchname) and \
+        (vswitchname in links or (ctx.fabric is not None and ctx.fabric.owns(vswitchname)))
+    vswitchnames = sorted(set(network_state.portgroup_vswitch[pgname] for pgname in pgnames
+                              if ours(network_state.portgroup_vswitch[pgname]) and
+                              not left.get(network_state.portgroup_vswitch[pgname])))
+
+    for switch in doomed:
+        print ("- %s: VM" % switch)
+    for pgname in pgnames:
+        print ("- Portgroup %s" % pgname)
+    for vswitchname in vswitchnames:
+        print ("- vSwitch %s" % vswitchname)
+    if args.plan:
+        return
+
+    vms = [snapshot.vms[switch]['vm'] for switch in doomed]
+    running = [snapshot.vms[switch]['vm'] for switch in doomed
+               if snapshot.vms[switch]['power'] != vim.VirtualMachine.PowerState.poweredOff]
+    if running:
+        print ("Powering off %d VMs..." % len(running))
+        wait_ignoring(si, [vm.PowerOffVM_Task() for vm in running], vim.fault.InvalidPowerState)
+    if vms:
+        print ("Destroying %d VMs..." % len(vms))
+        wait_for_tasks(si, [vm.Destroy_Task() for vm in vms])
+        for switch in doomed:
+            ctx.index.remove(snapshot.vms[switch]['vm'], switch)
+
+    #Folders are left behind by builds that failed before the VM was made,
+    #or hold files the VM didn't own. Without orphans only the folders of
+    #VMs removed here go, in case the datastore is shared with other hosts.
+    file_manager = si.content.fileManager
+    folders = [switch for switch in (doc.keys() if orphans else doomed)
+               if switch != args.seed_folder and not ctx.index.get(vim.VirtualMachine, switch)]
+    if folders:
+        #Without a record of where each node went, look on every datastore
+        print ("Deleting %d datastore folders..." % len(folders))
+        wait_ignoring(si, [file_manager.DeleteDatastoreFile_Task(
+            name='[%s] %s' % (datastorename, switch), datacenter=ctx.datacenter)
+            for switch in folders for datastorename in ctx.datastores],
+            vim.fault.FileNotFound)
+
+    if pgnames or vswitchnames:
+        print ("Removing %d port groups and %d vSwitches..." % (len(pgnames), len(vswitchnames)))
+        network_state.remove(pgnames, vswitchnames)
+        if ctx.fabric is not None:
+            ctx.fabric.release(pgname[:-len('-PG')] for pgname in pgnames)
+            ctx.fabric.save()
+    #Nothing left to resume
+    ctx.journal.clear()
+
+#Exporting and diffing labs
+class SnapshotError(Exception):
+    pass
+
+#Link names that yaml reads back as the same string without quotes
+PLAIN_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_./-]*$')
+YAML_WORDS = ('y', 'n', 'yes', 'no', 'true', 'false', 'on', 'off', 'null')
+
+def yaml_scalar(value):
+    if isinstance(value, int):
+        return str(value)
+    value = str(value)
+    if PLAIN_RE.match(value) and value.lower() not in YAML_WORDS:
+        return value
+    return json.dumps(value)
+
+@traced('export')
+def collect_labs(service_instance, hostname, labs=None):
+    '''
+    Every tagged lab VM on the host, with its settings and NICs and the port
+    groups and vSwitches they are on, from a single RetrieveContents: the
+    host's network config and, following host -> vm, every VM's properties,
+    however many VMs there are. With labs, only those labs. Returns
+    lab -> node -> entry, see export_labs() for the entry.
+    '''
+    PC = vmodl.query.PropertyCollector
+    content = service_instance.RetrieveContent()
+    view = content.viewManager.CreateContainerView(content.rootFolder, [vim.HostSystem], True)
+    try:
+        to_vms = PC.TraversalSpec(name='vms', path='vm', skip=False, type=vim.HostSystem)
+        traversal = PC.TraversalSpec(name='traverse', path='view', skip=False,
+                                     type=vim.view.ContainerView, selectSet=[to_vms])
+        obj_spec = PC.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+        host_props = PC.PropertySpec(type=vim.HostSystem,
+                                     pathSet=['config.network.vswitch',
+                                              'config.network.portgroup'])
+        vm_props = PC.PropertySpec(type=vim.VirtualMachine,
+                                   pathSet=['name', 'config.annotation', 'config.version',
+                                            'config.hardware', 'config.cpuAllocation',
+                                            'config.memoryAllocation',
+                                            'config.memoryReservationLockedToMax',
+                                            'config.latencySensitivity',
+                                            'config.files.vmPathName', 'runtime.powerState'])
+        results = content.propertyCollector.RetrieveContents(
+            [PC.FilterSpec(objectSet=[obj_spec], propSet=[host_props, vm_props])])
+    finally:
+        view.Destroy()
+
+    portgroups = {}     # name -> (vSwitch, VLAN)
+    for result in results:
+        if isinstance(result.obj, vim.HostSystem):
+            for prop in result.propSet:
+                if prop.name == 'config.network.portgroup':
+                    for pg in prop.val or []:
+                        portgroups[pg.spec.name] = (pg.spec.vswitchName, pg.spec.vlanId)
+    nic_names = dict((nictype, name) for name, nictype in NIC_TYPES.items())
+
+    found = OrderedDict()
+    for result in results:
+        if not isinstance(result.obj, vim.VirtualMachine):
+            continue
+        props = dict((prop.name, prop.val) for prop in result.propSet)
+        tag = parse_annotation(props.get('config.annotation'))
+        if tag is None or (labs and tag[LAB_TAG] not in labs):
+            continue
+        hardware = props['config.hardware']
+        nics = sorted([device for device in hardware.device or []
+                       if isinstance(device, vim.vm.device.VirtualEthernetCard)],
+                      key=lambda device: device.key)
+        version = str(props.get('config.version') or '')
+        memory_allocation = props.get('config.memoryAllocation')
+        settings = OrderedDict()
+        if 'description' in tag:
+            settings['description'] = tag['description']
+        settings['nic'] = nic_names.get(type(nics[0]) if nics else None, NODE_DEFAULTS['nic'])
+        settings['hardware_version'] = int(version[len('vmx-'):]) \
+            if version.startswith('vmx-') and version[len('vmx-'):].isdigit() \
+            else NODE_DEFAULTS['hardware_version']
+        settings['cpus'] = hardware.numCPU
+        settings['memory'] = hardware.memoryMB
+        settings['cpu_reservation'] = getattr(props.get('config.cpuAllocation'),
+                                              'reservation', None) or 0
+        settings['memory_reservation'] = 'all' \
+            if props.get('config.memoryReservationLockedToMax') \
+            else getattr(memory_allocation, 'reservation', None) or 0
+        settings['latency_sensitivity'] = getattr(props.get('config.latencySensitivity'),
+                                                  'level', None) or 'normal'
+        interfaces = []
+        for number, nic in enumerate(nics):
+            pgname = getattr(nic.backing, 'deviceName', None) or ''
+            vswitchname, vlan = portgroups.get(pgname, (None, None))
+            interfaces.append(['Ma1' if number == 0 else 'E%d' % number,
+                               pgname[:-len('-PG')] if pgname.endswith('-PG') else pgname,
+                               vswitchname, vlan])
+        path = props.get('config.files.vmPathName') or ''
+        found.setdefault(tag[LAB_TAG], OrderedDict())[props['name']] = OrderedDict([
+            ('host', hostname),
+            ('moid', result.obj._moId),
+            ('power', str(props.get('runtime.powerState'))),
+            ('datastore', path[1:path.index(']')] if path.startswith('[') else None),
+            ('settings', settings),
+            ('nics', interfaces),
+        ])
+    return found
+
+def lab_topology(nodes):
+    '''
+    The yaml for exported nodes: each node's description and the settings
+    that aren't the defaults, then its interfaces. Returns the nodes and the
+    links for shared:, the ones that don't have two ends.
+    '''
+    topology = OrderedDict()
+    ends = OrderedDict()
+    management = set()
+    for switch, entry in nodes.items():
+        node = OrderedDict()
+        for key, value in entry['settings'].items():
+            if key == 'description' or value != NODE_DEFAULTS[key]:
+                node[key] = value
+        for intname, link, vswitchname, vlan in entry['nics']:
+            node[intname] = link
+            if intname == 'Ma1':
+                management.add(link)
+            else:
+                ends[link] = ends.get(link, 0) + 1
+        topology[switch] = node
+    shared = [link for link, count in ends.items() if count != 2 and link not in management]
+    return topology, shared
+
+def write_topology(path, topology, shared, comment):
+    #Block style like example.yaml, which a yaml dumper doesn't do for
+    #OrderedDict
+    with open(path, 'w') as fh:
+        fh.write('#%s\n' % comment)
+        if shared:
+            fh.write('shared:\n')
+            for link in shared:
+                fh.write('    - %s\n' % yaml_scalar(link))
+            fh.write('\n')
+        for switch, node in topology.items():
+            fh.write('%s:\n' % yaml_scalar(switch))
+            for key, value in node.items():
+                fh.write('    %s: %s\n' % (key, yaml_scalar(value)))
+            fh.write('\n')
+
+def export_labs(args, service_instances):
+    '''
+    Write the tagged labs on the hosts out to args.export: <lab>.yaml for
+    each lab, which builds the lab as it is now, and index.json with
+    everything collected, in compact form for fast loading by --diff:
+
+        {"version": 1, "hosts": [...], "time": ...,
+         "labs": {lab: {node: {"host", "moid", "power", "datastore",
+                               "settings": {...},
+                               "nics": [[interface, link, vSwitch, VLAN], ...]}}}}
+    '''
+    labs = OrderedDict()
+    wanted = [args.lab] if args.lab else None
+    for found in for_each_host(service_instances,
+                               lambda hostname, si: collect_labs(si, hostname, wanted)):
+        for lab, nodes in found.items():
+            labs.setdefault(lab, OrderedDict()).update(nodes)
+    for lab in labs:
+        labs[lab] = OrderedDict(sorted(labs[lab].items()))
+    labs = OrderedDict(sorted(labs.items()))
+
+    if not os.path.isdir(args.export):
+        os.makedirs(args.export)
+    stamp = time.strftime('%Y-%m-%d %H:%M:%S')
+    for lab, nodes in labs.items():
+        topology, shared = lab_topology(nodes)
+        path = os.path.join(args.export, re.sub(r'[^A-Za-z0-9_.-]', '_', lab) + '.yaml')
+        write_topology(path, topology, shared, 'Lab %s exported from %s at %s' % (
+            lab, ', '.join(service_instances), stamp))
+        print ("Lab %s: %d nodes -> %s" % (lab, len(nodes), path))
+    if not labs:
+        print ("No eosgenlab labs found")
+    index = OrderedDict([('version', 1), ('hosts', list(service_instances)),
+                         ('time', int(time.time())), ('labs', labs)])
+    with open(os.path.join(args.export, 'index.json'), 'w') as fh:
+        json.dump(index, fh, separators=(',', ':'))
+
+def load_snapshot(path, args):
+    '''
+    Read one side of a diff: an index.json from --export, or a yaml file,
+    compiled so generate: and profiles count, which stands for the lab named
+    by --lab or after the file. Returns lab -> {'nodes': node -> {'settings',
+    'interfaces', and from an export 'host' and 'datastore'}, 'links':
+    link -> (vSwitch, VLAN) from an export, None from yaml}.
+    '''
+    if path.endswith('.json'):
+        try:
+            with open(path, 'r') as fh:
+                index = json.load(fh)
+            labs = index['labs']
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            raise SnapshotError("%s is not an index.json from --export: %s" % (path, e))
+        #Plain dicts, which keep the file's order on python 3: this is the
+        #slow part of diffing big fleets
+        snapshot = OrderedDict()
+        for lab in sorted(labs):
+            links = {}
+            nodes = labs[lab]
+            for entry in nodes.values():
+                entry['settings'].setdefault('description', None)
+                entry['interfaces'] = dict((nic[0], nic[1]) for nic in entry['nics'])
+                for intname, link, vswitchname, vlan in entry['nics']:
+                    links[link] = (vswitchname, vlan)
+            snapshot[lab] = {'nodes': nodes, 'links': links}
+        return snapshot
+
+    try:
+        doc = load_topology(path)
+    except (IOError, TopologyError) as e:
+        raise SnapshotError("%s has problems:\n    %s" % (
+            path, '\n    '.join(getattr(e, 'problems', None) or [str(e)])))
+    lab_nodes = OrderedDict()
+    for switch, switchintf in doc.items():
+        settings = OrderedDict([('description', None)])
+        if switchintf.get('description') is not None:
+            settings['description'] = str(switchintf['description'])
+        settings.update(node_profile(switch, switchintf))
+        interfaces = OrderedDict((key, value) for key, value in switchintf.items()
+                                 if parse_interface(key) is not None)
+        lab_nodes[switch] = {'settings': settings, 'interfaces': interfaces}
+    lab = args.lab or os.path.splitext(os.path.basename(path))[0]
+    return OrderedDict([(lab, {'nodes': lab_nodes, 'links': None})])
+
+def diff_lab(old, new):
+    '''
+    What changed from one lab to the other, as lines like --plan prints.
+    One pass over each side's nodes and links, all dict lookups.
+    '''
+    lines = []
+    old_nodes, new_nodes = old['nodes'], new['nodes']
+    for switch in old_nodes:
+        if switch not in new_nodes:
+            lines.append("- %s" % switch)
+    for switch, b in new_nodes.items():
+        if switch not in old_nodes:
+            lines.append("+ %s" % switch)
+            continue
+        a = old_nodes[switch]
+        if a['settings'] == b['settings'] and a['interfaces'] == b['interfaces'] and \
+                a.get('host') == b.get('host') and a.get('datastore') == b.get('datastore'):
+            continue
+        for key, value in b['settings'].items():
+            if a['settings'].get(key) != value:
+                lines.append("~ %s: %s %s -> %s" % (switch, key, a['settings'].get(key), value))
+        for key in ('host', 'datastore'):
+            if a.get(key) and b.get(key) and a[key] != b[key]:
+                lines.append("~ %s: %s %s -> %s" % (switch, key, a[key], b[key]))
+        for intname, link in a['interfaces'].items():
+            if intname not in b['interfaces']:
+                lines.append("- %s: %s on %s" % (switch, intname, link))
+            elif b['interfaces'][intname] != link:
+                lines.append("~ %s: %s from %s to %s" % (switch, intname, link,
+                                                         b['interfaces'][intname]))
+        for intname, link in b['interfaces'].items():
+            if intname not in a['interfaces']:
+                lines.append("+ %s: %s on %s" % (switch, intname, link))
+    if old['links'] is not None and new['links'] is not None:
+        describe = lambda where: '%s VLAN %s' % where if where[1] else str(where[0])
+        for link, where in sorted(new['links'].items()):
+            if link in old['links'] and tuple(old['links'][link]) != tuple(where):
+                lines.append("~ link %s: %s -> %s" % (link, describe(old['links'][link]),
+                                                      describe(where)))
+    return lines
+
+@traced('diff')
+def diff_snapshots(args):
+    '''
+    Print how the second snapshot differs from the first (the yaml file if
+    there's only one). Returns True if they differ. When each side holds
+    one lab those two are compared whatever they are called; otherwise
+    labs are matched by name, and a yaml file's lab has to be among the
+    other side's.
+    '''
+    paths = list(args.diff) if len(args.diff) == 2 else [args.diff[0], args.yaml_file]
+    old, new = [load_snapshot(path, args) for path in paths]
+    if len(old) == 1 and len(new) == 1:
+        (old_lab, old_nodes), = old.items()
+        (new_lab, new_nodes), = new.items()
+        pairs = [(old_lab if old_lab == new_lab else '%s -> %s' % (old_lab, new_lab),
+                  old_nodes, new_nodes)]
+    else:
+        common = [lab for lab in old if lab in new]
+        if not common:
+            raise SnapshotError("No lab in both %s (%s) and %s (%s), name the yaml file's lab "
+                                "with --lab" % (paths[0], ', '.join(old) or 'none',
+                                                paths[1], ', '.join(new) or 'none'))
+        #A yaml file is one lab, so only that lab of an export is compared
+        if not paths[0].endswith('.json') or not paths[1].endswith('.json'):
+            old = OrderedDict((lab, old[lab]) for lab in common)
+            new = OrderedDict((lab, new[lab]) for lab in common)
+        pairs = [(lab, old.get(lab), new.get(lab))
+                 for lab in list(old) + [lab for lab in new if lab not in old]]
+
+    changed = False
+    for lab, old_lab, new_lab in pairs:
+        if new_lab is None:
+            print ("- lab %s (%d nodes)" % (lab, len(old_lab['nodes'])))
+        elif old_lab is None:
+            print ("+ lab %s (%d nodes)" % (lab, len(new_lab['nodes'])))
+        else:
+            lines = diff_lab(old_lab, new_lab)
+            if not lines:
+                continue
+            print ("Lab %s:" % lab)
+            for line in lines:
+                print ("    " + line)
+        changed = True
+    if not changed:
+        print ("No differences")
+    return changed
+
+def connect_host(args, hostname, sslContext):
+    '''
+    Log in to one host, exiting if we can't.
+    '''
+    service_instance = None
+    try:
+        with tracer.span('connect'):
+            service_instance = connect.SmartConnect(host=hostname,
+                                                    user=args.user,
+                                                    pwd=args.password,
+                                                    port=int(args.port),
+                                                    sslContext=sslContext)
+    except IOError as e:
+        pass
+    if not service_instance:
+        print("Could not connect to %s using specified "
+              "username and password" % hostname)
+        raise SystemExit(-1)
+
+    #Log in again by itself if the session expires in the middle of a build
+    stub = connect.VimSessionOrientedStub(
+        service_instance._stub,
+        connect.VimSessionOrientedStub.makeUserLoginMethod(args.user, args.password))
+    service_instance = vim.ServiceInstance('ServiceInstance', stub)
+
+    # Ensure that we cleanly disconnect in case our code dies
+    atexit.register(connect.Disconnect, service_instance)
+    tracer.instrument(service_instance)
+    task_monitor(service_instance).timeout = args.task_timeout
+    return service_instance
 
 def main():
     args = get_args()
+    if args.report or args.trace:
+        tracer.enable()
 
     try:
-        service_instance = None
         sslContext = None
         verify_cert = None
 
@@ -493,40 +3993,88 @@ def main():
             if hasattr(requests.packages.urllib3, 'disable_warnings'):
                 requests.packages.urllib3.disable_warnings()
 
-        try:
-            service_instance = connect.SmartConnect(host=args.host,
-                                                    user=args.user,
-                                                    pwd=args.password,
-                                                    port=int(args.port),
-                                                    sslContext=sslContext)
-        except IOError as e:
-            pass
-        if not service_instance:
-            print("Could not connect to the specified host using specified "
-                  "username and password")
-            raise SystemExit(-1)
-
-        # Ensure that we cleanly disconnect in case our code dies
-        atexit.register(connect.Disconnect, service_instance)
-
-        content = service_instance.RetrieveContent()
-        vmfolder = (get_obj(content, [vim.Folder], None))
-        resource_pool = (get_obj(content, [vim.ResourcePool], None))
-
-        with open(args.yaml_file, 'r') as fh:
-            doc = yaml.load(fh)
-        for switch in doc.keys():
-            #Push VM, create VM and build/bind Port Groups to VM
-            pushvmdk(service_instance, args.datastore,args.host,args.local_file,verify_cert,switch)
-
-            #Pass doc[switch] which is a dictionary of interfaces for the vm
-            create_vm(switch, service_instance, vmfolder, resource_pool, args.datastore, doc[switch])
+        if args.diff:
+            raise SystemExit(1 if diff_snapshots(args) else 0)
+
+        if args.export:
+            service_instances = OrderedDict((hostname, connect_host(args, hostname, sslContext))
+                                            for hostname in args.host)
+            export_labs(args, service_instances)
+            raise SystemExit(0)
+
+        #Check the whole topology before going near the host
+        start = time.time()
+        doc = load_topology(args.yaml_file)
+        print ("Topology: %d nodes, %d links (%.0f ms)" % (len(doc), len(link_members(doc)),
+                                                          (time.time() - start) * 1000))
+
+        contexts = OrderedDict()
+        for hostname in args.host:
+            service_instance = connect_host(args, hostname, sslContext)
+            with tracer.span('inventory'):
+                contexts[hostname] = BuildContext(args, service_instance, verify_cert, hostname)
+
+        if args.destroy:
+            #Each host takes down whatever part of the lab it has
+            for_each_host(contexts, lambda hostname, ctx: destroy_lab(ctx, doc,
+                                                                      len(contexts) == 1))
+            if not args.plan:
+                if len(contexts) > 1:
+                    release_uplink(args, contexts, doc)
+                print ("vEOS-lab destroyed!")
+            raise SystemExit(0)
+
+        #With several hosts each one gets its share of the topology
+        if len(contexts) > 1:
+            placement = place_lab(args, contexts, doc)
+            docs = host_docs(doc, placement, contexts)
+        else:
+            docs = OrderedDict((hostname, doc) for hostname in contexts)
+        for hostname, ctx in contexts.items():
+            if ctx.fabric is not None:
+                ctx.fabric.count_ports(docs[hostname])
+
+        #Make sure the lab fits before building anything
+        admit(contexts, docs, enforce=not args.plan)
+
+        if args.plan or args.apply:
+            #Only touch what differs from the yaml file
+            plans = OrderedDict()
+            for hostname, ctx in contexts.items():
+                if len(contexts) > 1:
+                    print ("Host %s:" % hostname)
+                snapshot = HostSnapshot(ctx)
+                network, nodes = plan_changes(ctx, docs[hostname], snapshot)
+                print_plan(network, nodes)
+                if network or nodes:
+                    plans[hostname] = (snapshot, network, nodes)
+            if args.apply and plans:
+                for_each_host(OrderedDict((hostname, contexts[hostname]) for hostname in plans),
+                              lambda hostname, ctx: apply_plan(ctx, docs[hostname],
+                                                               *plans[hostname]))
+                print ("vEOS-lab reconcile complete!")
+        else:
+            for_each_host(contexts, lambda hostname, ctx: build_lab(ctx, docs[hostname]))
+            print ("vEOS-lab generation complete!")
 
-        print ("vEOS-lab generation complete!")
+        if args.power_on and not args.plan:
+            for_each_host(contexts, lambda hostname, ctx: power_on(ctx, docs[hostname]))
+            print ("vEOS-lab powered on!")
 
     except vmodl.MethodFault as e:
-        print("Caught vmodl fault : " + e.msg)
+        print("Caught vmodl fault : %s" % (e.msg or e))
         raise SystemExit(-1)
+    except TopologyError as e:
+        print ("%s has problems:" % args.yaml_file)
+        for problem in e.problems:
+            print ("    " + problem)
+        raise SystemExit(-1)
+    except (UploadError, TaskTimeout, FabricError, PlacementError, ProfileError,
+            CapacityError, SnapshotError) as e:
+        print(e)
+        raise SystemExit(-1)
+    finally:
+        tracer.save(args.report, args.trace)
 
     raise SystemExit(0)
 